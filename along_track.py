@@ -0,0 +1,189 @@
+# Along-track sampling of gridded fields at a fixed chainage spacing.
+#
+# Bilinear interpolation weights from the model grid to points spaced evenly
+# along a route are built once per grid+route as a sparse matrix. Every
+# (time, member) field then maps to the track with a single sparse mat-mul,
+# giving values ordered by distance from the start of the route. Cubes are
+# read in (time, realization) chunks of only the grid cells the weights use,
+# so the whole cube is never loaded.
+
+import csv
+import hashlib
+
+import numpy as np
+from scipy import sparse
+
+from rail_extraction import MEMBER_CHUNK, TIME_CHUNK, _member_points, iter_corridor_chunks
+from rail_parameters import convert_values
+from rail_route import resample_route
+
+# CSV Schema (member = realization, chainage in km from the start of the route)
+ALONG_TRACK_TITLES = [
+    "Location Name",
+    "Chainage",
+    "Lat",
+    "Long",
+    "Datetime",
+    "Member",
+    "Parameter",
+    "Value",
+]
+t_str = "{dt.day}/{dt.month:02d}/{dt.year}"
+
+_weights_cache = {}
+
+
+def _bracket(points, values):
+    # Indices of the grid points either side of each value, and the fractional
+    # distance towards the second one. Handles descending coordinates.
+    descending = points[0] > points[-1]
+    asc = points[::-1] if descending else points
+    i0 = np.clip(np.searchsorted(asc, values, side="right") - 1, 0, asc.size - 2)
+    i1 = i0 + 1
+    frac = np.clip((values - asc[i0]) / (asc[i1] - asc[i0]), 0.0, 1.0)
+    if descending:
+        i0, i1 = asc.size - 1 - i0, asc.size - 1 - i1
+    return i0, i1, frac
+
+
+def _is_global(grid_lons):
+    # Evenly spaced longitudes whose spacing closes the circle, e.g. 0..359.5.
+    if grid_lons.size < 2:
+        return False
+    step = abs(grid_lons[1] - grid_lons[0])
+    return np.isclose(abs(grid_lons[-1] - grid_lons[0]) + step, 360.0, atol=step / 2)
+
+
+def _bracket_periodic(points, values):
+    # As _bracket, for a global longitude grid: values beyond the last point
+    # blend it with the first instead of being clamped to it.
+    descending = points[0] > points[-1]
+    asc = points[::-1] if descending else points
+    values = asc[0] + np.mod(values - asc[0], 360.0)
+    i0 = np.searchsorted(asc, values, side="right") - 1
+    i1 = (i0 + 1) % asc.size
+    frac = (values - asc[i0]) / (np.where(i1 == 0, asc[0] + 360.0, asc[i1]) - asc[i0])
+    if descending:
+        i0, i1 = asc.size - 1 - i0, asc.size - 1 - i1
+    return i0, i1, frac
+
+
+def _wrap_lons(lons, grid_lons):
+    # Global grids are often 0..360 while routes are given in -180..180.
+    if grid_lons.max() > 180:
+        return np.mod(lons, 360)
+    return lons
+
+
+def bilinear_weights(grid_lats, grid_lons, sample_lats, sample_lons):
+    grid_lats = np.asarray(grid_lats, dtype=float)
+    grid_lons = np.asarray(grid_lons, dtype=float)
+    sample_lats = np.asarray(sample_lats, dtype=float)
+    sample_lons = _wrap_lons(np.asarray(sample_lons, dtype=float), grid_lons)
+
+    lat0, lat1, fy = _bracket(grid_lats, sample_lats)
+    if _is_global(grid_lons):
+        lon0, lon1, fx = _bracket_periodic(grid_lons, sample_lons)
+    else:
+        lon0, lon1, fx = _bracket(grid_lons, sample_lons)
+
+    n_lon = grid_lons.size
+    n_samples = sample_lats.size
+    rows = np.repeat(np.arange(n_samples), 4)
+    cols = np.stack(
+        [lat0 * n_lon + lon0, lat0 * n_lon + lon1, lat1 * n_lon + lon0, lat1 * n_lon + lon1],
+        axis=1,
+    ).ravel()
+    weights = np.stack(
+        [(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1
+    ).ravel()
+    return sparse.csr_matrix(
+        (weights, (rows, cols)), shape=(n_samples, grid_lats.size * n_lon)
+    )
+
+
+def grid_route_key(grid_lats, grid_lons, rail_lat_lons, *extra):
+    digest = hashlib.sha1()
+    for array in (grid_lats, grid_lons, rail_lat_lons):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+def get_along_track_weights(grid_lats, grid_lons, rail_lat_lons, spacing_km=1.0):
+    # Returns (chainage, lats, lons, weights), cached per grid+route+spacing.
+    key = grid_route_key(grid_lats, grid_lons, rail_lat_lons, spacing_km)
+    if key not in _weights_cache:
+        chainage, lats, lons = resample_route(rail_lat_lons, spacing_km)
+        weights = bilinear_weights(grid_lats, grid_lons, lats, lons)
+        _weights_cache[key] = (chainage, lats, lons, weights)
+    return _weights_cache[key]
+
+
+def sample_along_track(data, weights):
+    # data has trailing (lat, lon) dims; returns trailing (sample,) instead.
+    # Masked points become NaN and so poison any sample that touches them.
+    data = np.ma.filled(np.ma.asarray(data, dtype=float), np.nan)
+    lead_shape = data.shape[:-2]
+    flat = data.reshape(-1, data.shape[-2] * data.shape[-1])
+    sampled = weights @ flat.T
+    return np.asarray(sampled).T.reshape(lead_shape + (weights.shape[0],))
+
+
+def iter_along_track_chunks(cube, weights, time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK):
+    # Yields (time points, member points, values[time, member, sample]),
+    # reading only the grid cells the weights use.
+    n_lon = len(cube.coord("longitude").points)
+    cells = np.unique(weights.indices)
+    lat_inds, lon_inds = np.divmod(cells, n_lon)
+    cell_weights = weights[:, cells]
+    for times, members, values in iter_corridor_chunks(cube, lat_inds, lon_inds, time_chunk, member_chunk):
+        yield times, members, sample_along_track(values[..., np.newaxis, :], cell_weights)
+
+
+def sample_cube_along_track(cube, rail_lat_lons, spacing_km=1.0, time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK):
+    # Returns (chainage, lats, lons, values[time, member, sample]); probability
+    # cubes get a length-one member axis.
+    chainage, lats, lons, weights = get_along_track_weights(
+        cube.coord("latitude").points,
+        cube.coord("longitude").points,
+        rail_lat_lons,
+        spacing_km,
+    )
+    n_members = len(_member_points(cube)[1])
+    values = np.empty((len(cube.coord("time").points), n_members, len(chainage)))
+    # Chunks come time-major, members varying fastest.
+    t_start = m_start = 0
+    for times, members, chunk in iter_along_track_chunks(cube, weights, time_chunk, member_chunk):
+        values[t_start : t_start + len(times), m_start : m_start + len(members)] = chunk
+        m_start += len(members)
+        if m_start == n_members:
+            t_start, m_start = t_start + len(times), 0
+    return chainage, lats, lons, values
+
+
+def along_track_rows(cube, rail_lat_lons, location_name="rail", spacing_km=1.0):
+    # Yields CSV rows ordered by time, member and then chainage.
+    # Expects a (time, realization, lat, lon) cube as used in the notebooks.
+    chainage, lats, lons, values = sample_cube_along_track(
+        cube, rail_lat_lons, spacing_km
+    )
+    param_name = cube.name()
+    values = convert_values(param_name, cube.units, values)
+    t_unit = cube.coord("time").units
+    times = cube.coord("time").points
+    members = cube.coord("realization").points
+    for ti, t_point in enumerate(times):
+        date = t_str.format(dt=t_unit.num2date(t_point))
+        for mi, ens_mbr in enumerate(members):
+            for ch, lac, loc, val in zip(chainage, lats, lons, values[ti, mi]):
+                yield [location_name, ch, lac, loc, date, ens_mbr, param_name, val]
+
+
+def write_along_track_csv(filepath, cube, rail_lat_lons, location_name="rail", spacing_km=1.0):
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(ALONG_TRACK_TITLES)
+        csvw.writerows(
+            along_track_rows(cube, rail_lat_lons, location_name, spacing_km)
+        )
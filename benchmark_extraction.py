@@ -0,0 +1,307 @@
+# Synthetic-cube benchmarks for the rail extraction path.
+#
+# Builds MOGREPS-G-shaped (time, realization, latitude, longitude) cubes over
+# the UK offline, so no agl_temperature.nc / rail_temperature.nc download is
+# needed, and times the cut, extract (read and gather), aggregate and write
+# stages over a sweep of grid sizes and member counts. The stages stream
+# chunks as production does; wall times are taken without tracemalloc and
+# peak memory in a separate traced pass. Each result records rows/s and peak
+# memory and is appended to a JSON-lines file with the git revision, so a run
+# can be compared with the previous one for the same configuration and
+# slowdowns flagged.
+#
+#   python benchmark_extraction.py -g 100x100,200x200,400x400 -n 2,6,18 -t 12
+#   python benchmark_extraction.py -y diagonal -w 3 -m 0.1 -r 1.2
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import dask.array as da
+import numpy as np
+from iris.coord_systems import GeogCS
+from iris.coords import DimCoord
+from iris.cube import Cube
+
+import profiling
+from rail_aggregation import stream_window_stats
+from rail_extraction import chunk_rows, convert_chunk, corridor_coords, corridor_indices, iter_corridor_chunks, titles
+from rail_route import load_rail_lat_lons, rail_line_from_lat_lons
+
+RESULTS_FILE = "benchmark_results.jsonl"
+UK_BBOX = (49.0, 61.0, -8.0, 2.0)
+LAYOUTS = ["route", "diagonal", "scatter"]
+REGRESSION_RATIO = 1.2
+
+
+def synthetic_cube(n_time, n_members, n_lat, n_lon, masked=0.0, lazy=True, seed=0):
+    # Hourly air temperature in K, one dask chunk per field when lazy. A
+    # `masked` fraction of the points is masked, as missing members and
+    # sea points are in the real files.
+    lat0, lat1, lon0, lon1 = UK_BBOX
+    shape = (n_time, n_members, n_lat, n_lon)
+    if lazy:
+        state = da.random.RandomState(seed)
+        chunks = (1, 1, n_lat, n_lon)
+        data = state.uniform(270.0, 305.0, size=shape, chunks=chunks).astype(np.float32)
+        if masked:
+            data = da.ma.masked_where(state.random_sample(shape, chunks=chunks) < masked, data)
+    else:
+        rng = np.random.default_rng(seed)
+        data = rng.uniform(270.0, 305.0, size=shape).astype(np.float32)
+        if masked:
+            data = np.ma.masked_where(rng.random(shape) < masked, data)
+    cs = GeogCS(6371229.0)
+    return Cube(
+        data,
+        standard_name="air_temperature",
+        units="K",
+        dim_coords_and_dims=[
+            (DimCoord(np.arange(n_time, dtype=float), "time", units="hours since 2022-07-18 00:00:00"), 0),
+            (DimCoord(np.arange(n_members), "realization", units="1"), 1),
+            (DimCoord(np.linspace(lat0, lat1, n_lat), "latitude", units="degrees", coord_system=cs), 2),
+            (DimCoord(np.linspace(lon0, lon1, n_lon), "longitude", units="degrees", coord_system=cs), 3),
+        ],
+    )
+
+
+def synthetic_corridor(cube, layout, width=1, fraction=0.002, seed=0):
+    # "route" cuts the London-Edinburgh line with shapecutter; "diagonal" is a
+    # band `width` cells wide across the grid; "scatter" is a random
+    # `fraction` of all cells.
+    n_lat = len(cube.coord("latitude").points)
+    n_lon = len(cube.coord("longitude").points)
+    if layout == "route":
+        return corridor_indices(cube, rail_line_from_lat_lons(load_rail_lat_lons()))
+    if layout == "diagonal":
+        lat_inds = np.repeat(np.arange(n_lat), width)
+        lon_inds = (lat_inds * n_lon // n_lat + np.tile(np.arange(width), n_lat)) % n_lon
+        return lat_inds, lon_inds
+    if layout == "scatter":
+        n_cells = max(1, int(n_lat * n_lon * fraction))
+        flat = np.random.default_rng(seed).choice(n_lat * n_lon, n_cells, replace=False)
+        return np.unravel_index(np.sort(flat), (n_lat, n_lon))
+    raise ValueError("Unknown corridor layout: " + layout)
+
+
+def stage_funcs(cube, lat_inds, lon_inds, csv_filepath):
+    # The extract, aggregate and write stages as production runs them, each
+    # streaming its own chunks: extract only reads and converts, aggregate
+    # and write include that reading as extract_to_csv and write_pyramid do.
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    t_unit = cube.coord("time").units
+
+    def chunks():
+        for times, members, values in iter_corridor_chunks(cube, lat_inds, lon_inds):
+            yield times, members, convert_chunk(cube.name(), cube.units, values)
+
+    def extract():
+        for _ in chunks():
+            pass
+
+    def aggregate():
+        for _ in stream_window_stats(chunks(), t_unit, windows=(3, 6, 24)):
+            pass
+
+    def write():
+        n_rows = 0
+        with open(csv_filepath, "w") as csvfile:
+            csvw = csv.writer(csvfile)
+            csvw.writerow(titles)
+            for times, members, values in chunks():
+                rows = list(chunk_rows("rail", cube.name(), t_unit, lat_coords, lon_coords, times, members, values))
+                n_rows += len(rows)
+                csvw.writerows(rows)
+        return n_rows
+
+    return [("extract", extract), ("aggregate", aggregate), ("write", write)]
+
+
+def run_case(n_time, n_members, n_lat, n_lon, layout, width=1, masked=0.0):
+    # Wall times come from a pass without tracemalloc, whose tracing would
+    # otherwise dominate them; peak memory from a second, traced pass.
+    profiling.disable()
+    cube = synthetic_cube(n_time, n_members, n_lat, n_lon, masked)
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        csv_filepath = os.path.join(tmp_folder, "bench.csv")
+        start = time.perf_counter()
+        lat_inds, lon_inds = synthetic_corridor(cube, layout, width)
+        stages["cut"] = {"wall_s": time.perf_counter() - start}
+        funcs = stage_funcs(cube, lat_inds, lon_inds, csv_filepath)
+        results = {}
+        for name, func in funcs:
+            start = time.perf_counter()
+            results[name] = func()
+            stages[name] = {"wall_s": time.perf_counter() - start}
+        n_rows = results["write"]
+
+        profiling.enable()
+        profiling.reset()
+        with profiling.stage("cut"):
+            synthetic_corridor(cube, layout, width)
+        for name, func in funcs:
+            with profiling.stage(name):
+                func()
+        for record in profiling.report():
+            if record["stage"] in stages:
+                stages[record["stage"]]["peak_bytes"] = record["peak_bytes"]
+        profiling.disable()
+
+    # Rows/s of the production path: cut, then read and write the rows.
+    extract_s = stages["cut"]["wall_s"] + stages["write"]["wall_s"]
+    return {
+        "config": {
+            "time": n_time,
+            "members": n_members,
+            "lat": n_lat,
+            "lon": n_lon,
+            "layout": layout,
+            "width": width,
+            "masked": masked,
+        },
+        "corridor_cells": int(len(lat_inds)),
+        "rows": n_rows,
+        "rows_per_s": n_rows / extract_s if extract_s else None,
+        "peak_bytes": max(stage["peak_bytes"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results(filepath):
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def previous_result(results, config):
+    for result in reversed(results):
+        if result["config"] == config:
+            return result
+    return None
+
+
+def compare(result, previous, ratio=REGRESSION_RATIO):
+    # Stage names whose wall time grew by more than `ratio` since `previous`.
+    slower = []
+    for name, stage in result["stages"].items():
+        before = previous["stages"].get(name)
+        if before and before["wall_s"] > 0 and stage["wall_s"] / before["wall_s"] > ratio:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark rail extraction stages on synthetic MOGREPS-G-shaped cubes."
+    )
+    parser.add_argument(
+        "-g",
+        "--grids",
+        action="store",
+        dest="grids",
+        default="100x100,200x200,400x400",
+        help="Comma separated LATxLON grid sizes.",
+    )
+    parser.add_argument(
+        "-n",
+        "--members",
+        action="store",
+        dest="members",
+        default="2,6,18",
+        help="Comma separated ensemble sizes.",
+    )
+    parser.add_argument(
+        "-t", "--times", action="store", dest="times", default=12, type=int, help="Number of time steps."
+    )
+    parser.add_argument(
+        "-y",
+        "--layout",
+        action="store",
+        dest="layout",
+        default="route",
+        choices=LAYOUTS,
+        help="Corridor layout. Defaults to the London-Edinburgh route.",
+    )
+    parser.add_argument(
+        "-w", "--width", action="store", dest="width", default=1, type=int, help="Diagonal corridor width in cells."
+    )
+    parser.add_argument(
+        "-m",
+        "--masked",
+        action="store",
+        dest="masked",
+        default=0.0,
+        type=float,
+        help="Fraction of the synthetic data to mask.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        dest="output",
+        default=RESULTS_FILE,
+        help="JSON-lines file the results are appended to.",
+    )
+    parser.add_argument(
+        "-r",
+        "--ratio",
+        action="store",
+        dest="ratio",
+        default=REGRESSION_RATIO,
+        type=float,
+        help="Flag stages slower than this ratio against the previous result.",
+    )
+    args = parser.parse_args()
+
+    history = load_results(args.output)
+    revision = git_revision()
+    print("{:>9} {:>7} {:>7} {:>12} {:>10} {:>12}".format("grid", "members", "cells", "rows", "rows/s", "peak MB"))
+    with open(args.output, "a") as results_file:
+        for grid in args.grids.split(","):
+            n_lat, n_lon = (int(n) for n in grid.split("x"))
+            for n_members in (int(n) for n in args.members.split(",")):
+                result = run_case(args.times, n_members, n_lat, n_lon, args.layout, args.width, args.masked)
+                result["revision"] = revision
+                result["created"] = datetime.now().isoformat()
+                print(
+                    "{:>9} {:>7} {:>7} {:>12} {:>10.0f} {:>12.1f}".format(
+                        grid,
+                        n_members,
+                        result["corridor_cells"],
+                        result["rows"],
+                        result["rows_per_s"] or 0,
+                        result["peak_bytes"] / 1e6,
+                    )
+                )
+                previous = previous_result(history, result["config"])
+                if previous is not None:
+                    slower = compare(result, previous, args.ratio)
+                    if slower:
+                        print(
+                            "WARNING: slower than "
+                            + previous.get("revision", "previous run")
+                            + " in: "
+                            + ", ".join(slower)
+                        )
+                results_file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,8 @@
 # See https://github.com/MetOffice/weather_datahub_utilities/blob/main/atmospheric_order_download/Documentation.md
 
 import csv, os
+import json
+import re
 import requests
 import argparse
 import time
@@ -25,10 +27,11 @@ import queue
 import threading
 import uuid
 
+import profiling
+from weatherdatahub_api import BASE_URL, MODEL_LIST
+
 # Example code to download GRIB data files from the Met Office Weather DataHub via API calls
 
-MODEL_LIST = ["mo-global", "mo-uk", "mo-uk-latlon", "mo-mogrepsg"]
-BASE_URL = "https://api-metoffice.apiconnect.ibmcloud.com/metoffice/production/1.0.0"
 debugMode = False
 printUrl = False
 retryCount = 3
@@ -141,6 +144,106 @@ def get_order_file(
     return [ttfb, local_filename]
 
 
+# Block size for streamed blob uploads; Azure allows up to 50,000 blocks.
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def stream_order_file_to_blob(
+    baseUrl, requestHeaders, orderName, fileId, container_client, blobName, start
+):
+
+    # Pipe the response body straight into a block blob: each BLOB_BLOCK_SIZE
+    # of the body is staged as it arrives and the block list committed at
+    # the end, so nothing touches local disk.
+
+    import base64
+    from azure.storage.blob import BlobBlock
+
+    url = baseUrl + "/orders/" + orderName + "/latest/" + fileId + "/data"
+    actualHeaders = {"Accept": "application/x-grib"}
+    actualHeaders.update(requestHeaders)
+    blob_client = container_client.get_blob_client(blobName)
+
+    blockIds = []
+    fileSize = 0
+
+    def stage(data):
+        blockId = base64.b64encode("{:08d}".format(len(blockIds)).encode()).decode()
+        blob_client.stage_block(blockId, data)
+        blockIds.append(BlobBlock(block_id=blockId))
+
+    with requests.get(
+        url, headers=actualHeaders, allow_redirects=True, stream=True
+    ) as r:
+
+        if printUrl == True:
+            print("stream_order_file_to_blob: ", url)
+            if url != r.url:
+                print("redirected to: ", r.url)
+
+        if r.status_code != 200:
+
+            raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
+
+        ttfb = start + r.elapsed.total_seconds()
+
+        block = bytearray()
+        for chunk in r.iter_content(chunk_size=65536):
+            fileSize += len(chunk)
+            block += chunk
+            if len(block) >= BLOB_BLOCK_SIZE:
+                stage(bytes(block))
+                block = bytearray()
+        if block or not blockIds:
+            stage(bytes(block))
+
+    blob_client.commit_block_list(blockIds)
+    return [ttfb, blob_client.url, fileSize]
+
+
+def grib_message_length(data, start):
+
+    # Total length of the GRIB message starting at `start`, from section 0:
+    # 3 bytes at offset 4 in edition 1, 8 bytes at offset 8 in edition 2.
+
+    if data[start + 7] == 1:
+        return int.from_bytes(data[start + 4:start + 7], "big")
+    return int.from_bytes(data[start + 8:start + 16], "big")
+
+
+def grib_messages_from_bytes(data):
+
+    # Decode GRIB messages held in memory (e.g. a blob downloaded with
+    # download_blob().readall()) with eccodes, yielding (shortName,
+    # validityDate, validityTime, values) per message. Each message is cut
+    # from a memoryview at its section 0 length, so only that message is
+    # copied for eccodes rather than the rest of the buffer.
+
+    import eccodes
+
+    view = memoryview(data)
+    offset = 0
+    while True:
+        start = data.find(b"GRIB", offset)
+        if start < 0 or start + 16 > len(data):
+            break
+        end = start + grib_message_length(data, start)
+        if not start + 16 <= end <= len(data):
+            print("WARNING: Bad or truncated GRIB message at byte " + str(start) + ", stopping.")
+            break
+        gid = eccodes.codes_new_from_message(bytes(view[start:end]))
+        try:
+            yield (
+                eccodes.codes_get(gid, "shortName"),
+                eccodes.codes_get(gid, "validityDate"),
+                eccodes.codes_get(gid, "validityTime"),
+                eccodes.codes_get_values(gid),
+            )
+        finally:
+            eccodes.codes_release(gid)
+        offset = end
+
+
 def get_files_by_run(order, runsToDownload, numFilesPerOrder):
 
     # Break down the files in to those needed for each run
@@ -160,6 +263,99 @@ def get_files_by_run(order, runsToDownload, numFilesPerOrder):
     return filesByRun
 
 
+# Download scheduling: the order files are queued in the order the policy
+# gives. "largest" is longest-processing-time-first on the sizes in the
+# order details, which shortens the tail of the download; "leadtime" and
+# "parameter" get the earliest lead times, or the parameters listed first,
+# on disk first.
+SCHEDULING_POLICIES = ["order", "largest", "leadtime", "parameter"]
+# Lead time as it appears in Weather DataHub file ids.
+LEAD_TIME_PATTERN = re.compile(r"_\+\d{2}_?\+?(\d{3,4})")
+
+
+def file_lead_time(fileId):
+    match = LEAD_TIME_PATTERN.search(fileId)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def file_parameter_rank(fileId, parameterPriority):
+    for rank, parameter in enumerate(parameterPriority):
+        if parameter in fileId:
+            return rank
+    return len(parameterPriority)
+
+
+def schedule_tasks(downloadTasks, policy, fileSizes=None, parameterPriority=None):
+
+    # Sorts are stable, so ties keep the order details order
+
+    if policy == "largest":
+        fileSizes = fileSizes or {}
+        if not any(fileSizes.get(t["fileId"]) for t in downloadTasks):
+            print("WARNING: No file sizes in the order details, keeping the order.")
+            return list(downloadTasks)
+        return sorted(downloadTasks, key=lambda t: -(fileSizes.get(t["fileId"]) or 0))
+    if policy == "leadtime":
+        return sorted(
+            downloadTasks,
+            key=lambda t: (
+                t["leadTime"] is None,
+                t["leadTime"] or 0,
+                file_parameter_rank(t["fileId"], parameterPriority or []),
+            ),
+        )
+    if policy == "parameter":
+        return sorted(
+            downloadTasks,
+            key=lambda t: (
+                file_parameter_rank(t["fileId"], parameterPriority or []),
+                t["leadTime"] is None,
+                t["leadTime"] or 0,
+            ),
+        )
+    return list(downloadTasks)
+
+
+class LeadTimeTracker:
+
+    # Writes <folder>/ready/+LLL.json once every file of that lead time in
+    # the run folder has downloaded, so later stages can start on it.
+
+    def __init__(self):
+        self.remaining = {}
+        self.fileIds = {}
+        self.lock = threading.Lock()
+
+    def add(self, folder, leadTime, fileId):
+        key = (folder, leadTime)
+        self.remaining[key] = self.remaining.get(key, 0) + 1
+        self.fileIds.setdefault(key, []).append(fileId)
+
+    def done(self, folder, leadTime):
+        key = (folder, leadTime)
+        with self.lock:
+            self.remaining[key] -= 1
+            if self.remaining[key] > 0:
+                return None
+        readyFolder = os.path.join(folder, "ready")
+        os.makedirs(readyFolder, exist_ok=True)
+        markerFile = os.path.join(readyFolder, "+{:03d}.json".format(leadTime))
+        with open(markerFile, "w") as marker:
+            json.dump(
+                {
+                    "leadTime": leadTime,
+                    "files": self.fileIds[key],
+                    "ready": datetime.now().isoformat(),
+                },
+                marker,
+            )
+        if verbose:
+            print("Lead time " + str(leadTime) + " ready: " + markerFile)
+        return markerFile
+
+
 def download_worker():
 
     if taskQueue:
@@ -178,18 +374,36 @@ def download_worker():
             timeToFirstByte = 0
             startTime = time.time()
             try:
-                downloadResp = get_order_file(
-                    downloadTask["baseUrl"],
-                    downloadTask["requestHeaders"],
-                    downloadTask["orderName"],
-                    downloadTask["fileId"],
-                    downloadTask["guidFileNames"],
-                    downloadTask["folder"],
-                    startTime,
-                )
+                if downloadTask.get("containerClient") is not None:
+                    # Straight to blob storage, bypassing local disk
+                    with profiling.stage("stream_order_file_to_blob"):
+                        downloadResp = stream_order_file_to_blob(
+                            downloadTask["baseUrl"],
+                            downloadTask["requestHeaders"],
+                            downloadTask["orderName"],
+                            downloadTask["fileId"],
+                            downloadTask["containerClient"],
+                            os.path.basename(downloadTask["folder"])
+                            + "/"
+                            + downloadTask["fileId"]
+                            + ".grib2",
+                            startTime,
+                        )
+                    fileSize = downloadResp[2]
+                else:
+                    with profiling.stage("get_order_file"):
+                        downloadResp = get_order_file(
+                            downloadTask["baseUrl"],
+                            downloadTask["requestHeaders"],
+                            downloadTask["orderName"],
+                            downloadTask["fileId"],
+                            downloadTask["guidFileNames"],
+                            downloadTask["folder"],
+                            startTime,
+                        )
+                    fileSize = os.path.getsize(downloadResp[1])
                 timeToFirstByte = round((downloadResp[0] - startTime), 2)
                 downloadedFile = downloadResp[1]
-                fileSize = os.path.getsize(downloadedFile)
 
             except Exception as ex:
                 error = True
@@ -211,6 +425,8 @@ def download_worker():
                         "currentTime": current_time,
                         "ordername": downloadTask["orderName"],
                         "folder": downloadTask["folder"],
+                        "leadTime": downloadTask.get("leadTime"),
+                        "readyTracker": downloadTask.get("readyTracker"),
                     }
                 )
                 downloadTask["responseLog"].append(
@@ -248,6 +464,13 @@ def download_worker():
                         "currentTime": current_time,
                     }
                 )
+                if (
+                    downloadTask.get("readyTracker") is not None
+                    and downloadTask["leadTime"] is not None
+                ):
+                    downloadTask["readyTracker"].done(
+                        downloadTask["folder"], downloadTask["leadTime"]
+                    )
 
             taskQueue.task_done()
 
@@ -493,7 +716,7 @@ printUrl = ""
 taskQueue = None
 
 
-def download_from_weatherdatahub():
+def download_from_weatherdatahub(argv=None):
     parser = argparse.ArgumentParser(
         description="Download all the files for one or more order from the CDA delivery service."
     )
@@ -626,8 +849,42 @@ def download_from_weatherdatahub():
         default="",
         help="Use direct API Key when not via APIM.",
     )
+    parser.add_argument(
+        "-b",
+        "--blob",
+        action="store",
+        dest="blobContainer",
+        default="",
+        help="Stream the GRIB files straight to this blob container instead of to disk (uses AZURE_STORAGE_CONNECTION_STRING).",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "-g",
+        "--schedule",
+        action="store",
+        dest="schedule",
+        default="order",
+        choices=SCHEDULING_POLICIES,
+        help="Download order: as listed in the order, largest files first, earliest lead times first or by parameter priority.",
+    )
+    parser.add_argument(
+        "-n",
+        "--priority",
+        action="store",
+        dest="priority",
+        default="",
+        help="Comma separated parameters, most urgent first, for the leadtime and parameter schedules.",
+    )
+    parser.add_argument(
+        "-e",
+        "--ready",
+        action="store_true",
+        dest="ready",
+        default=False,
+        help="Write a ready/+LLL.json marker in the run folder as each lead time completes.",
+    )
+
+    args = parser.parse_args(argv)
 
     global baseUrl
     global clientId
@@ -662,6 +919,19 @@ def download_from_weatherdatahub():
     baseFolder = args.location
     apikey = args.apikey
     printUrl = args.printurl
+    parameterPriority = [p for p in args.priority.split(",") if p]
+
+    containerClient = None
+    if args.blobContainer != "":
+        from azure.storage.blob import BlobServiceClient
+
+        connectStr = os.environ.get("AZURE_STORAGE_CONNECTION_STRING", "")
+        if connectStr == "":
+            print("ERROR: AZURE_STORAGE_CONNECTION_STRING must be set to stream to blob.")
+            exit()
+        containerClient = BlobServiceClient.from_connection_string(
+            connectStr
+        ).get_container_client(args.blobContainer)
 
     if debugMode == True:
         print("WARNING: As we are in debug mode setting workers to one.")
@@ -834,6 +1104,12 @@ def download_from_weatherdatahub():
 
             # Break down the files in to those needed for each run
             filesByRun = get_files_by_run(order, runsToDownload, numFilesPerOrder)
+            fileSizes = {
+                f["fileId"]: f.get("fileSize", f.get("size"))
+                for f in order["orderDetails"]["files"]
+            }
+            readyTracker = LeadTimeTracker() if args.ready else None
+            downloadTasks = []
 
             # Now queue up tasks to down load each file
             for run in runsToDownload:
@@ -853,7 +1129,8 @@ def download_from_weatherdatahub():
                 else:
                     folder = baseFolder + ROOT_FOLDER + "/" + orderName + "_" + run
 
-                os.makedirs(folder, exist_ok=True)
+                if containerClient is None:
+                    os.makedirs(folder, exist_ok=True)
                 for fileId in filesByRun[run]:
                     downloadTask = {
                         "baseUrl": baseUrl,
@@ -862,10 +1139,21 @@ def download_from_weatherdatahub():
                         "fileId": fileId,
                         "guidFileNames": guidFileNames,
                         "folder": folder,
+                        "containerClient": containerClient,
+                        "leadTime": file_lead_time(fileId),
+                        "readyTracker": readyTracker,
                         "responseLog": responseLog,
                         "downloadErrorLog": downloadErrorLog,
                     }
-                    taskQueue.put(downloadTask)
+                    if readyTracker is not None and downloadTask["leadTime"] is not None:
+                        readyTracker.add(folder, downloadTask["leadTime"], fileId)
+                    downloadTasks.append(downloadTask)
+
+            # Queue in the order of the scheduling policy, across all runs
+            for downloadTask in schedule_tasks(
+                downloadTasks, args.schedule, fileSizes, parameterPriority
+            ):
+                taskQueue.put(downloadTask)
 
         # Start the worker threads
         if ordersfound == False:
@@ -998,16 +1286,31 @@ def download_from_weatherdatahub():
                         retryFile["fileid"],
                         retryFile["folder"],
                     )
-                downloadResp = get_order_file(
-                    baseUrl,
-                    requestHeaders,
-                    retryFile["ordername"],
-                    retryFile["fileid"],
-                    False,
-                    retryFile["folder"],
-                    startTime,
-                )
-                fileSize = os.path.getsize(downloadResp[1])
+                if containerClient is not None:
+                    downloadResp = stream_order_file_to_blob(
+                        baseUrl,
+                        requestHeaders,
+                        retryFile["ordername"],
+                        retryFile["fileid"],
+                        containerClient,
+                        os.path.basename(retryFile["folder"])
+                        + "/"
+                        + retryFile["fileid"]
+                        + ".grib2",
+                        startTime,
+                    )
+                    fileSize = downloadResp[2]
+                else:
+                    downloadResp = get_order_file(
+                        baseUrl,
+                        requestHeaders,
+                        retryFile["ordername"],
+                        retryFile["fileid"],
+                        False,
+                        retryFile["folder"],
+                        startTime,
+                    )
+                    fileSize = os.path.getsize(downloadResp[1])
 
             except Exception as ex:
                 error = True
@@ -1027,6 +1330,13 @@ def download_from_weatherdatahub():
                         + "\n"
                     )
                 sumfile.close()
+                if (
+                    retryFile.get("readyTracker") is not None
+                    and retryFile.get("leadTime") is not None
+                ):
+                    retryFile["readyTracker"].done(
+                        retryFile["folder"], retryFile["leadTime"]
+                    )
 
             else:
                 with open(failuresFileName, "a") as errfile:
@@ -1061,7 +1371,8 @@ def main():
     latest_run = get_latest_mogreps_run()
     print(f"Fetching run {latest_run}")
     set_arguments(latest_run)
-    fetch_data()
+    with profiling.stage("fetch"):
+        fetch_data()
 
     connect_str = "DefaultEndpointsProtocol=https;AccountName=moensembledata;AccountKey=DG1JH+DzSNLxI4kKKPlu1wwOSXSopn69sMU0nYqbFptqJsNs8x3txu+DNACKoJUBskLKP/Lwt5a8+AStT2GnhA==;EndpointSuffix=core.windows.net"
     blob_service_client = BlobServiceClient.from_connection_string(connect_str)
@@ -1080,10 +1391,16 @@ def main():
 #         "ground_temperature",
 #         "pressure-reduced-to-msl",
     ]:
-        out_filepath = convert_and_save_netcdf_xr(
-            f"test_data/downloaded/{ORDER_NUMBER}_{latest_run}", parameter_name
-        )
-        copy_to_blob(blob_service_client, out_filepath)
+        with profiling.stage("convert"):
+            out_filepath = convert_and_save_netcdf_xr(
+                f"test_data/downloaded/{ORDER_NUMBER}_{latest_run}", parameter_name
+            )
+        with profiling.stage("upload"):
+            copy_to_blob(blob_service_client, out_filepath)
+
+    profile_filepath = profiling.write_profile(order=ORDER_NUMBER, run=latest_run)
+    if profile_filepath:
+        print(f"Wrote profile {profile_filepath}")
 
 
 def copy_to_blob(blob_service_client, filepath):
@@ -1130,21 +1447,25 @@ def convert_and_save_netcdf_xr(filepath, parameter_name):
     dss = []
     for grib_filepath in glob(os.path.join(filepath, f"*{parameter_name}*.grib2")):
         print(f"loading grib {grib_filepath}")
-        ds = xr.open_dataset(grib_filepath, engine="cfgrib")
+        with profiling.stage("cfgrib.open_dataset"):
+            ds = xr.open_dataset(grib_filepath, engine="cfgrib")
         dss.append(ds)
     print(f"got {len(dss)} datasets")
-    ds = xr.concat(dss, "number")
+    with profiling.stage("xr.concat"):
+        ds = xr.concat(dss, "number")
     ds = ds.rename_dims({"number": "realization"})
     print(ds)
-    print(ds["t2m"])
     out_filepath = os.path.join(filepath, f"{parameter_name}.nc")
-    ds.to_netcdf(out_filepath)
+    with profiling.stage("to_netcdf"):
+        ds.to_netcdf(out_filepath)
     return out_filepath
 
 
 # COMMAND ----------
 
-main()
+# Notebooks run as __main__; the guard lets pipeline.py import this module.
+if __name__ == "__main__":
+    main()
 
 # COMMAND ----------
 
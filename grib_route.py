@@ -0,0 +1,246 @@
+# Direct GRIB-to-route extraction, skipping the NetCDF round trip.
+#
+# convert_and_save_netcdf_xr writes whole-domain NetCDF that is uploaded and
+# read back only to keep the few hundred corridor cells. Here GRIB messages
+# are read one at a time with eccodes, only the corridor points of each field
+# are decoded (codes_get_double_elements) and rows go straight to CSV or
+# Parquet, so memory and output scale with the corridor rather than the
+# domain. The corridor is cut once per grid and route, on a single-field
+# cube, and cached next to the route cache.
+#
+#   python grib_route.py -i ./test_data/downloaded/<order>_<run> -o rail.parquet -f parquet
+
+import argparse
+import csv
+import os
+from datetime import datetime
+from glob import glob
+
+import eccodes
+import numpy as np
+
+from along_track import grid_route_key
+from rail_csv import t_str, titles
+from rail_parameters import convert_values
+from rail_route import DEFAULT_ROUTE_FILE, ROUTE_CACHE_FOLDER, RouteRegistry
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+PARQUET_BATCH_ROWS = 100000
+# Keys that pin down a regular lat/lon grid.
+GRID_KEYS = [
+    "Ni",
+    "Nj",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "latitudeOfLastGridPointInDegrees",
+    "longitudeOfLastGridPointInDegrees",
+]
+
+
+def iter_grib_messages(filepath):
+    with open(filepath, "rb") as grib_file:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(grib_file)
+            if gid is None:
+                break
+            try:
+                yield gid
+            finally:
+                eccodes.codes_release(gid)
+
+
+def grid_signature(gid):
+    return tuple(eccodes.codes_get(gid, key) for key in GRID_KEYS)
+
+
+def grid_coords(gid):
+    # 1D latitudes and longitudes in the message's scanning order.
+    n_lat, n_lon = eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni")
+    lats = eccodes.codes_get_array(gid, "latitudes").reshape(n_lat, n_lon)[:, 0]
+    lons = eccodes.codes_get_array(gid, "longitudes").reshape(n_lat, n_lon)[0, :]
+    return lats, lons
+
+
+def grib_corridor(gid, route, cache_folder=ROUTE_CACHE_FOLDER):
+    # Corridor (lat_inds, lon_inds) for this message's grid, cut with
+    # shapecutter on a one-field cube the first time and cached after.
+    lats, lons = grid_coords(gid)
+    os.makedirs(cache_folder, exist_ok=True)
+    cache_path = os.path.join(
+        cache_folder, "corridor-" + grid_route_key(lats, lons, route.rail_lat_lons) + ".npz"
+    )
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            return lats, lons, (cached["lat_inds"], cached["lon_inds"])
+
+    from iris.coord_systems import GeogCS
+    from iris.coords import DimCoord
+    from iris.cube import Cube
+
+    from rail_extraction import corridor_indices
+
+    cs = GeogCS(6371229.0)
+    field = Cube(
+        eccodes.codes_get_values(gid).reshape(len(lats), len(lons)),
+        dim_coords_and_dims=[
+            (DimCoord(lats, "latitude", units="degrees", coord_system=cs), 0),
+            (DimCoord(lons, "longitude", units="degrees", coord_system=cs), 1),
+        ],
+    )
+    lat_inds, lon_inds = corridor_indices(field, route.line)
+    np.savez(cache_path, lat_inds=lat_inds, lon_inds=lon_inds)
+    return lats, lons, (lat_inds, lon_inds)
+
+
+def message_param_name(gid):
+    for key in ("cfName", "cfVarName", "shortName"):
+        if eccodes.codes_is_defined(gid, key):
+            name = eccodes.codes_get(gid, key)
+            if name and name != "unknown":
+                return name
+    return "unknown"
+
+
+def message_units(gid):
+    import cf_units
+
+    try:
+        return cf_units.Unit(eccodes.codes_get(gid, "units"))
+    except ValueError:
+        return None
+
+
+def message_valid_time(gid):
+    return datetime.strptime(
+        "{}{:04d}".format(eccodes.codes_get(gid, "validityDate"), eccodes.codes_get(gid, "validityTime")),
+        "%Y%m%d%H%M",
+    )
+
+
+def message_member(gid):
+    if eccodes.codes_is_defined(gid, "perturbationNumber"):
+        return eccodes.codes_get(gid, "perturbationNumber")
+    return "Summary"
+
+
+def grib_route_rows(grib_filepaths, route, location_name="rail", cache_folder=ROUTE_CACHE_FOLDER):
+    # Yields rows in the `titles` schema for every message of every file.
+    signature = None
+    for grib_filepath in grib_filepaths:
+        for gid in iter_grib_messages(grib_filepath):
+            if grid_signature(gid) != signature:
+                signature = grid_signature(gid)
+                lats, lons, (lat_inds, lon_inds) = grib_corridor(gid, route, cache_folder)
+                flat_inds = (lat_inds * len(lons) + lon_inds).tolist()
+                lat_coords, lon_coords = lats[lat_inds], lons[lon_inds]
+
+            values = np.array(eccodes.codes_get_double_elements(gid, "values", flat_inds))
+            keep = np.ones(len(values), dtype=bool)
+            if eccodes.codes_get(gid, "bitmapPresent"):
+                keep = values != eccodes.codes_get(gid, "missingValue")
+            param_name = message_param_name(gid)
+            values = convert_values(param_name, message_units(gid), values)
+            date = t_str.format(dt=message_valid_time(gid))
+            member = message_member(gid)
+            for lac, loc, val in zip(lat_coords[keep], lon_coords[keep], values[keep]):
+                yield [location_name, lac, loc, date, member, param_name, val]
+
+
+def write_rows_csv(out_filepath, rows):
+    with open(out_filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(titles)
+        csvw.writerows(rows)
+
+
+def write_rows_parquet(out_filepath, rows, batch_rows=PARQUET_BATCH_ROWS):
+    # Written in row groups of batch_rows, so memory stays bounded.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("Location Name", pa.string()),
+            ("Lat", pa.float64()),
+            ("Long", pa.float64()),
+            ("Datetime", pa.string()),
+            ("Member", pa.string()),
+            ("Parameter", pa.string()),
+            ("Value", pa.float64()),
+        ]
+    )
+
+    def write_batch(writer, batch):
+        columns = [list(column) for column in zip(*batch)]
+        columns[4] = [str(member) for member in columns[4]]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    with pq.ParquetWriter(out_filepath, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                write_batch(writer, batch)
+                batch = []
+        if batch:
+            write_batch(writer, batch)
+
+
+def find_grib_files(inputs):
+    filepaths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            filepaths.extend(sorted(glob(os.path.join(entry, "*.grib2"))))
+        else:
+            filepaths.extend(sorted(glob(entry)))
+    return filepaths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract rail corridor points straight from GRIB files to CSV or Parquet."
+    )
+    parser.add_argument(
+        "-i",
+        "--inputs",
+        action="store",
+        dest="inputs",
+        nargs="+",
+        required=True,
+        help="GRIB files, folders of them or glob patterns.",
+    )
+    parser.add_argument(
+        "-r", "--route", action="store", dest="route", default=DEFAULT_ROUTE_FILE, help="Route file."
+    )
+    parser.add_argument(
+        "-o", "--out", action="store", dest="out", default="rail.csv", help="Output file."
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        action="store",
+        dest="format",
+        default="csv",
+        choices=OUTPUT_FORMATS,
+        help="Output format. Parquet needs pyarrow.",
+    )
+    parser.add_argument(
+        "-l", "--location", action="store", dest="location", default="rail", help="Location name written to each row."
+    )
+    args = parser.parse_args()
+
+    grib_filepaths = find_grib_files(args.inputs)
+    if not grib_filepaths:
+        print("ERROR: No GRIB files found.")
+        exit(1)
+    route = RouteRegistry().load(args.route)
+    rows = grib_route_rows(grib_filepaths, route, args.location)
+    if args.format == "parquet":
+        write_rows_parquet(args.out, rows)
+    else:
+        write_rows_csv(args.out, rows)
+    print("Written " + args.out)
+
+
+if __name__ == "__main__":
+    main()
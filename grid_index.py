@@ -0,0 +1,212 @@
+# Nearest-grid-cell lookup for rail assets given as lat/lon.
+#
+# A KD-tree over the model grid cell centres is built once per grid
+# definition and cached, in memory and pickled in GRID_INDEX_FOLDER beside
+# the distance rasters, so later runs on the same grid skip the build.
+# Thousands of asset coordinates (bridges, cuttings, points, signals) then
+# map to grid indices in one vectorised query, and the indices feed straight
+# into iter_corridor_chunks as a point set.
+#
+# The distance-to-track raster holds, for every cell of a grid, its distance
+# to a route and the chainage of the nearest point on the route. It is
+# computed once per grid and route and saved in GRID_INDEX_FOLDER, so a
+# corridor of any width, or a distance-weighted statistic, is an array mask
+# rather than a new shapecutter cut.
+
+import csv
+import hashlib
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from along_track import grid_route_key
+from rail_extraction import TIME_CHUNK, MEMBER_CHUNK, convert_chunk, iter_corridor_chunks, t_str
+from rail_route import EARTH_RADIUS_KM, resample_route
+
+# Asset CSVs need at least these columns; any others are ignored.
+ASSET_TITLES = ["Name", "Lat", "Long"]
+
+GRID_INDEX_FOLDER = ".grid_index"
+# Route sample spacing for the nearest-point search; the distance itself is
+# measured to the route segments either side of the nearest sample.
+TRACK_SPACING_KM = 1.0
+
+_tree_cache = {}
+_distance_cache = {}
+
+
+def _unit_vectors(lats, lons):
+    # Points on the unit sphere, so distances don't break at the poles or the
+    # longitude seam.
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.stack(
+        [np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=-1
+    )
+
+
+def grid_key(grid_lats, grid_lons):
+    digest = hashlib.sha1()
+    for array in (grid_lats, grid_lons):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def get_grid_tree(grid_lats, grid_lons, folder=GRID_INDEX_FOLDER):
+    # KD-tree over the cell centres, cached in memory and pickled per grid.
+    key = grid_key(grid_lats, grid_lons)
+    if key not in _tree_cache:
+        cache_path = os.path.join(folder, "tree-" + key + ".pickle")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as tree_file:
+                _tree_cache[key] = pickle.load(tree_file)
+        else:
+            lat_mesh, lon_mesh = np.meshgrid(grid_lats, grid_lons, indexing="ij")
+            tree = cKDTree(_unit_vectors(lat_mesh.ravel(), lon_mesh.ravel()))
+            os.makedirs(folder, exist_ok=True)
+            with open(cache_path, "wb") as tree_file:
+                pickle.dump(tree, tree_file, protocol=pickle.HIGHEST_PROTOCOL)
+            _tree_cache[key] = tree
+    return _tree_cache[key]
+
+
+def nearest_cells(grid_lats, grid_lons, asset_lats, asset_lons, k=1, folder=GRID_INDEX_FOLDER):
+    # Returns (lat_inds, lon_inds, weights), each shaped (n_assets, k).
+    # Weights are inverse-distance and sum to 1 per asset; an asset sitting
+    # exactly on a cell centre takes all its weight from that cell.
+    tree = get_grid_tree(grid_lats, grid_lons, folder)
+    dist, flat_inds = tree.query(_unit_vectors(np.asarray(asset_lats), np.asarray(asset_lons)), k=k)
+    dist = dist.reshape(len(asset_lats), k)
+    flat_inds = flat_inds.reshape(len(asset_lats), k)
+
+    exact = dist == 0
+    with np.errstate(divide="ignore"):
+        inv = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), 1 / dist)
+    weights = inv / inv.sum(axis=1, keepdims=True)
+
+    lat_inds, lon_inds = np.unravel_index(flat_inds, (len(grid_lats), len(grid_lons)))
+    return lat_inds, lon_inds, weights
+
+
+def _local_km(cell_lats, cell_lons, lats, lons):
+    # (x, y) in km of points relative to each cell, on the plane tangent at
+    # the cell. Accurate at corridor distances, approximate far from the route.
+    dlon = (lons - cell_lons + 180) % 360 - 180
+    x = EARTH_RADIUS_KM * np.radians(dlon) * np.cos(np.radians(cell_lats))
+    y = EARTH_RADIUS_KM * np.radians(lats - cell_lats)
+    return x, y
+
+
+def distance_to_track(grid_lats, grid_lons, rail_lat_lons, spacing_km=TRACK_SPACING_KM):
+    # Returns (distance_km, chainage_km), each [lat, lon]: every cell centre's
+    # distance to the route and the chainage of its nearest point on it.
+    chainage, lats, lons = resample_route(rail_lat_lons, spacing_km)
+    lat_mesh, lon_mesh = np.meshgrid(grid_lats, grid_lons, indexing="ij")
+    cell_lats, cell_lons = lat_mesh.ravel(), lon_mesh.ravel()
+    _, nearest = cKDTree(_unit_vectors(lats, lons)).query(_unit_vectors(cell_lats, cell_lons))
+
+    distance = np.full(len(cell_lats), np.inf)
+    nearest_chainage = np.zeros(len(cell_lats))
+    for first in (nearest - 1, nearest):
+        a = np.clip(first, 0, len(lats) - 2)
+        b = a + 1
+        ax, ay = _local_km(cell_lats, cell_lons, lats[a], lons[a])
+        bx, by = _local_km(cell_lats, cell_lons, lats[b], lons[b])
+        dx, dy = bx - ax, by - ay
+        seg2 = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(seg2 > 0, seg2, 1), 0, 1)
+        seg_distance = np.hypot(ax + t * dx, ay + t * dy)
+        closer = seg_distance < distance
+        distance = np.where(closer, seg_distance, distance)
+        nearest_chainage = np.where(
+            closer, chainage[a] + t * (chainage[b] - chainage[a]), nearest_chainage
+        )
+    shape = (len(grid_lats), len(grid_lons))
+    return (
+        distance.reshape(shape).astype(np.float32),
+        nearest_chainage.reshape(shape).astype(np.float32),
+    )
+
+
+def get_distance_raster(
+    grid_lats, grid_lons, rail_lat_lons, spacing_km=TRACK_SPACING_KM, folder=GRID_INDEX_FOLDER
+):
+    # distance_to_track, cached in memory and as a .npz per grid and route.
+    key = grid_route_key(grid_lats, grid_lons, rail_lat_lons, spacing_km)
+    if key not in _distance_cache:
+        cache_path = os.path.join(folder, "distance-" + key + ".npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                _distance_cache[key] = (cached["distance_km"], cached["chainage_km"])
+        else:
+            distance_km, chainage_km = distance_to_track(grid_lats, grid_lons, rail_lat_lons, spacing_km)
+            os.makedirs(folder, exist_ok=True)
+            np.savez(cache_path, distance_km=distance_km, chainage_km=chainage_km)
+            _distance_cache[key] = (distance_km, chainage_km)
+    return _distance_cache[key]
+
+
+def corridor_within(distance_km, chainage_km, max_km):
+    # (lat_inds, lon_inds) of the cells within max_km of the route, ordered
+    # by chainage; usable wherever a `corridor` is accepted.
+    lat_inds, lon_inds = np.nonzero(distance_km <= max_km)
+    order = np.argsort(chainage_km[lat_inds, lon_inds], kind="stable")
+    return lat_inds[order], lon_inds[order]
+
+
+def cube_corridor_within(cube, rail_lat_lons, max_km, folder=GRID_INDEX_FOLDER):
+    distance_km, chainage_km = get_distance_raster(
+        cube.coord("latitude").points, cube.coord("longitude").points, rail_lat_lons, folder=folder
+    )
+    return corridor_within(distance_km, chainage_km, max_km)
+
+
+def distance_weights(distances_km, scale_km):
+    # Gaussian weights over a set of cells, falling off with distance from
+    # the route and summing to 1.
+    weights = np.exp(-0.5 * (np.asarray(distances_km, dtype=float) / scale_km) ** 2)
+    return weights / weights.sum()
+
+
+def load_assets(filepath):
+    # Returns (names, lats, lons) from a CSV with Name, Lat and Long columns.
+    names, lats, lons = [], [], []
+    with open(filepath) as csvfile:
+        for row in csv.DictReader(csvfile):
+            names.append(row["Name"])
+            lats.append(float(row["Lat"]))
+            lons.append(float(row["Long"]))
+    return names, np.array(lats), np.array(lons)
+
+
+def stream_asset_rows(
+    cube, names, asset_lats, asset_lons, k=1, time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK
+):
+    # Rows in the notebook CSV schema with the asset name as Location Name and
+    # its own coordinates, the value being the weighted mean of its k cells.
+    # Masked cells drop out and the remaining weights are rescaled to sum to
+    # 1; an asset with all k cells masked gets no row.
+    lat_inds, lon_inds, weights = nearest_cells(
+        cube.coord("latitude").points, cube.coord("longitude").points, asset_lats, asset_lons, k
+    )
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    for times, members, values in iter_corridor_chunks(
+        cube, lat_inds.ravel(), lon_inds.ravel(), time_chunk, member_chunk
+    ):
+        values = convert_chunk(param_name, cube.units, values)
+        values = values.reshape(values.shape[:2] + weights.shape)
+        cell_weights = np.where(np.ma.getmaskarray(values), 0.0, weights)
+        total = cell_weights.sum(axis=-1)
+        asset_values = np.ma.masked_array(
+            (np.ma.filled(values, 0.0) * cell_weights).sum(axis=-1) / np.where(total > 0, total, 1.0),
+            mask=total == 0,
+        )
+        for ti, t_point in enumerate(times):
+            date = t_str.format(dt=t_unit.num2date(t_point))
+            for mi, ens_mbr in enumerate(members):
+                for name, lat, lon, val in zip(names, asset_lats, asset_lons, asset_values[ti, mi]):
+                    if val is np.ma.masked:
+                        continue
+                    yield [name, lat, lon, date, ens_mbr, param_name, val]
@@ -0,0 +1,222 @@
+# Incremental processing of a forecast run as its lead times arrive.
+#
+# Instead of waiting for a whole order to download and convert, the order
+# details are polled and only files not yet processed for the run are
+# downloaded, earliest lead time first. Each new GRIB file is decoded and its
+# corridor cells appended to the run's CSV straight away, and the set of
+# processed files (with their lead time and member) is saved after each one,
+# so the first lead times are published long before the run is complete and
+# a restart carries on where it left off. A file is recorded as in progress,
+# with the CSV's length, before its rows are appended; an append cut short
+# by a crash is truncated away and redone on the next poll. A file that
+# fails to download or decode is left unprocessed for the next poll.
+
+import csv
+import json
+import os
+import re
+import time
+from datetime import datetime
+
+import cf_units
+import numpy as np
+import xarray as xr
+
+import fetch_from_weatherdatahub as wdh
+from rail_extraction import corridor_indices, t_str, titles
+from rail_parameters import convert_values
+
+STATE_FOLDER = "incremental"
+POLL_PERIOD = 120
+MAX_IDLE_POLLS = 15
+# Member as it appears in Weather DataHub file ids; the lead time is parsed
+# by wdh.file_lead_time.
+MEMBER_PATTERN = re.compile(r"member_?(\d+)|_(\d{2})$")
+
+
+def parse_file_id(file_id):
+    # Returns (lead time hours or None, member or None).
+    lead = wdh.file_lead_time(file_id)
+    member = MEMBER_PATTERN.search(file_id)
+    if member:
+        member = int(member.group(1) or member.group(2))
+    return lead, member
+
+
+def state_filepath(order_name, run_stamp, state_folder=STATE_FOLDER):
+    return os.path.join(state_folder, order_name + "_" + run_stamp.replace(":", "-") + ".json")
+
+
+def load_state(filepath):
+    if not os.path.exists(filepath):
+        return {"processed": {}, "corridor": None}
+    with open(filepath) as state_file:
+        return json.load(state_file)
+
+
+def save_state(filepath, state):
+    tmp_file = filepath + ".tmp"
+    with open(tmp_file, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_file, filepath)
+
+
+def _param_name(data_array):
+    name = data_array.attrs.get("standard_name", "unknown")
+    if name == "unknown":
+        name = data_array.attrs.get("GRIB_cfName", data_array.name)
+    return name
+
+
+def _iter_fields(data_array):
+    other_dims = [d for d in data_array.dims if d not in ("latitude", "longitude")]
+    if not other_dims:
+        yield data_array
+        return
+    for idx in np.ndindex(*[data_array.sizes[d] for d in other_dims]):
+        yield data_array.isel(dict(zip(other_dims, idx)))
+
+
+def grib_corridor_rows(grib_filepath, rail_line, corridor=None, location_name="rail"):
+    # Returns (rows, corridor) for every field in one GRIB file.
+    rows = []
+    with xr.open_dataset(grib_filepath, engine="cfgrib") as ds:
+        for data_array in ds.data_vars.values():
+            if corridor is None:
+                first_field = next(_iter_fields(data_array))
+                corridor = corridor_indices(first_field.to_iris(), rail_line)
+            lat_inds, lon_inds = corridor
+            lat_coords = data_array["latitude"].values[lat_inds]
+            lon_coords = data_array["longitude"].values[lon_inds]
+            param_name = _param_name(data_array)
+            units = cf_units.Unit(data_array.attrs.get("units", "unknown"))
+            for field in _iter_fields(data_array):
+                valid_time = field["valid_time"].values.astype("datetime64[s]").item()
+                ens_mbr = int(field["number"].values) if "number" in field.coords else "Summary"
+                values = convert_values(
+                    param_name, units, field.transpose("latitude", "longitude").values[lat_inds, lon_inds]
+                )
+                date = t_str.format(dt=valid_time)
+                for lac, loc, val in zip(lat_coords, lon_coords, values):
+                    if np.isnan(val):
+                        continue
+                    rows.append([location_name, lac, loc, date, ens_mbr, param_name, val])
+    return rows, corridor
+
+
+def append_rows(out_filepath, rows):
+    new_file = not os.path.exists(out_filepath) or os.path.getsize(out_filepath) == 0
+    with open(out_filepath, "a") as csvfile:
+        csvw = csv.writer(csvfile)
+        if new_file:
+            csvw.writerow(titles)
+        csvw.writerows(rows)
+
+
+def roll_back_unfinished(state, out_filepath):
+    # Truncates the CSV to before any append that never finished and forgets
+    # those files, so they are processed again. Returns their ids.
+    unfinished = [f for f, entry in state["processed"].items() if "offset" in entry]
+    if unfinished and os.path.exists(out_filepath):
+        offset = min(state["processed"][f]["offset"] for f in unfinished)
+        with open(out_filepath, "r+") as csvfile:
+            csvfile.truncate(offset)
+    for file_id in unfinished:
+        del state["processed"][file_id]
+    return unfinished
+
+
+def process_new_steps(
+    base_url,
+    request_headers,
+    order_name,
+    run,
+    run_stamp,
+    rail_line,
+    folder,
+    out_filepath,
+    state_folder=STATE_FOLDER,
+    publish=None,
+    verbose=False,
+):
+    # One poll: download, extract and append every file of `run` not yet
+    # processed, earliest lead time first. `publish(out_filepath, file_ids)`
+    # is called after each file is appended. Returns the file ids processed;
+    # files that failed are retried on the next poll.
+    os.makedirs(folder, exist_ok=True)
+    os.makedirs(state_folder, exist_ok=True)
+    state_file = state_filepath(order_name, run_stamp, state_folder)
+    state = load_state(state_file)
+    if roll_back_unfinished(state, out_filepath):
+        save_state(state_file, state)
+    corridor = state["corridor"]
+    if corridor is not None:
+        corridor = (np.array(corridor[0]), np.array(corridor[1]))
+
+    order = wdh.get_order_details(base_url, request_headers, order_name, True, [run])
+    file_ids = wdh.get_files_by_run(order, [run], 0)[run]
+    new_ids = [f for f in file_ids if f not in state["processed"]]
+    new_ids.sort(key=lambda f: (parse_file_id(f)[0] or 0, f))
+
+    processed = []
+    for file_id in new_ids:
+        start = time.time()
+        try:
+            grib_filepath = wdh.get_order_file(
+                base_url, request_headers, order_name, file_id, False, folder, start
+            )[1]
+            rows, corridor = grib_corridor_rows(grib_filepath, rail_line, corridor)
+        except (Exception, SystemExit) as ex:
+            # fetch_from_weatherdatahub exit()s on some download errors.
+            print("WARNING: " + file_id + " failed, retrying next poll: " + repr(ex))
+            continue
+
+        lead, member = parse_file_id(file_id)
+        state["processed"][file_id] = {
+            "offset": os.path.getsize(out_filepath) if os.path.exists(out_filepath) else 0
+        }
+        save_state(state_file, state)
+        append_rows(out_filepath, rows)
+        state["processed"][file_id] = {
+            "lead": lead,
+            "member": member,
+            "rows": len(rows),
+            "processed": datetime.now().isoformat(),
+        }
+        state["corridor"] = [corridor[0].tolist(), corridor[1].tolist()]
+        save_state(state_file, state)
+        processed.append(file_id)
+        if verbose:
+            print("Appended " + str(len(rows)) + " rows from " + file_id)
+        if publish is not None:
+            publish(out_filepath, [file_id])
+    return processed
+
+
+def follow_run(
+    base_url,
+    request_headers,
+    order_name,
+    run,
+    run_stamp,
+    rail_line,
+    folder,
+    out_filepath,
+    poll_period=POLL_PERIOD,
+    max_idle_polls=MAX_IDLE_POLLS,
+    **kwargs
+):
+    # Polls until no new files have been processed for max_idle_polls polls.
+    # A poll that fails outright (e.g. the order details can't be fetched)
+    # counts as idle.
+    idle_polls = 0
+    while idle_polls < max_idle_polls:
+        try:
+            new_ids = process_new_steps(
+                base_url, request_headers, order_name, run, run_stamp, rail_line, folder, out_filepath, **kwargs
+            )
+        except (Exception, SystemExit) as ex:
+            print("WARNING: Poll failed: " + repr(ex))
+            new_ids = []
+        idle_polls = 0 if new_ids else idle_polls + 1
+        time.sleep(poll_period)
@@ -0,0 +1,287 @@
+# Pipeline runner: fetch -> convert -> upload -> extract -> aggregate -> alert (and buckling) as a DAG.
+#
+# Each stage declares the files it reads and writes. A stage's key is a hash
+# of its name, parameters and the content of its inputs (read in HASH_CHUNK
+# blocks, so whole GRIB orders are never held in memory); after a successful
+# run the key and the hashes of its outputs are saved to a state file. On the
+# next run a stage whose key is unchanged and whose outputs are still intact
+# is skipped, so re-running after a partial failure only redoes the stages
+# that failed or whose inputs changed. Stages whose dependencies are done run
+# concurrently in a thread pool.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob, has_magic
+
+import profiling
+
+PIPELINE_STATE_FILE = ".pipeline_state.json"
+HASH_CHUNK = 1024 * 1024
+# Parameter files the buckling stage reads, when they are in the order.
+BUCKLING_AIR_PARAMETER = "agl_temperature"
+BUCKLING_SHORTWAVE_PARAMETER = "downward-short-wave-radiation-flux"
+
+
+def path_exists(path):
+    if has_magic(path):
+        return len(glob(path)) > 0
+    return os.path.exists(path)
+
+
+def hash_path(path):
+    # Content hash of a file, of every file under a folder or of every file
+    # matching a glob pattern (names included), streamed in HASH_CHUNK blocks.
+    digest = hashlib.sha1()
+    if has_magic(path):
+        for filepath in sorted(glob(path)):
+            digest.update(filepath.encode())
+            digest.update(hash_path(filepath).encode())
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                digest.update(os.path.relpath(filepath, path).encode())
+                digest.update(hash_path(filepath).encode())
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Stage:
+    def __init__(self, name, func, inputs=(), outputs=(), deps=(), params=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params or {}
+
+    def key(self):
+        digest = hashlib.sha1(self.name.encode())
+        digest.update(json.dumps(self.params, sort_keys=True, default=str).encode())
+        for path in self.inputs:
+            digest.update(path.encode())
+            digest.update(hash_path(path).encode() if path_exists(path) else b"missing")
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, state_file=PIPELINE_STATE_FILE):
+        self.state_file = state_file
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, func, inputs=(), outputs=(), deps=(), params=None):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Stage " + name + " depends on unknown stage " + dep)
+        self.stages[name] = Stage(name, func, inputs, outputs, deps, params)
+        return self.stages[name]
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def _up_to_date(self, stage, key, state):
+        saved = state.get(stage.name)
+        if saved is None or saved["key"] != key:
+            return False
+        for path in stage.outputs:
+            if not path_exists(path) or saved["outputs"].get(path) != hash_path(path):
+                return False
+        return True
+
+    def _run_stage(self, stage, state, verbose):
+        key = stage.key()
+        if self._up_to_date(stage, key, state):
+            if verbose:
+                print("Skipping unchanged stage: " + stage.name)
+            return "skipped"
+        if verbose:
+            print("Running stage: " + stage.name)
+        with profiling.stage("pipeline:" + stage.name):
+            stage.func(**stage.params)
+        outputs = {path: hash_path(path) for path in stage.outputs}
+        with self._lock:
+            state[stage.name] = {"key": key, "outputs": outputs}
+            self._save_state(state)
+        return "ran"
+
+    def run(self, max_workers=4, verbose=True):
+        # Returns {stage name: "ran" | "skipped" | "failed" | "blocked"}.
+        state = self._load_state()
+        status = {}
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(status.get(dep) in ("failed", "blocked") for dep in stage.deps):
+                        status[name] = "blocked"
+                        del pending[name]
+                    elif all(status.get(dep) in ("ran", "skipped") for dep in stage.deps):
+                        running[executor.submit(self._run_stage, stage, state, verbose)] = name
+                        del pending[name]
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except (Exception, SystemExit) as ex:
+                        # fetch_from_weatherdatahub calls exit() on many errors;
+                        # that fails the stage rather than the whole run.
+                        status[name] = "failed"
+                        print("ERROR: Stage " + name + " failed: " + repr(ex))
+        profile_filepath = profiling.write_profile(pipeline=self.state_file, status=status)
+        if profile_filepath and verbose:
+            print("Wrote profile " + profile_filepath)
+        return status
+
+
+def build_rail_pipeline(
+    order_number,
+    run,
+    parameters,
+    rail_line,
+    client_id="",
+    secret="",
+    connect_str=None,
+    download_folder="./test_data",
+    out_dir="extracted",
+):
+    # The fetch_from_weatherdatahub.py flow plus extraction and aggregation.
+    # Each parameter gets its own convert, upload, extract, aggregate and
+    # alert stages, so parameters proceed independently once the fetch is done.
+    # With air temperature in the order, a buckling stage writes rail
+    # temperature and buckling probability as soon as it is converted.
+    import iris
+
+    import fetch_from_weatherdatahub as wdh
+    from rail_aggregation import write_pyramid
+    from rail_alerts import write_alerts_csv
+    from rail_buckling import write_buckling_csv
+    from rail_extraction import extract_parameters
+    from rail_route import line_lat_lons
+
+    if connect_str is None:
+        connect_str = os.environ.get("AZURE_STORAGE_CONNECTION_STRING", "")
+    run_folder = os.path.join(download_folder, "downloaded", order_number + "_" + run)
+    # Conversion writes .nc files next to the GRIB files, so the fetch stage
+    # only owns the .grib2 files.
+    grib_files = os.path.join(run_folder, "*.grib2")
+
+    def fetch(order, run):
+        wdh.download_from_weatherdatahub(
+            ["-c", client_id, "-s", secret, "-o", order, "-l", download_folder, "-r", run]
+        )
+
+    def upload(filepath):
+        from azure.storage.blob import BlobServiceClient
+
+        wdh.copy_to_blob(BlobServiceClient.from_connection_string(connect_str), filepath)
+
+    def extract(nc_filepath, param_out_dir):
+        # Stages run on threads that may be inside netCDF/HDF5, so the worker
+        # process is spawned rather than forked from this one.
+        extract_parameters(
+            [nc_filepath], rail_line, param_out_dir, processes=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def aggregate(nc_filepath, pyramid_dir):
+        write_pyramid(pyramid_dir, iris.load_cube(nc_filepath), rail_line)
+
+    def alert(nc_filepath, alerts_filepath):
+        write_alerts_csv(alerts_filepath, [iris.load_cube(nc_filepath)], line_lat_lons(rail_line))
+
+    def buckling(nc_filepath, shortwave_filepath, buckling_filepath):
+        shortwave_cube = iris.load_cube(shortwave_filepath) if shortwave_filepath else None
+        os.makedirs(os.path.dirname(buckling_filepath), exist_ok=True)
+        write_buckling_csv(buckling_filepath, iris.load_cube(nc_filepath), rail_line, shortwave_cube)
+
+    pipeline = Pipeline(os.path.join(download_folder, PIPELINE_STATE_FILE))
+    pipeline.add("fetch", fetch, outputs=[grib_files], params={"order": order_number, "run": run})
+    for parameter_name in parameters:
+        nc_filepath = os.path.join(run_folder, parameter_name + ".nc")
+        param_out_dir = os.path.join(out_dir, parameter_name)
+        pyramid_dir = os.path.join(param_out_dir, "pyramid")
+        pipeline.add(
+            "convert:" + parameter_name,
+            wdh.convert_and_save_netcdf_xr,
+            # The same files convert_and_save_netcdf_xr reads.
+            inputs=[os.path.join(run_folder, "*" + parameter_name + "*.grib2")],
+            outputs=[nc_filepath],
+            deps=["fetch"],
+            params={"filepath": run_folder, "parameter_name": parameter_name},
+        )
+        pipeline.add(
+            "upload:" + parameter_name,
+            upload,
+            inputs=[nc_filepath],
+            deps=["convert:" + parameter_name],
+            params={"filepath": nc_filepath},
+        )
+        pipeline.add(
+            "extract:" + parameter_name,
+            extract,
+            inputs=[nc_filepath],
+            outputs=[os.path.join(param_out_dir, parameter_name + ".csv")],
+            deps=["convert:" + parameter_name],
+            params={"nc_filepath": nc_filepath, "param_out_dir": param_out_dir},
+        )
+        pipeline.add(
+            "aggregate:" + parameter_name,
+            aggregate,
+            inputs=[nc_filepath],
+            outputs=[pyramid_dir],
+            deps=["convert:" + parameter_name],
+            params={"nc_filepath": nc_filepath, "pyramid_dir": pyramid_dir},
+        )
+        alerts_filepath = os.path.join(param_out_dir, parameter_name + "_alerts.csv")
+        pipeline.add(
+            "alert:" + parameter_name,
+            alert,
+            inputs=[nc_filepath],
+            outputs=[alerts_filepath],
+            deps=["convert:" + parameter_name],
+            params={"nc_filepath": nc_filepath, "alerts_filepath": alerts_filepath},
+        )
+
+    if BUCKLING_AIR_PARAMETER in parameters:
+        nc_filepath = os.path.join(run_folder, BUCKLING_AIR_PARAMETER + ".nc")
+        inputs, deps = [nc_filepath], ["convert:" + BUCKLING_AIR_PARAMETER]
+        shortwave_filepath = None
+        if BUCKLING_SHORTWAVE_PARAMETER in parameters:
+            shortwave_filepath = os.path.join(run_folder, BUCKLING_SHORTWAVE_PARAMETER + ".nc")
+            inputs.append(shortwave_filepath)
+            deps.append("convert:" + BUCKLING_SHORTWAVE_PARAMETER)
+        buckling_filepath = os.path.join(out_dir, BUCKLING_AIR_PARAMETER, BUCKLING_AIR_PARAMETER + "_buckling.csv")
+        pipeline.add(
+            "buckling",
+            buckling,
+            inputs=inputs,
+            outputs=[buckling_filepath],
+            deps=deps,
+            params={
+                "nc_filepath": nc_filepath,
+                "shortwave_filepath": shortwave_filepath,
+                "buckling_filepath": buckling_filepath,
+            },
+        )
+    return pipeline
@@ -0,0 +1,201 @@
+# Opt-in timing and memory instrumentation for the pipeline stages.
+#
+# Wrap a stage or hot loop in `with profiling.stage("name"):`. When enabled
+# (RAIL_PROFILE=1 or profiling.enable()) each stage records wall time, CPU
+# time, call count and tracemalloc peak memory, keyed by its nesting path
+# such as "convert/xr.concat". Outermost stages can also dump cProfile stats
+# (RAIL_PROFILE_CPROFILE=<folder>) for snakeviz/flameprof flamegraphs.
+# write_profile() emits one JSON profile per run. Disabled, a stage is a
+# flag check.
+#
+# tracemalloc peaks are process-wide, so stages running concurrently on
+# other threads share each other's peaks. Stages run in worker processes are
+# recorded there; map_profiled hands their records back to the parent.
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+PROFILE_FOLDER = "profiles"
+
+_enabled = os.environ.get("RAIL_PROFILE", "") not in ("", "0")
+_cprofile_folder = os.environ.get("RAIL_PROFILE_CPROFILE") or None
+_records = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(cprofile_folder=None):
+    global _enabled, _cprofile_folder
+    _enabled = True
+    _cprofile_folder = cprofile_folder
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _records.clear()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(path, wall, cpu, peak):
+    with _lock:
+        record = _records.setdefault(
+            path, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_bytes": 0}
+        )
+        record["calls"] += 1
+        record["wall_s"] += wall
+        record["cpu_s"] += cpu
+        record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+
+@contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    stack = _stack()
+    path = "/".join([frame["name"] for frame in stack] + [name])
+    # Fold the peak so far into the parent before resetting it for this stage.
+    _, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+    tracemalloc.reset_peak()
+    frame = {"name": name, "peak": 0}
+    stack.append(frame)
+
+    profiler = None
+    if _cprofile_folder and len(stack) == 1:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread.
+            profiler = None
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(_cprofile_folder, exist_ok=True)
+            profiler.dump_stats(
+                os.path.join(
+                    _cprofile_folder,
+                    "{}-{}.prof".format(name.replace("/", "_"), datetime.now().strftime("%H-%M-%S-%f")),
+                )
+            )
+        stack.pop()
+        _, peak = tracemalloc.get_traced_memory()
+        frame["peak"] = max(frame["peak"], peak)
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+        _record(path, wall, cpu, frame["peak"])
+
+
+def profiled(name=None):
+    # Decorator form of stage().
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def merge(records):
+    # Folds stage records from report() in another process into this one's.
+    with _lock:
+        for other in records:
+            record = _records.setdefault(
+                other["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_bytes": 0}
+            )
+            record["calls"] += other["calls"]
+            record["wall_s"] += other["wall_s"]
+            record["cpu_s"] += other["cpu_s"]
+            record["peak_bytes"] = max(record["peak_bytes"], other["peak_bytes"])
+
+
+def _profiled_call(task):
+    # Runs in a worker process, profiled when the parent is.
+    enabled, func, arg = task
+    if not enabled:
+        return func(arg), []
+    if not _enabled:
+        enable()
+    # A forked worker starts with a copy of the parent's records.
+    reset()
+    result = func(arg)
+    return result, report()
+
+
+def map_profiled(executor, func, args):
+    # executor.map(func, args) for a process pool, merging each worker's stage
+    # records into this process's. func must be picklable.
+    results = []
+    for result, records in executor.map(_profiled_call, [(_enabled, func, arg) for arg in args]):
+        merge(records)
+        results.append(result)
+    return results
+
+
+def report():
+    # Stage records, slowest first.
+    with _lock:
+        records = [dict(stage=path, **record) for path, record in _records.items()]
+    return sorted(records, key=lambda record: record["wall_s"], reverse=True)
+
+
+def write_profile(filepath=None, **run_info):
+    # Writes the run's profile as JSON and returns its path, or None when
+    # profiling is off. run_info (order, run, ...) is stored alongside.
+    if not _enabled:
+        return None
+    if filepath is None:
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        filepath = os.path.join(
+            PROFILE_FOLDER, "profile-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+        )
+    profile = {
+        "created": datetime.now().isoformat(),
+        "run": run_info,
+        "stages": report(),
+    }
+    with open(filepath, "w") as profile_file:
+        json.dump(profile, profile_file, indent=2, default=str)
+    return filepath
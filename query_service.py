@@ -0,0 +1,313 @@
+# Small HTTP query service over extracted rail forecasts.
+#
+# Loads the extraction CSVs (the notebook schema) matching a set of glob
+# patterns in a folder into typed NumPy columns, sorted and indexed on
+# (route, parameter, member, source, time), and answers range and point
+# queries as JSON. The source is the file's path under the folder without
+# .csv, so the same parameter from different files (a member CSV and a
+# pyramid level, say) stays apart: every row returned names its source, and
+# `source=` picks one. The folder is polled and the data reloaded in the
+# background when a new run lands, so the dashboard never has to pull whole
+# CSVs.
+#
+#   python query_service.py -d output_data -p 8080 -g "*/*.csv"
+#   GET /meta
+#   GET /range?route=rail&parameter=air_temperature&member=0&source=ensemble_data&start=2022-07-18&end=2022-07-19
+#   GET /point?route=rail&parameter=air_temperature&lat=51.65&lon=-0.14&time=2022-07-18
+
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from rail_csv import titles
+
+RELOAD_PERIOD = 30
+DEFAULT_PATTERNS = ["**/*.csv"]
+
+
+def parse_datetime(text):
+    # Extraction CSVs use either d/mm/yyyy or ISO datetimes.
+    if "/" in text:
+        day, month, year = text.split("/")
+        return np.datetime64("{}-{:0>2}-{:0>2}".format(year, month, day), "s")
+    return np.datetime64(text, "s")
+
+
+def source_name(filepath, folder=None):
+    if folder is not None:
+        filepath = os.path.relpath(filepath, folder)
+    return os.path.splitext(filepath)[0].replace(os.sep, "/")
+
+
+class ForecastStore:
+    # Column arrays for all rows, sorted by (route, parameter, member, source,
+    # time). Sources are named relative to `folder` when given.
+
+    def __init__(self, filepaths, folder=None):
+        routes, params, members, sources, times, lats, lons, values = [], [], [], [], [], [], [], []
+        for filepath in filepaths:
+            source = source_name(filepath, folder)
+            with open(filepath) as csvfile:
+                reader = csv.reader(csvfile)
+                header = next(reader, None)
+                if header != titles:
+                    continue
+                for route, lat, lon, dt, member, param, value in reader:
+                    sources.append(source)
+                    routes.append(route)
+                    lats.append(lat)
+                    lons.append(lon)
+                    times.append(dt)
+                    members.append(member)
+                    params.append(param)
+                    values.append(value)
+
+        self.routes, route_codes = np.unique(np.array(routes, dtype=str), return_inverse=True)
+        self.parameters, param_codes = np.unique(np.array(params, dtype=str), return_inverse=True)
+        self.members, member_codes = np.unique(np.array(members, dtype=str), return_inverse=True)
+        self.sources, source_codes = np.unique(np.array(sources, dtype=str), return_inverse=True)
+        unique_times, time_inverse = np.unique(np.array(times, dtype=str), return_inverse=True)
+        time_points = np.array([parse_datetime(t) for t in unique_times], dtype="datetime64[s]")
+
+        order = np.lexsort((time_points[time_inverse], source_codes, member_codes, param_codes, route_codes))
+        self.route_codes = route_codes[order].astype(np.int32)
+        self.param_codes = param_codes[order].astype(np.int32)
+        self.member_codes = member_codes[order].astype(np.int32)
+        self.source_codes = source_codes[order].astype(np.int32)
+        self.times = time_points[time_inverse][order]
+        self.lats = np.array(lats, dtype=np.float64)[order]
+        self.lons = np.array(lons, dtype=np.float64)[order]
+        self.values = np.array(values, dtype=np.float64)[order]
+
+        # (route, parameter, member, source) -> contiguous row slice, sorted
+        # by time.
+        self.index = {}
+        keys = np.stack([self.route_codes, self.param_codes, self.member_codes, self.source_codes], axis=1)
+        if len(keys):
+            starts = np.concatenate([[0], np.nonzero(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1])
+            stops = np.append(starts[1:], len(keys))
+            for start, stop in zip(starts, stops):
+                key = (
+                    self.routes[keys[start, 0]],
+                    self.parameters[keys[start, 1]],
+                    self.members[keys[start, 2]],
+                    self.sources[keys[start, 3]],
+                )
+                self.index[key] = (start, stop)
+
+    def __len__(self):
+        return len(self.values)
+
+    def meta(self):
+        return {
+            "rows": len(self),
+            "routes": self.routes.tolist(),
+            "parameters": self.parameters.tolist(),
+            "members": self.members.tolist(),
+            "sources": self.sources.tolist(),
+            "start": str(self.times.min()) if len(self) else None,
+            "end": str(self.times.max()) if len(self) else None,
+        }
+
+    def _slices(self, route, parameter, member=None, source=None):
+        # [((member, source), (start, stop))] for the matching index entries.
+        return [
+            (key[2:], rows)
+            for key, rows in self.index.items()
+            if key[:2] == (route, parameter)
+            and (member is None or key[2] == member)
+            and (source is None or key[3] == source)
+        ]
+
+    def _rows(self, member_source, start, stop):
+        member, source = member_source
+        return [
+            {"member": member, "source": source, "time": str(t), "lat": la, "lon": lo, "value": v}
+            for t, la, lo, v in zip(
+                self.times[start:stop],
+                self.lats[start:stop].tolist(),
+                self.lons[start:stop].tolist(),
+                self.values[start:stop].tolist(),
+            )
+        ]
+
+    def range_query(self, route, parameter, member=None, start=None, end=None, source=None):
+        # Rows with start <= time <= end (both optional).
+        rows = []
+        for mbr, (first, last) in self._slices(route, parameter, member, source):
+            times = self.times[first:last]
+            lo = first if start is None else first + np.searchsorted(times, parse_datetime(start), "left")
+            hi = last if end is None else first + np.searchsorted(times, parse_datetime(end), "right")
+            rows.extend(self._rows(mbr, lo, hi))
+        return rows
+
+    def point_query(self, route, parameter, lat, lon, valid_time=None, member=None, source=None):
+        # Values at the stored point nearest to (lat, lon), per member and source.
+        rows = []
+        for mbr, (first, last) in self._slices(route, parameter, member, source):
+            if valid_time is not None:
+                times = self.times[first:last]
+                t = parse_datetime(valid_time)
+                lo = first + np.searchsorted(times, t, "left")
+                hi = first + np.searchsorted(times, t, "right")
+                first, last = lo, hi
+            if first == last:
+                continue
+            dist = (self.lats[first:last] - lat) ** 2 + (self.lons[first:last] - lon) ** 2
+            nearest = dist == dist.min()
+            for i in first + np.nonzero(nearest)[0]:
+                rows.extend(self._rows(mbr, i, i + 1))
+        return rows
+
+
+class StoreReloader:
+    # Keeps the current ForecastStore and swaps in a new one when the CSVs in
+    # the folder change. Readers just take `reloader.store`.
+
+    def __init__(self, folder, period=RELOAD_PERIOD, patterns=DEFAULT_PATTERNS):
+        self.folder = folder
+        self.period = period
+        self.patterns = patterns
+        self.signature = None
+        self.store = None
+        self.reload()
+
+    def _signature(self):
+        filepaths = sorted(
+            {f for pattern in self.patterns for f in glob(os.path.join(self.folder, pattern), recursive=True)}
+        )
+        return filepaths, tuple((f, os.path.getmtime(f), os.path.getsize(f)) for f in filepaths)
+
+    def reload(self):
+        filepaths, signature = self._signature()
+        if signature == self.signature:
+            return False
+        self.store = ForecastStore(filepaths, self.folder)
+        self.signature = signature
+        return True
+
+    def watch(self):
+        while True:
+            time.sleep(self.period)
+            try:
+                if self.reload():
+                    print("Reloaded {} rows".format(len(self.store)))
+            except (OSError, ValueError) as ex:
+                print("WARNING: reload failed:", ex)
+
+    def start(self):
+        thread = threading.Thread(target=self.watch, daemon=True)
+        thread.start()
+        return thread
+
+
+def make_handler(reloader):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            store = reloader.store
+            try:
+                if url.path == "/meta":
+                    self._send(200, store.meta())
+                elif url.path == "/range":
+                    self._send(
+                        200,
+                        store.range_query(
+                            query["route"],
+                            query["parameter"],
+                            query.get("member"),
+                            query.get("start"),
+                            query.get("end"),
+                            query.get("source"),
+                        ),
+                    )
+                elif url.path == "/point":
+                    self._send(
+                        200,
+                        store.point_query(
+                            query["route"],
+                            query["parameter"],
+                            float(query["lat"]),
+                            float(query["lon"]),
+                            query.get("time"),
+                            query.get("member"),
+                            query.get("source"),
+                        ),
+                    )
+                else:
+                    self._send(404, {"error": "Unknown path " + url.path})
+            except KeyError as ex:
+                self._send(400, {"error": "Missing parameter " + str(ex)})
+            except ValueError as ex:
+                self._send(400, {"error": str(ex)})
+
+    return QueryHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve range and point queries over extracted rail forecasts."
+    )
+    parser.add_argument(
+        "-d",
+        "--data",
+        action="store",
+        dest="folder",
+        default="output_data",
+        help="Folder holding the extraction CSVs. Defaults to output_data.",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        action="store",
+        dest="port",
+        default=8080,
+        type=int,
+        help="Port to listen on. Defaults to 8080.",
+    )
+    parser.add_argument(
+        "-r",
+        "--reload",
+        action="store",
+        dest="period",
+        default=RELOAD_PERIOD,
+        type=int,
+        help="Seconds between checks for new extraction outputs.",
+    )
+    parser.add_argument(
+        "-g",
+        "--glob",
+        action="append",
+        dest="patterns",
+        default=None,
+        help="Glob pattern under the folder for the CSVs to load; may be repeated. Defaults to every CSV.",
+    )
+    args = parser.parse_args()
+
+    reloader = StoreReloader(args.folder, args.period, args.patterns or DEFAULT_PATTERNS)
+    reloader.start()
+    print("Loaded {} rows from {}".format(len(reloader.store), args.folder))
+    server = ThreadingHTTPServer(("", args.port), make_handler(reloader))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+# Windowed aggregation of corridor data in a single streaming pass over time.
+#
+# rail_extract_and_aggregate.ipynb aggregates the whole grid with
+# `cube.aggregated_by("6hr", iris.analysis.MAX)` before cutting. Here the
+# corridor is cut first and the (time, member, cell) chunks are folded into
+# running max/min/sum/count accumulators for every window length at once.
+# Only the current window of each length is ever held in memory, and only
+# when percentiles are asked for. Windows are labelled with their floor (the
+# start of the window on the hours-since-epoch grid, not the first time step
+# in it) and datetimes keep the time of day; max and min, like the mean, skip
+# masked steps.
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from rail_extraction import (
+    MEMBER_CHUNK,
+    TIME_CHUNK,
+    chunk_rows,
+    convert_chunk,
+    corridor_coords,
+    corridor_indices,
+    iso_t_str,
+    iter_corridor_chunks,
+    titles,
+)
+
+WINDOWS = (6,)
+STATISTICS = ("max", "min", "mean")
+PERCENTILES = ()
+
+
+def hours_since_epoch(t_unit, points):
+    return t_unit.convert(np.asarray(points, dtype=float), "hours since 1970-01-01 00:00:00")
+
+
+def points_per_hour(t_unit):
+    # How far time points in `t_unit` move per hour.
+    hours = hours_since_epoch(t_unit, [0.0, 1.0])
+    return 1.0 / (hours[1] - hours[0])
+
+
+def _masked_extreme(func, current, values):
+    # np.maximum/np.minimum of two masked arrays where a value masked in one
+    # takes the other's, so a masked step doesn't blank the window.
+    current_mask = np.ma.getmaskarray(current)
+    values_mask = np.ma.getmaskarray(values)
+    current_data = np.ma.getdata(current)
+    values_data = np.ma.getdata(values)
+    combined = np.where(
+        current_mask,
+        values_data,
+        np.where(values_mask, current_data, func(current_data, values_data)),
+    )
+    return np.ma.masked_array(combined, mask=current_mask & values_mask)
+
+
+class WindowAccumulator:
+    # Running statistics for one window length and one set of members.
+    # `t_points_per_hour` (see points_per_hour) puts the window floor back
+    # into the time points' units.
+
+    def __init__(self, hours, statistics=STATISTICS, percentiles=PERCENTILES, t_points_per_hour=1.0):
+        self.hours = hours
+        self.statistics = statistics
+        self.percentiles = percentiles
+        self.t_points_per_hour = t_points_per_hour
+        self.key = None
+
+    def _reset(self, key, hour, t_point, values):
+        self.key = key
+        self.start = t_point - (hour - key * self.hours) * self.t_points_per_hour
+        self.max = values.copy()
+        self.min = values.copy()
+        self.sum = np.ma.filled(values, 0.0).astype(float)
+        self.count = (~np.ma.getmaskarray(values)).astype(int)
+        self.buffer = [values] if self.percentiles else None
+
+    def add(self, hour, t_point, values):
+        # Adds one time step of values[member, cell]; returns the finished
+        # window's stats when this step starts a new window, else None.
+        key = int(hour // self.hours)
+        if key == self.key:
+            self.max = _masked_extreme(np.maximum, self.max, values)
+            self.min = _masked_extreme(np.minimum, self.min, values)
+            self.sum += np.ma.filled(values, 0.0)
+            self.count += ~np.ma.getmaskarray(values)
+            if self.buffer is not None:
+                self.buffer.append(values)
+            return None
+        finished = self.finish()
+        self._reset(key, hour, t_point, values)
+        return finished
+
+    def finish(self):
+        # Returns (window floor time point, {stat name: values[member, cell]}).
+        if self.key is None:
+            return None
+        stats = {}
+        if "max" in self.statistics:
+            stats["max"] = self.max
+        if "min" in self.statistics:
+            stats["min"] = self.min
+        if "mean" in self.statistics:
+            stats["mean"] = np.ma.masked_array(
+                self.sum / np.maximum(self.count, 1), mask=self.count == 0
+            )
+        if self.buffer is not None:
+            stack = np.ma.filled(np.ma.stack(self.buffer).astype(float), np.nan)
+            levels = np.nanpercentile(stack, self.percentiles, axis=0)
+            for percentile, level in zip(self.percentiles, levels):
+                stats["p{:g}".format(percentile)] = np.ma.masked_invalid(level)
+        self.key = None
+        return self.start, stats
+
+
+def stream_window_stats(chunks, t_unit, windows=WINDOWS, statistics=STATISTICS, percentiles=PERCENTILES):
+    # chunks are (time points, member points, values[time, member, cell]) as
+    # from iter_corridor_chunks, in time order for each member chunk.
+    # Yields (window hours, window floor point, members, stat name, values[member, cell]).
+    accumulators = {}
+    t_points_per_hour = points_per_hour(t_unit)
+    member_points = {}
+    for times, members, values in chunks:
+        member_key = tuple(members)
+        member_points[member_key] = members
+        if member_key not in accumulators:
+            accumulators[member_key] = [
+                WindowAccumulator(hours, statistics, percentiles, t_points_per_hour) for hours in windows
+            ]
+        hours = hours_since_epoch(t_unit, times)
+        for ti, t_point in enumerate(times):
+            for acc in accumulators[member_key]:
+                finished = acc.add(hours[ti], t_point, values[ti])
+                if finished is not None:
+                    start, stats = finished
+                    for stat_name, stat_values in stats.items():
+                        yield acc.hours, start, members, stat_name, stat_values
+
+    for member_key, member_accs in accumulators.items():
+        for acc in member_accs:
+            finished = acc.finish()
+            if finished is not None:
+                start, stats = finished
+                for stat_name, stat_values in stats.items():
+                    yield acc.hours, start, member_points[member_key], stat_name, stat_values
+
+
+def aggregated_param_name(param_name, hours, stat_name):
+    return "{}_{}hr_{}".format(param_name, hours, stat_name)
+
+
+def stream_aggregated_rows(
+    cube,
+    rail_line,
+    location_name="rail",
+    windows=WINDOWS,
+    statistics=STATISTICS,
+    percentiles=PERCENTILES,
+    time_chunk=TIME_CHUNK,
+    member_chunk=MEMBER_CHUNK,
+    corridor=None,
+):
+    if corridor is None:
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    chunks = (
+        (times, members, convert_chunk(param_name, cube.units, values))
+        for times, members, values in iter_corridor_chunks(
+            cube, lat_inds, lon_inds, time_chunk, member_chunk
+        )
+    )
+    for hours, start, members, stat_name, values in stream_window_stats(
+        chunks, t_unit, windows, statistics, percentiles
+    ):
+        yield from chunk_rows(
+            location_name,
+            aggregated_param_name(param_name, hours, stat_name),
+            t_unit,
+            lat_coords,
+            lon_coords,
+            [start],
+            members,
+            values[np.newaxis],
+            iso_t_str,
+        )
+
+
+def aggregate_to_csv(filepath, cubes, rail_line, location_name="rail", windows=WINDOWS, statistics=STATISTICS, percentiles=PERCENTILES):
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(titles)
+        for cube in cubes:
+            for row in stream_aggregated_rows(
+                cube, rail_line, location_name, windows, statistics, percentiles
+            ):
+                csvw.writerow(row)
+
+
+# Temporal pyramid: each level is built from the finished windows of the
+# level below, so only max/min/sum/count are carried up (no percentiles).
+PYRAMID_LEVELS = (3, 6, 12, 24)
+
+
+class PyramidLevel:
+    # Running max/min/sum/count for one pyramid level and one set of members,
+    # labelled with the window floor like WindowAccumulator.
+
+    def __init__(self, hours, t_points_per_hour=1.0):
+        self.hours = hours
+        self.t_points_per_hour = t_points_per_hour
+        self.key = None
+
+    def add(self, hour, t_point, max_values, min_values, sum_values, count):
+        key = int(hour // self.hours)
+        if key == self.key:
+            self.max = _masked_extreme(np.maximum, self.max, max_values)
+            self.min = _masked_extreme(np.minimum, self.min, min_values)
+            self.sum = self.sum + sum_values
+            self.count = self.count + count
+            return None
+        finished = self.finish()
+        self.key = key
+        self.start_hour = key * self.hours
+        self.start = t_point - (hour - self.start_hour) * self.t_points_per_hour
+        self.max, self.min, self.sum, self.count = max_values, min_values, sum_values, count
+        return finished
+
+    def finish(self):
+        # Returns (floor hour, floor point, max, min, sum, count).
+        if self.key is None:
+            return None
+        self.key = None
+        return self.start_hour, self.start, self.max, self.min, self.sum, self.count
+
+
+def _check_pyramid_levels(levels):
+    for lower, upper in zip(levels[:-1], levels[1:]):
+        if upper % lower != 0:
+            raise ValueError(
+                "Pyramid level {}hr is not a multiple of {}hr.".format(upper, lower)
+            )
+
+
+def _level_stats(max_values, min_values, sum_values, count):
+    return {
+        "max": max_values,
+        "min": min_values,
+        "mean": np.ma.masked_array(sum_values / np.maximum(count, 1), mask=count == 0),
+    }
+
+
+def stream_pyramid(chunks, t_unit, levels=PYRAMID_LEVELS):
+    # Yields (level, start point, members, stats) where level is "native" for
+    # the input steps (stats {"value": ...}) or the window length in hours
+    # (start is then the window floor).
+    _check_pyramid_levels(levels)
+    t_points_per_hour = points_per_hour(t_unit)
+    cascades = {}
+
+    def feed(cascade, members, index, finished):
+        # Pushes a finished window up from level `index`, yielding every
+        # window it completes on the way.
+        while finished is not None:
+            start_hour, start, max_values, min_values, sum_values, count = finished
+            yield levels[index], start, members, _level_stats(max_values, min_values, sum_values, count)
+            index += 1
+            if index == len(levels):
+                return
+            finished = cascade[index].add(start_hour, start, max_values, min_values, sum_values, count)
+
+    for times, members, values in chunks:
+        member_key = tuple(members)
+        if member_key not in cascades:
+            cascades[member_key] = (members, [PyramidLevel(hours, t_points_per_hour) for hours in levels])
+        cascade = cascades[member_key][1]
+        hours = hours_since_epoch(t_unit, times)
+        for ti, t_point in enumerate(times):
+            step = values[ti]
+            yield "native", t_point, members, {"value": step}
+            finished = cascade[0].add(
+                hours[ti],
+                t_point,
+                step,
+                step,
+                np.ma.filled(step, 0.0).astype(float),
+                (~np.ma.getmaskarray(step)).astype(int),
+            )
+            yield from feed(cascade, members, 0, finished)
+
+    for members, cascade in cascades.values():
+        for index, level in enumerate(cascade):
+            yield from feed(cascade, members, index, level.finish())
+
+
+def pyramid_label(level):
+    return level if level == "native" else "{}hr".format(level)
+
+
+def pyramid_filepath(out_dir, route_name, param_name, level):
+    return os.path.join(out_dir, route_name, param_name, pyramid_label(level) + ".csv")
+
+
+def write_pyramid(
+    out_dir,
+    cube,
+    rail_line,
+    route_name="rail",
+    levels=PYRAMID_LEVELS,
+    time_chunk=TIME_CHUNK,
+    member_chunk=MEMBER_CHUNK,
+    corridor=None,
+):
+    # Writes <out_dir>/<route>/<parameter>/{native,3hr,6hr,...}.csv in one
+    # pass, plus an index.json listing them, so a query at any time zoom is a
+    # file lookup. Datetimes keep the time of day.
+    if corridor is None:
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    chunks = (
+        (times, members, convert_chunk(param_name, cube.units, values))
+        for times, members, values in iter_corridor_chunks(
+            cube, lat_inds, lon_inds, time_chunk, member_chunk
+        )
+    )
+
+    filepaths = {
+        level: pyramid_filepath(out_dir, route_name, param_name, level)
+        for level in ("native",) + tuple(levels)
+    }
+    os.makedirs(os.path.dirname(filepaths["native"]), exist_ok=True)
+    files = {level: open(filepath, "w") for level, filepath in filepaths.items()}
+    try:
+        writers = {level: csv.writer(csvfile) for level, csvfile in files.items()}
+        for csvw in writers.values():
+            csvw.writerow(titles)
+        for level, start, members, stats in stream_pyramid(chunks, t_unit, levels):
+            for stat_name, values in stats.items():
+                name = param_name if level == "native" else aggregated_param_name(param_name, level, stat_name)
+                writers[level].writerows(
+                    chunk_rows(
+                        route_name, name, t_unit, lat_coords, lon_coords, [start], members, values[np.newaxis], iso_t_str
+                    )
+                )
+    finally:
+        for csvfile in files.values():
+            csvfile.close()
+
+    index = {
+        "route": route_name,
+        "parameter": param_name,
+        "levels": {pyramid_label(level): os.path.basename(filepath) for level, filepath in filepaths.items()},
+    }
+    with open(os.path.join(os.path.dirname(filepaths["native"]), "index.json"), "w") as index_file:
+        json.dump(index, index_file, indent=2)
+    return filepaths
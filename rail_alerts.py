@@ -0,0 +1,169 @@
+# Threshold alerts along the route from the along-track samples.
+#
+# Each rule marks a (time, chainage) sample as hot when at least
+# `probability` of the members are beyond the threshold. Hot samples are
+# run-length encoded along the route for every time step at once, runs that
+# overlap on consecutive time steps are joined into one alert, and each
+# alert is reported as a km range and a time range with its peak value, e.g.
+# "air_temperature > 30 between km 120 and 164 from 12:00 to 18:00". Every
+# parameter is sampled and scanned once.
+
+import csv
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from along_track import sample_cube_along_track
+from rail_extraction import iso_t_str
+from rail_parameters import convert_values
+
+AlertRule = namedtuple("AlertRule", ["param_name", "threshold", "above", "probability"])
+ALERT_RULES = [
+    AlertRule("air_temperature", 30.0, True, 0.5),
+    AlertRule("rail_buckling_probability", 0.3, True, 0.5),
+]
+
+ALERT_TITLES = [
+    "Location Name",
+    "Parameter",
+    "Condition",
+    "From km",
+    "To km",
+    "From",
+    "To",
+    "Peak Value",
+    "Peak Probability",
+]
+
+
+def exceedance_fraction(values, rule, member_axis=1):
+    # Fraction of members beyond the threshold; masked or NaN values never are.
+    filled = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    with np.errstate(invalid="ignore"):
+        beyond = filled > rule.threshold if rule.above else filled < rule.threshold
+    return beyond.mean(axis=member_axis)
+
+
+def hot_runs(hot):
+    # Runs of True along the last axis of hot[time, sample], as
+    # (time index, start, stop) arrays with stop exclusive.
+    padded = np.zeros((hot.shape[0], hot.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = hot
+    edges = np.diff(padded, axis=1)
+    run_times, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+    return run_times, starts, stops
+
+
+def join_runs(run_times, starts, stops):
+    # Labels runs so that runs overlapping along the route on consecutive time
+    # steps share a label. Returns (number of alerts, label per run).
+    n_runs = len(run_times)
+    rows, cols = [], []
+    step_bounds = np.searchsorted(run_times, np.arange(run_times.max() + 2)) if n_runs else []
+    for t in range(len(step_bounds) - 2):
+        a = np.arange(step_bounds[t], step_bounds[t + 1])
+        b = np.arange(step_bounds[t + 1], step_bounds[t + 2])
+        if not len(a) or not len(b):
+            continue
+        overlap = (starts[a][:, None] < stops[b][None, :]) & (starts[b][None, :] < stops[a][:, None])
+        ai, bi = np.nonzero(overlap)
+        rows.append(a[ai])
+        cols.append(b[bi])
+    if rows:
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+    graph = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_runs, n_runs))
+    return connected_components(graph, directed=False)
+
+
+def _run_reduce(ufunc, field, run_times, starts, stops, fill):
+    # ufunc.reduceat over each run's samples of field[time, sample].
+    flat = np.append(field.ravel(), fill)
+    offsets = run_times * field.shape[1]
+    bounds = np.stack([offsets + starts, offsets + stops], axis=1).ravel()
+    return ufunc.reduceat(flat, bounds)[::2]
+
+
+def detect_alerts(values, chainage, rule, member_axis=1):
+    # values[time, member, sample] along the route. Returns one dict per
+    # alert with time and sample index ranges (inclusive) and its peaks.
+    fraction = exceedance_fraction(values, rule, member_axis)
+    hot = fraction >= rule.probability
+    run_times, starts, stops = hot_runs(hot)
+    if not len(run_times):
+        return []
+    n_alerts, labels = join_runs(run_times, starts, stops)
+
+    valid = np.ma.masked_invalid(np.ma.asarray(values, dtype=float))
+    extreme = valid.max(axis=member_axis) if rule.above else valid.min(axis=member_axis)
+    extreme = np.ma.filled(extreme, -np.inf if rule.above else np.inf)
+    peak_ufunc = np.maximum if rule.above else np.minimum
+    run_peaks = _run_reduce(peak_ufunc, extreme, run_times, starts, stops, extreme.flat[0])
+    run_fractions = _run_reduce(np.maximum, fraction, run_times, starts, stops, 0.0)
+
+    first_time = np.full(n_alerts, run_times.max())
+    last_time = np.zeros(n_alerts, dtype=int)
+    first_sample = np.full(n_alerts, len(chainage))
+    last_sample = np.zeros(n_alerts, dtype=int)
+    peaks = np.full(n_alerts, -np.inf if rule.above else np.inf)
+    peak_fractions = np.zeros(n_alerts)
+    np.minimum.at(first_time, labels, run_times)
+    np.maximum.at(last_time, labels, run_times)
+    np.minimum.at(first_sample, labels, starts)
+    np.maximum.at(last_sample, labels, stops - 1)
+    peak_ufunc.at(peaks, labels, run_peaks)
+    np.maximum.at(peak_fractions, labels, run_fractions)
+
+    order = np.lexsort((first_sample, first_time))
+    return [
+        {
+            "times": (first_time[i], last_time[i]),
+            "samples": (first_sample[i], last_sample[i]),
+            "peak": peaks[i],
+            "probability": peak_fractions[i],
+        }
+        for i in order
+    ]
+
+
+def alert_rows(location_name, rule, chainage, times, t_unit, alerts):
+    condition = "{} {:g}".format(">" if rule.above else "<", rule.threshold)
+    for alert in alerts:
+        t0, t1 = alert["times"]
+        s0, s1 = alert["samples"]
+        yield [
+            location_name,
+            rule.param_name,
+            condition,
+            round(chainage[s0], 3),
+            round(chainage[s1], 3),
+            iso_t_str.format(dt=t_unit.num2date(times[t0])),
+            iso_t_str.format(dt=t_unit.num2date(times[t1])),
+            alert["peak"],
+            alert["probability"],
+        ]
+
+
+def stream_alert_rows(cube, rail_lat_lons, rules=ALERT_RULES, location_name="rail", spacing_km=1.0):
+    # One along-track sampling of the cube, read chunk by chunk into a small
+    # [time, member, sample] array and scanned by each rule for its name.
+    param_name = cube.name()
+    param_rules = [rule for rule in rules if rule.param_name == param_name]
+    if not param_rules:
+        return
+    chainage, _, _, values = sample_cube_along_track(cube, rail_lat_lons, spacing_km)
+    values = convert_values(param_name, cube.units, values)
+    times = cube.coord("time").points
+    t_unit = cube.coord("time").units
+    for rule in param_rules:
+        yield from alert_rows(location_name, rule, chainage, times, t_unit, detect_alerts(values, chainage, rule))
+
+
+def write_alerts_csv(filepath, cubes, rail_lat_lons, rules=ALERT_RULES, location_name="rail", spacing_km=1.0):
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(ALERT_TITLES)
+        for cube in cubes:
+            csvw.writerows(stream_alert_rows(cube, rail_lat_lons, rules, location_name, spacing_km))
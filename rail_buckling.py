@@ -0,0 +1,175 @@
+# Rail temperature and buckling probability computed from the ensemble.
+#
+# Replaces loading `rail_buckling_probability` from a precomputed
+# rail_temperature.nc: rail temperature is derived from each member's air
+# temperature (plus short-wave radiation when available) on the corridor
+# cells only, and the probability of exceeding each threshold is the fraction
+# of members above it, reduced over the member axis in one NumPy operation.
+# Short-wave flux is a mean over a period, often on other steps than the air
+# temperature, so it is matched on period end and interpolated in time to
+# the air temperature times.
+
+import csv
+
+import numpy as np
+
+from rail_aggregation import hours_since_epoch
+from rail_extraction import (
+    TIME_CHUNK,
+    chunk_rows,
+    corridor_coords,
+    corridor_indices,
+    iter_corridor_chunks,
+    titles,
+)
+
+# Rail temperature thresholds (C) for the buckling probability.
+BUCKLING_THRESHOLDS = (46.0,)
+# Rail heating per W m-2 of incoming short-wave radiation (C).
+SOLAR_GAIN = 0.02
+# Without radiation, rails are taken to run at 1.5x the air temperature (C).
+RAIL_AIR_RATIO = 1.5
+
+
+def rail_temperature(air_temp_c, shortwave=None, solar_gain=SOLAR_GAIN, ratio=RAIL_AIR_RATIO):
+    if shortwave is not None:
+        return air_temp_c + solar_gain * np.maximum(shortwave, 0)
+    return air_temp_c + (ratio - 1) * np.maximum(air_temp_c, 0)
+
+
+def exceedance_probability(values, thresholds, member_axis=1):
+    # Returns an array with a leading threshold axis and no member axis.
+    # Masked values don't count towards the member total.
+    values = np.ma.asarray(values)
+    thresholds = np.asarray(thresholds, dtype=float)
+    exceeds = values[np.newaxis] > thresholds.reshape((-1,) + (1,) * values.ndim)
+    return np.ma.mean(exceeds, axis=member_axis + 1)
+
+
+def _convert_chunk(units, values, target):
+    return np.ma.masked_array(
+        units.convert(np.ma.getdata(values), target), mask=np.ma.getmaskarray(values)
+    )
+
+
+def check_inputs(air_cube, shortwave_cube=None):
+    # rail_temperature works in C and W m-2, so the cubes must convert to them;
+    # a mislabelled cube would otherwise give plausible-looking nonsense.
+    if air_cube.name() != "air_temperature":
+        raise ValueError("Expected an air_temperature cube, got " + air_cube.name())
+    if air_cube.units is None or not air_cube.units.is_convertible("celsius"):
+        raise ValueError("Air temperature units {} don't convert to celsius".format(air_cube.units))
+    if shortwave_cube is not None and (
+        shortwave_cube.units is None or not shortwave_cube.units.is_convertible("W m-2")
+    ):
+        raise ValueError("Short-wave radiation units {} don't convert to W m-2".format(shortwave_cube.units))
+
+
+def period_end_hours(cube):
+    # Hours since the epoch at the end of each time period (the points of an
+    # unbounded time coordinate).
+    coord = cube.coord("time")
+    points = coord.bounds[:, 1] if coord.has_bounds() else coord.points
+    return hours_since_epoch(coord.units, points)
+
+
+def shortwave_at_times(shortwave_cube, sw_hours, air_hours, lat_inds, lon_inds, n_members):
+    # Short-wave values[time, member, cell] at `air_hours`, interpolated
+    # linearly between the periods ending either side (exact where a period
+    # ends at that time, the nearest period outside the short-wave times).
+    # Only the short-wave steps needed are read.
+    pos = np.interp(air_hours, sw_hours, np.arange(len(sw_hours)))
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, len(sw_hours) - 1)
+    frac = (pos - lo)[:, np.newaxis, np.newaxis]
+    t_start, t_stop = lo.min(), hi.max() + 1
+    keys = [slice(None)] * shortwave_cube.ndim
+    keys[shortwave_cube.coord_dims("time")[0]] = slice(t_start, t_stop)
+    _, _, block = next(
+        iter_corridor_chunks(shortwave_cube[tuple(keys)], lat_inds, lon_inds, t_stop - t_start, n_members)
+    )
+    block = _convert_chunk(shortwave_cube.units, block, "W m-2")
+    return block[lo - t_start] * (1 - frac) + block[hi - t_start] * frac
+
+
+def probability_name(threshold, thresholds):
+    if len(thresholds) == 1:
+        return "rail_buckling_probability"
+    return "rail_buckling_probability_{:g}C".format(threshold)
+
+
+def stream_buckling_rows(
+    air_cube,
+    rail_line,
+    shortwave_cube=None,
+    thresholds=BUCKLING_THRESHOLDS,
+    location_name="rail",
+    time_chunk=TIME_CHUNK,
+    corridor=None,
+    member_rows=True,
+    solar_gain=SOLAR_GAIN,
+    ratio=RAIL_AIR_RATIO,
+):
+    # One pass over the air temperature cube producing, per chunk, the member
+    # air and rail temperature rows (if member_rows) and a "Summary" row per
+    # threshold with the buckling probability. Chunks span every member, as
+    # the probability needs the whole ensemble.
+    check_inputs(air_cube, shortwave_cube)
+    if corridor is None:
+        corridor = corridor_indices(air_cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(air_cube, lat_inds, lon_inds)
+    t_unit = air_cube.coord("time").units
+    air_name = air_cube.name()
+    n_members = len(air_cube.coord("realization").points)
+
+    sw_hours = None
+    if shortwave_cube is not None:
+        sw_hours = period_end_hours(shortwave_cube)
+        air_hours = hours_since_epoch(t_unit, air_cube.coord("time").points)
+        if air_hours.min() < sw_hours.min() or air_hours.max() > sw_hours.max():
+            print("WARNING: Air temperature times outside the short-wave radiation times use the nearest period.")
+
+    for times, members, air in iter_corridor_chunks(
+        air_cube, lat_inds, lon_inds, time_chunk, n_members
+    ):
+        air_c = _convert_chunk(air_cube.units, air, "celsius")
+        shortwave = None
+        if sw_hours is not None:
+            shortwave = shortwave_at_times(
+                shortwave_cube, sw_hours, hours_since_epoch(t_unit, times), lat_inds, lon_inds, n_members
+            )
+        rail_temp = rail_temperature(air_c, shortwave, solar_gain, ratio)
+
+        if member_rows:
+            yield from chunk_rows(
+                location_name, air_name, t_unit, lat_coords, lon_coords, times, members, air_c
+            )
+            yield from chunk_rows(
+                location_name, "rail_temperature", t_unit, lat_coords, lon_coords, times, members, rail_temp
+            )
+
+        probabilities = exceedance_probability(rail_temp, thresholds)
+        for threshold, prob in zip(thresholds, probabilities):
+            yield from chunk_rows(
+                location_name,
+                probability_name(threshold, thresholds),
+                t_unit,
+                lat_coords,
+                lon_coords,
+                times,
+                ["Summary"],
+                prob[:, np.newaxis],
+            )
+
+
+def write_buckling_csv(filepath, air_cube, rail_line, shortwave_cube=None, location_name="rail", **kwargs):
+    # Air temperature, rail temperature and buckling probability rows from one
+    # pass over the air temperature cube; kwargs go to stream_buckling_rows.
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(titles)
+        csvw.writerows(
+            stream_buckling_rows(air_cube, rail_line, shortwave_cube, location_name=location_name, **kwargs)
+        )
+    return filepath
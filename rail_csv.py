@@ -0,0 +1,14 @@
+# CSV schemas of the extraction outputs.
+#
+# Kept free of iris and shapecutter so that readers of the CSVs (the query
+# service, deltas, the GRIB fast path) can share the schema without the
+# extraction dependencies.
+
+# CSV Schema (member = realization)
+titles = ["Location Name", "Lat", "Long", "Datetime", "Member", "Parameter", "Value"]
+t_str = "{dt.day}/{dt.month:02d}/{dt.year}"
+# Keeps the time of day, for outputs finer than daily.
+iso_t_str = "{dt.year}-{dt.month:02d}-{dt.day:02d}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+# Ensemble summary schema: one row per (point, time) instead of per member.
+summary_titles = ["Location Name", "Lat", "Long", "Datetime", "Parameter", "Mean", "Min", "Max", "P10", "P50", "P90"]
@@ -0,0 +1,109 @@
+# Run-to-run delta encoding of the corridor values.
+#
+# Consecutive 6-hourly runs overlap in valid time and often change little
+# there, yet each run is written out in full. Given the shared corridor
+# folders (see shared_corridor.py) of a new run and of a base run, this
+# compares the values at the valid times, members and cells both have and
+# writes only the values that moved by more than a tolerance, appeared or
+# disappeared. A JSON manifest next to the delta CSV names the base run by
+# its forecast reference time, valid-time range and source file, so clients
+# holding the base can apply the delta instead of refetching everything.
+# Delta files have their own header, delta_titles, so they are never read
+# as full extractions; a value that has gone (masked in the new run) is
+# written with Removed set and a NaN Value.
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from rail_aggregation import hours_since_epoch
+from rail_csv import t_str, titles
+from shared_corridor import HEADER_FILE, open_shared_corridor, run_identity
+
+DELTA_TOLERANCE = 0.1
+delta_titles = titles + ["Removed"]
+
+
+def _aligned(new_points, base_points):
+    # Indices into each of the points both have.
+    _, new_inds, base_inds = np.intersect1d(new_points, base_points, return_indices=True)
+    return new_inds, base_inds
+
+
+def corridor_delta(new, base, tolerance=DELTA_TOLERANCE):
+    # Returns (emit, had_base) masks over new.values[time, member, cell]:
+    # values to write, and which of them the base run also had.
+    emit = ~np.asarray(new.mask)
+    had_base = np.zeros(new.values.shape, dtype=bool)
+    if not (np.array_equal(new.lat_coords, base.lat_coords) and np.array_equal(new.lon_coords, base.lon_coords)):
+        # A different corridor can't be compared, so everything is new.
+        return emit, had_base
+
+    new_ti, base_ti = _aligned(
+        np.round(hours_since_epoch(new.t_unit, new.times), 6),
+        np.round(hours_since_epoch(base.t_unit, base.times), 6),
+    )
+    new_mi, base_mi = _aligned(new.members.astype(str), base.members.astype(str))
+    if not len(new_ti) or not len(new_mi):
+        return emit, had_base
+
+    new_box = np.ix_(new_ti, new_mi)
+    base_box = np.ix_(base_ti, base_mi)
+    new_mask = np.asarray(new.mask[new_box])
+    base_mask = np.asarray(base.mask[base_box])
+    moved = np.abs(np.asarray(new.values[new_box], dtype=float) - base.values[base_box]) > tolerance
+    # Written if it moved, appeared or disappeared; unchanged gaps aren't.
+    emit[new_box] = np.where(new_mask, ~base_mask, base_mask | moved)
+    had_base[new_box] = ~base_mask
+    return emit, had_base
+
+
+def write_delta_csv(
+    out_filepath, new_folder, base_folder, location_name="rail", tolerance=DELTA_TOLERANCE
+):
+    # Writes the delta CSV (`delta_titles` schema) and <out>.json manifest, and
+    # returns the manifest.
+    new = open_shared_corridor(new_folder)
+    base = open_shared_corridor(base_folder)
+    emit, had_base = corridor_delta(new, base, tolerance)
+
+    dates = [t_str.format(dt=new.t_unit.num2date(t_point)) for t_point in new.times]
+    t_inds, m_inds, c_inds = np.nonzero(emit)
+    values = np.asarray(new.values[t_inds, m_inds, c_inds])
+    gone = np.asarray(new.mask[t_inds, m_inds, c_inds])
+    with open(out_filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(delta_titles)
+        csvw.writerows(
+            [
+                location_name,
+                new.lat_coords[ci],
+                new.lon_coords[ci],
+                dates[ti],
+                new.members[mi],
+                new.param_name,
+                np.nan if is_gone else value,
+                int(is_gone),
+            ]
+            for ti, mi, ci, value, is_gone in zip(t_inds, m_inds, c_inds, values, gone)
+        )
+
+    with open(os.path.join(base_folder, HEADER_FILE)) as header_file:
+        base_header = json.load(header_file)
+    with open(os.path.join(new_folder, HEADER_FILE)) as header_file:
+        new_header = json.load(header_file)
+    manifest = {
+        "base": run_identity(base_header),
+        "run": run_identity(new_header),
+        "base_param_name": base_header["param_name"],
+        "tolerance": tolerance,
+        "rows": int(len(t_inds)),
+        "unchanged": int(np.count_nonzero(had_base & ~emit)),
+        "new": int(np.count_nonzero(emit & ~had_base)),
+        "removed": int(np.count_nonzero(gone)),
+    }
+    with open(os.path.splitext(out_filepath)[0] + ".json", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
@@ -0,0 +1,267 @@
+# Command line entry point for the rail corridor extraction.
+#
+# Only the standard library is imported at start-up. iris, shapecutter,
+# shapely and scipy are imported when the chosen output format needs them,
+# and the plotting libraries (cartopy, matplotlib, iris.plot) never are, so
+# short scheduled jobs don't pay seconds of import time before any work
+# starts. With RAIL_PROFILE=1 (or -P) a stage profile, worker processes
+# included, is written to profiles/ at the end.
+#
+#   python rail_extract_cli.py -i ./test_data/downloaded/<order>_<run> -p agl_temperature,wind-speed-gust -f both -o extracted
+#   python rail_extract_cli.py -i <run folder>/agl_temperature.nc -f buckling -w <run folder>/downward-short-wave-radiation-flux.nc
+
+import argparse
+import os
+from glob import glob
+
+import profiling
+
+FORMATS = ["members", "summary", "both", "aggregated", "along-track", "buckling"]
+# Same default as rail_route.DEFAULT_ROUTE_FILE, kept here so --help and
+# argument errors don't import numpy and shapely.
+DEFAULT_ROUTE_FILE = "rail_line_london_to_edinb.txt"
+
+
+def find_inputs(inputs, parameters=None):
+    # inputs are NetCDF files, folders of them or glob patterns. parameters
+    # picks files by stem (see rail_parameters.PARAMETER_FILES), in order.
+    filepaths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            filepaths.extend(sorted(glob(os.path.join(entry, "*.nc"))))
+        elif glob(entry):
+            filepaths.extend(sorted(glob(entry)))
+        else:
+            print("WARNING: No input files match " + entry)
+    if parameters:
+        by_stem = {os.path.splitext(os.path.basename(f))[0]: f for f in filepaths}
+        for parameter in parameters:
+            if parameter not in by_stem:
+                print("WARNING: No input file for parameter " + parameter)
+        filepaths = [by_stem[p] for p in parameters if p in by_stem]
+    return filepaths
+
+
+def run_extraction(
+    filepaths,
+    route_filepath,
+    out_dir,
+    output_format,
+    location_name="rail",
+    processes=None,
+    shared=False,
+    delta_base=None,
+    delta_tolerance=None,
+    keep_corridor=False,
+    shortwave_filepath=None,
+):
+    # Returns the paths of the files written. keep_corridor leaves each
+    # file's corridor arrays in out_dir as the delta base for the next run.
+    # The buckling format reads the air temperature files among filepaths
+    # (others are skipped), and short-wave radiation from shortwave_filepath
+    # when given.
+    from rail_route import RouteRegistry
+
+    route = RouteRegistry().load(route_filepath)
+    os.makedirs(out_dir, exist_ok=True)
+
+    if (shared or delta_base or keep_corridor) and output_format not in ("along-track", "buckling"):
+        from shared_corridor import extract_shared
+
+        written = []
+        for filepath in filepaths:
+            stem = os.path.splitext(os.path.basename(filepath))[0]
+            written.extend(
+                extract_shared(
+                    filepath,
+                    route.line,
+                    out_dir,
+                    location_name,
+                    processes,
+                    members=output_format in ("members", "both"),
+                    summary=output_format in ("summary", "both"),
+                    aggregated=output_format == "aggregated",
+                    # Kept as the base for the next run's delta.
+                    keep_corridor=keep_corridor or delta_base is not None,
+                    delta_base=os.path.join(delta_base, "." + stem + "_corridor") if delta_base else None,
+                    delta_tolerance=delta_tolerance,
+                )
+            )
+        return written
+
+    if output_format in ("members", "summary", "both"):
+        from rail_extraction import extract_parameters
+
+        written = extract_parameters(
+            filepaths,
+            route.line,
+            out_dir,
+            location_name,
+            processes,
+            members=output_format != "summary",
+            summary=output_format != "members",
+        )
+        return [f for pair in written for f in pair if f is not None]
+
+    import iris
+
+    shortwave_cube = None
+    if output_format == "buckling" and shortwave_filepath:
+        shortwave_cube = iris.load_cube(shortwave_filepath)
+    written = []
+    for filepath in filepaths:
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        cube = iris.load_cube(filepath)
+        if output_format == "buckling":
+            from rail_buckling import write_buckling_csv
+
+            if cube.name() != "air_temperature":
+                print("Skipping " + filepath + " for buckling: " + cube.name() + " is not air_temperature.")
+                continue
+
+            out_filepath = os.path.join(out_dir, stem + "_buckling.csv")
+            write_buckling_csv(out_filepath, cube, route.line, shortwave_cube, location_name)
+        elif output_format == "aggregated":
+            from rail_aggregation import aggregate_to_csv
+
+            out_filepath = os.path.join(out_dir, stem + "_aggregated.csv")
+            aggregate_to_csv(out_filepath, [cube], route.line, location_name)
+        else:
+            from along_track import write_along_track_csv
+
+            out_filepath = os.path.join(out_dir, stem + "_along_track.csv")
+            write_along_track_csv(out_filepath, cube, route.rail_lat_lons, location_name)
+        written.append(out_filepath)
+    if output_format == "buckling" and not written:
+        print("WARNING: No air_temperature files in the inputs, so no buckling file is written.")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract forecast parameters along a rail route to CSV.")
+    parser.add_argument(
+        "-i",
+        "--inputs",
+        action="store",
+        dest="inputs",
+        nargs="+",
+        required=True,
+        help="NetCDF files, folders of them or glob patterns.",
+    )
+    parser.add_argument(
+        "-r",
+        "--route",
+        action="store",
+        dest="route",
+        default=DEFAULT_ROUTE_FILE,
+        help="Route file (.txt lat/lon list or .geojson).",
+    )
+    parser.add_argument(
+        "-p",
+        "--parameters",
+        action="store",
+        dest="parameters",
+        default="",
+        help="Comma separated parameter file stems. Defaults to every input.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        action="store",
+        dest="format",
+        default="members",
+        choices=FORMATS,
+        help="Output format. Defaults to a row per ensemble member.",
+    )
+    parser.add_argument(
+        "-o", "--out", action="store", dest="out_dir", default="extracted", help="Output folder."
+    )
+    parser.add_argument(
+        "-l", "--location", action="store", dest="location", default="rail", help="Location name written to each row."
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        action="store",
+        dest="processes",
+        default=None,
+        type=int,
+        help="Worker processes for the member/summary formats. Defaults to one per core.",
+    )
+    parser.add_argument(
+        "-s",
+        "--shared",
+        action="store_true",
+        dest="shared",
+        default=False,
+        help="Cut each file once into memory-mapped arrays and split its members across the processes.",
+    )
+    parser.add_argument(
+        "-b",
+        "--delta-base",
+        action="store",
+        dest="delta_base",
+        default=None,
+        help="Output folder of the previous run; also writes <stem>_delta.csv with the values changed since it.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        action="store",
+        dest="tolerance",
+        default=None,
+        type=float,
+        help="Smallest change written to the delta, in output units. Defaults to 0.1.",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-corridor",
+        action="store_true",
+        dest="keep_corridor",
+        default=False,
+        help="Keep each file's corridor arrays in the output folder as the delta base for the next run.",
+    )
+    parser.add_argument(
+        "-w",
+        "--shortwave",
+        action="store",
+        dest="shortwave",
+        default=None,
+        help="Short-wave radiation file for the buckling format. Without it rail temperature comes from air temperature alone.",
+    )
+    parser.add_argument(
+        "-P",
+        "--profile",
+        action="store_true",
+        dest="profile",
+        default=False,
+        help="Time each extraction stage and write a profile to profiles/. Same as RAIL_PROFILE=1.",
+    )
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable()
+
+    parameters = [p for p in args.parameters.split(",") if p]
+    filepaths = find_inputs(args.inputs, parameters)
+    if not filepaths:
+        print("ERROR: No input files found.")
+        exit(1)
+    if not os.path.exists(args.route):
+        print("ERROR: Route file not found: " + args.route)
+        exit(1)
+    if args.shortwave and not os.path.exists(args.shortwave):
+        print("ERROR: Short-wave radiation file not found: " + args.shortwave)
+        exit(1)
+
+    for filepath in run_extraction(
+        filepaths, args.route, args.out_dir, args.format, args.location, args.processes, args.shared,
+        args.delta_base, args.tolerance, args.keep_corridor, args.shortwave,
+    ):
+        print("Written " + filepath)
+    profile_filepath = profiling.write_profile(inputs=filepaths, format=args.format)
+    if profile_filepath:
+        print("Wrote profile " + profile_filepath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+# Out-of-core extraction of gridded forecasts along a rail corridor.
+#
+# The cube is kept lazy: the corridor cells are found once from a single
+# (lat, lon) field, then the data is read in (time, realization) chunks
+# restricted to the corridor's bounding box. Only the corridor cells of each
+# chunk are kept and rows are streamed straight to the output writer, so
+# memory use is bounded by the chunk size rather than by the forecast length
+# or ensemble size.
+#
+# iris and shapecutter are imported by the functions that load and cut
+# cubes, so the chunk and row helpers also serve modules that never load
+# a cube (and run without iris installed).
+
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import profiling
+from rail_csv import iso_t_str, summary_titles, t_str, titles
+from rail_parameters import convert_values
+
+SUMMARY_PERCENTILES = (10, 50, 90)
+
+TIME_CHUNK = 6
+MEMBER_CHUNK = 6
+
+
+def corridor_indices(cube, rail_line):
+    # Cut a single field only, so finding the corridor never realises the cube.
+    import shapecutter
+
+    field = next(cube.slices(["latitude", "longitude"]))
+    with profiling.stage("shapecutter.cut"):
+        cut_field = shapecutter.Cutter(field, rail_line).cut_dataset("", to="boundary")
+    lat_inds, lon_inds = np.nonzero(np.ma.getmaskarray(cut_field.data) == False)
+    return lat_inds, lon_inds
+
+
+def corridor_coords(cube, lat_inds, lon_inds):
+    lat_coords = cube.coord("latitude").points[lat_inds]
+    lon_coords = cube.coord("longitude").points[lon_inds]
+    return lat_coords, lon_coords
+
+
+def _member_points(cube):
+    if cube.coords("realization", dim_coords=True):
+        return cube.coord_dims("realization")[0], cube.coord("realization").points
+    # Probability cubes have no member axis.
+    return None, np.array(["Summary"])
+
+
+def iter_corridor_chunks(
+    cube, lat_inds, lon_inds, time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK
+):
+    # Yields (time points, member points, values[time, member, cell]) per chunk.
+    data = cube.core_data()
+    t_dim = cube.coord_dims("time")[0]
+    lat_dim = cube.coord_dims("latitude")[0]
+    lon_dim = cube.coord_dims("longitude")[0]
+    m_dim, members = _member_points(cube)
+    times = cube.coord("time").points
+
+    lat0, lon0 = lat_inds.min(), lon_inds.min()
+    lat_box = slice(lat0, lat_inds.max() + 1)
+    lon_box = slice(lon0, lon_inds.max() + 1)
+    box_lat_inds = lat_inds - lat0
+    box_lon_inds = lon_inds - lon0
+
+    for t_start in range(0, len(times), time_chunk):
+        t_box = slice(t_start, t_start + time_chunk)
+        for m_start in range(0, len(members), member_chunk):
+            m_box = slice(m_start, m_start + member_chunk)
+            keys = [0] * data.ndim
+            keys[t_dim] = t_box
+            keys[lat_dim] = lat_box
+            keys[lon_dim] = lon_box
+            if m_dim is not None:
+                keys[m_dim] = m_box
+            with profiling.stage("read_chunk"):
+                block = data[tuple(keys)]
+                if hasattr(block, "compute"):
+                    block = block.compute()
+
+            # Integer keys drop their dims, so order the rest as (t, m, lat, lon).
+            kept = [d for d in range(data.ndim) if not isinstance(keys[d], int)]
+            order = [t_dim] + ([m_dim] if m_dim is not None else []) + [lat_dim, lon_dim]
+            block = np.ma.transpose(block, [kept.index(d) for d in order])
+            if m_dim is None:
+                block = block[:, np.newaxis]
+
+            yield times[t_box], members[m_box], block[..., box_lat_inds, box_lon_inds]
+
+
+def convert_chunk(param_name, units, values):
+    return np.ma.masked_array(
+        convert_values(param_name, units, np.ma.getdata(values)),
+        mask=np.ma.getmaskarray(values),
+    )
+
+
+def chunk_rows(location_name, param_name, t_unit, lat_coords, lon_coords, times, members, values, date_format=t_str):
+    for ti, t_point in enumerate(times):
+        date = date_format.format(dt=t_unit.num2date(t_point))
+        for mi, ens_mbr in enumerate(members):
+            cell_values = values[ti, mi]
+            not_masked = np.ma.getmaskarray(cell_values) == False
+            for lac, loc, val in zip(
+                lat_coords[not_masked], lon_coords[not_masked], np.ma.getdata(cell_values)[not_masked]
+            ):
+                yield [location_name, lac, loc, date, ens_mbr, param_name, val]
+
+
+def summarise_ensemble(values, percentiles=SUMMARY_PERCENTILES, member_axis=1):
+    # Mean, min, max and percentiles over the member axis, in summary_titles
+    # order. Masked members are ignored.
+    filled = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    levels = np.nanpercentile(filled, percentiles, axis=member_axis)
+    return [
+        np.nanmean(filled, axis=member_axis),
+        np.nanmin(filled, axis=member_axis),
+        np.nanmax(filled, axis=member_axis),
+    ] + list(levels)
+
+
+def summary_rows(location_name, param_name, t_unit, lat_coords, lon_coords, times, stats):
+    # stats as returned by summarise_ensemble, each [time, cell].
+    stacked = np.stack(stats, axis=-1)
+    for ti, t_point in enumerate(times):
+        date = t_str.format(dt=t_unit.num2date(t_point))
+        for lac, loc, cell_stats in zip(lat_coords, lon_coords, stacked[ti]):
+            if np.isnan(cell_stats[0]):
+                continue
+            yield [location_name, lac, loc, date, param_name] + list(cell_stats)
+
+
+def stream_corridor_rows(
+    cube,
+    rail_line,
+    location_name="rail",
+    time_chunk=TIME_CHUNK,
+    member_chunk=MEMBER_CHUNK,
+    corridor=None,
+):
+    # Rows come out grouped by (time chunk, member chunk) rather than strictly
+    # by time then member; every row still carries its own time and member.
+    if corridor is None:
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    for times, members, values in iter_corridor_chunks(
+        cube, lat_inds, lon_inds, time_chunk, member_chunk
+    ):
+        values = convert_chunk(param_name, cube.units, values)
+        yield from chunk_rows(
+            location_name, param_name, t_unit, lat_coords, lon_coords, times, members, values
+        )
+
+
+def extract_to_csv(filepath, cubes, rail_line, location_name="rail", time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK):
+    # Load cubes with iris.load_cube and don't touch .data: they stay lazy.
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(titles)
+        for cube in cubes:
+            for row in stream_corridor_rows(
+                cube, rail_line, location_name, time_chunk, member_chunk
+            ):
+                csvw.writerow(row)
+
+
+def stream_summary_rows(cube, rail_line, location_name="rail", time_chunk=TIME_CHUNK, corridor=None):
+    # Chunks span every member, as the summary needs the whole ensemble.
+    if corridor is None:
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    n_members = len(_member_points(cube)[1])
+    for times, members, values in iter_corridor_chunks(
+        cube, lat_inds, lon_inds, time_chunk, n_members
+    ):
+        values = convert_chunk(param_name, cube.units, values)
+        yield from summary_rows(
+            location_name, param_name, t_unit, lat_coords, lon_coords, times, summarise_ensemble(values)
+        )
+
+
+def _same_grid(cube, grid):
+    lat_points, lon_points = grid
+    return np.array_equal(cube.coord("latitude").points, lat_points) and np.array_equal(
+        cube.coord("longitude").points, lon_points
+    )
+
+
+def _extract_parameter_file(task):
+    # Runs in a worker process: one parameter file to a per-member CSV and/or
+    # an ensemble summary CSV, both written from the same chunks.
+    (
+        param_file, constraint, member_filepath, summary_filepath, rail_line,
+        corridor, grid, location_name, time_chunk, member_chunk,
+    ) = task
+    import iris
+
+    cube = iris.load_cube(param_file, constraint)
+    if corridor is None or not _same_grid(cube, grid):
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    if summary_filepath is not None:
+        member_chunk = len(_member_points(cube)[1])
+
+    member_file = summary_file = None
+    try:
+        if member_filepath is not None:
+            member_file = open(member_filepath, "w")
+            member_csvw = csv.writer(member_file)
+            member_csvw.writerow(titles)
+        if summary_filepath is not None:
+            summary_file = open(summary_filepath, "w")
+            summary_csvw = csv.writer(summary_file)
+            summary_csvw.writerow(summary_titles)
+
+        for times, members, values in iter_corridor_chunks(
+            cube, lat_inds, lon_inds, time_chunk, member_chunk
+        ):
+            values = convert_chunk(param_name, cube.units, values)
+            if member_file is not None:
+                with profiling.stage("write_member_rows"):
+                    member_csvw.writerows(
+                        chunk_rows(location_name, param_name, t_unit, lat_coords, lon_coords, times, members, values)
+                    )
+            if summary_file is not None:
+                with profiling.stage("write_summary_rows"):
+                    summary_csvw.writerows(
+                        summary_rows(
+                            location_name, param_name, t_unit, lat_coords, lon_coords, times, summarise_ensemble(values)
+                        )
+                    )
+    finally:
+        for out_file in (member_file, summary_file):
+            if out_file is not None:
+                out_file.close()
+    return member_filepath, summary_filepath
+
+
+def extract_parameters(
+    param_files,
+    rail_line,
+    out_dir,
+    location_name="rail",
+    processes=None,
+    time_chunk=TIME_CHUNK,
+    member_chunk=MEMBER_CHUNK,
+    members=True,
+    summary=False,
+    mp_context=None,
+):
+    # param_files holds paths, or (path, constraint) pairs for files holding
+    # more than one cube, e.g. ("rail_temperature.nc", "rail_buckling_probability").
+    # The corridor is computed once from the first file and shared with every
+    # worker; a file on a different grid falls back to its own cut.
+    # `members` writes <stem>.csv with a row per member, `summary` writes
+    # <stem>_summary.csv with the ensemble statistics.
+    # mp_context (e.g. a "spawn" context) is passed to the process pool.
+    # Returns (member CSV, summary CSV) paths per file, None where not written.
+    import iris
+
+    param_files = [
+        (entry, None) if isinstance(entry, str) else tuple(entry) for entry in param_files
+    ]
+    first_cube = iris.load_cube(*param_files[0])
+    corridor = corridor_indices(first_cube, rail_line)
+    grid = (first_cube.coord("latitude").points, first_cube.coord("longitude").points)
+
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    for param_file, constraint in param_files:
+        stem = os.path.splitext(os.path.basename(param_file))[0]
+        if constraint is not None:
+            stem = stem + "_" + str(constraint)
+        member_filepath = os.path.join(out_dir, stem + ".csv") if members else None
+        summary_filepath = os.path.join(out_dir, stem + "_summary.csv") if summary else None
+        tasks.append(
+            (
+                param_file, constraint, member_filepath, summary_filepath, rail_line,
+                corridor, grid, location_name, time_chunk, member_chunk,
+            )
+        )
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+        return profiling.map_profiled(executor, _extract_parameter_file, tasks)
+
+
+def combine_csvs(csv_filepaths, out_filepath, header=titles):
+    # Concatenate per-parameter CSVs with the same schema into one file.
+    with open(out_filepath, "w") as outfile:
+        outfile.write(",".join(header) + "\n")
+        for filepath in csv_filepaths:
+            if filepath is None:
+                continue
+            with open(filepath) as infile:
+                infile.readline()
+                for line in infile:
+                    outfile.write(line)
@@ -0,0 +1,54 @@
+# Output units for each extracted parameter, keyed by cube name.
+#
+# Replaces the inline `if param_name == "air_temperature"` K --> C check in
+# the notebooks. Parameters not listed here, or whose units can't be
+# converted to the target, are written as they are.
+
+PARAMETER_UNITS = {
+    "air_temperature": "celsius",
+    "surface_temperature": "celsius",
+    "soil_temperature": "celsius",
+    "rail_temperature": "celsius",
+    "air_pressure_at_mean_sea_level": "hPa",
+    "wind_speed": "m s-1",
+    "wind_speed_of_gust": "m s-1",
+    "wind_from_direction": "degrees",
+    "surface_downwelling_shortwave_flux_in_air": "W m-2",
+    "moisture_content_of_soil_layer": "kg m-2",
+    "rainfall_amount": "kg m-2",
+    "convective_rainfall_amount": "kg m-2",
+    "rail_buckling_probability": "1",
+}
+
+# The parameter files written by convert_and_save_netcdf_xr in
+# fetch_from_weatherdatahub.py.
+PARAMETER_FILES = [
+    "agl_temperature",
+    "wind-direction-from-which-blowing-surface-adjusted",
+    "wind-speed-gust",
+    "wind-speed-surface-adjusted",
+    "soil-moisture_0.05",
+    "soil-moisture_0.225",
+    "soil-moisture_0.675",
+    "soil-moisture_2.0",
+    "convective-rain-accumulation",
+    "downward-short-wave-radiation-flux",
+    "rainfall-accumulation",
+    "ground_temperature",
+    "pressure-reduced-to-msl",
+]
+
+
+def output_units(param_name, units):
+    target = PARAMETER_UNITS.get(param_name)
+    if target is None or units is None or not units.is_convertible(target):
+        return units
+    return target
+
+
+def convert_values(param_name, units, values):
+    # `units` is the cube's cf_units.Unit; masks are kept as they are.
+    target = output_units(param_name, units)
+    if target is units or units == target:
+        return values
+    return units.convert(values, target)
@@ -0,0 +1,225 @@
+# Route helpers shared by the rail extraction scripts.
+
+import ast
+import hashlib
+import json
+import os
+from collections import namedtuple
+from glob import glob
+
+import numpy as np
+from shapely.geometry import LineString, MultiLineString
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+DEFAULT_ROUTE_FILE = "rail_line_london_to_edinb.txt"
+ROUTE_CACHE_FOLDER = ".route_cache"
+ROUTE_FILE_PATTERNS = ["*.txt", "*.geojson"]
+EARTH_RADIUS_KM = 6371.0
+
+
+def load_rail_lat_lons(filepath=DEFAULT_ROUTE_FILE):
+    # Route files hold the same `rail_lat_lons = [[lat, lon], ...]` literal
+    # that is pasted into the notebooks.
+    with open(filepath) as route_file:
+        text = route_file.read()
+    return ast.literal_eval(text.split("=", 1)[1].strip())
+
+
+def split_route_parts(rail_lat_lons):
+    # A route with several parts (e.g. from a GeoJSON MultiLineString) keeps
+    # them apart with [nan, nan] rows; returns the parts as [lat, lon] arrays.
+    lat_lons = np.asarray(rail_lat_lons, dtype=float)
+    gaps = np.isnan(lat_lons).any(axis=1)
+    parts = np.split(lat_lons, np.flatnonzero(gaps))
+    parts = [part[~np.isnan(part).any(axis=1)] for part in parts]
+    return [part for part in parts if len(part)]
+
+
+def join_route_parts(parts):
+    gap = np.full((1, 2), np.nan)
+    joined = []
+    for part in parts:
+        if joined:
+            joined.append(gap)
+        joined.append(np.asarray(part, dtype=float)[:, :2])
+    return np.concatenate(joined)
+
+
+def rail_line_from_lat_lons(rail_lat_lons):
+    # Lon/lat values are transposed... A route in parts gives a
+    # MultiLineString, so no segment is drawn across the gaps.
+    lines = [
+        LineString([(x, y) for [y, x] in part]) for part in split_route_parts(rail_lat_lons) if len(part) > 1
+    ]
+    if len(lines) == 1:
+        return lines[0]
+    return MultiLineString(lines)
+
+
+def line_lat_lons(line):
+    # The inverse of rail_line_from_lat_lons; LineString coords are (lon, lat).
+    lines = line.geoms if isinstance(line, MultiLineString) else [line]
+    return join_route_parts([[[lat, lon] for lon, lat in part.coords] for part in lines])
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def route_chainage_km(rail_lat_lons):
+    # Cumulative distance along one route part at each vertex, starting at 0 km.
+    lat_lons = np.asarray(rail_lat_lons, dtype=float)
+    steps = haversine_km(
+        lat_lons[:-1, 0], lat_lons[:-1, 1], lat_lons[1:, 0], lat_lons[1:, 1]
+    )
+    return np.concatenate([[0.0], np.cumsum(steps)])
+
+
+def resample_route(rail_lat_lons, spacing_km=1.0):
+    # Points every `spacing_km` along the route (plus the final vertex of each
+    # part). Vertices are close together, so interpolating lat/lon linearly
+    # within a segment is accurate enough at model grid resolution. Parts are
+    # resampled separately, nothing is placed in the gaps between them and
+    # chainage carries on from the end of the previous part.
+    chainages, lats, lons = [], [], []
+    start_km = 0.0
+    for lat_lons in split_route_parts(rail_lat_lons):
+        vertex_chainage = start_km + route_chainage_km(lat_lons)
+        total_km = vertex_chainage[-1]
+        chainage = np.arange(start_km, total_km, spacing_km)
+        chainage = np.append(chainage, total_km)
+        chainages.append(chainage)
+        lats.append(np.interp(chainage, vertex_chainage, lat_lons[:, 0]))
+        lons.append(np.interp(chainage, vertex_chainage, lat_lons[:, 1]))
+        start_km = total_km
+    return np.concatenate(chainages), np.concatenate(lats), np.concatenate(lons)
+
+
+def normalise_lat_lons(points):
+    # Routes should be [lat, lon]; GeoJSON-style [lon, lat] input is swapped
+    # when the first column can't be a latitude.
+    points = np.asarray(points, dtype=float)[:, :2]
+    known = points[~np.isnan(points).any(axis=1)]
+    if np.any(np.abs(known[:, 0]) > 90) and np.all(np.abs(known[:, 1]) <= 90):
+        points = points[:, ::-1]
+    return points
+
+
+def load_geojson_lat_lons(filepath):
+    # First LineString or MultiLineString (parts split by [nan, nan] rows,
+    # see split_route_parts) in a GeoJSON file, feature or geometry. GeoJSON
+    # positions are [lon, lat].
+    with open(filepath) as geojson_file:
+        data = json.load(geojson_file)
+    if data.get("type") == "FeatureCollection":
+        data = data["features"][0]
+    if data.get("type") == "Feature":
+        data = data["geometry"]
+    if data["type"] == "MultiLineString":
+        parts = data["coordinates"]
+    elif data["type"] == "LineString":
+        parts = [data["coordinates"]]
+    else:
+        raise ValueError("Unsupported route geometry: " + data["type"])
+    return join_route_parts([[[lat, lon] for lon, lat in (point[:2] for point in part)] for part in parts])
+
+
+def load_route_lat_lons(filepath):
+    if filepath.lower().endswith((".geojson", ".json")):
+        lat_lons = load_geojson_lat_lons(filepath)
+    else:
+        lat_lons = load_rail_lat_lons(filepath)
+    return normalise_lat_lons(lat_lons)
+
+
+def simplify_lat_lons(lat_lons, tolerance):
+    # Drops vertices closer than `tolerance` degrees to the simplified line;
+    # half the grid spacing keeps every cell the route touches.
+    if not tolerance:
+        return lat_lons
+    return join_route_parts(
+        np.asarray(rail_line_from_lat_lons(part).simplify(tolerance, preserve_topology=False).coords)[:, ::-1]
+        if len(part) > 1
+        else part
+        for part in split_route_parts(lat_lons)
+    )
+
+
+Route = namedtuple("Route", ["name", "rail_lat_lons", "line", "prepared"])
+
+
+class RouteRegistry:
+    # Routes loaded from txt or GeoJSON files, with the parsed, normalised and
+    # simplified vertices cached as .npz files keyed by a hash of the source
+    # file and tolerance (the cache folder is made on the first write). Each route gets a LineString and a prepared
+    # geometry, and an STRtree answers which routes a geometry touches.
+
+    def __init__(self, cache_folder=ROUTE_CACHE_FOLDER, tolerance=None):
+        self.cache_folder = cache_folder
+        self.tolerance = tolerance
+        self.routes = {}
+        self._tree = None
+
+    def _cached_lat_lons(self, filepath):
+        with open(filepath, "rb") as source:
+            digest = hashlib.sha1(source.read())
+        digest.update(repr(self.tolerance).encode())
+        cache_path = os.path.join(self.cache_folder, digest.hexdigest() + ".npz")
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return cached["rail_lat_lons"]
+        lat_lons = simplify_lat_lons(load_route_lat_lons(filepath), self.tolerance)
+        os.makedirs(self.cache_folder, exist_ok=True)
+        np.savez(cache_path, rail_lat_lons=lat_lons)
+        return lat_lons
+
+    def add(self, name, rail_lat_lons):
+        line = rail_line_from_lat_lons(rail_lat_lons)
+        self.routes[name] = Route(name, np.asarray(rail_lat_lons), line, prep(line))
+        self._tree = None
+        return self.routes[name]
+
+    def load(self, filepath, name=None):
+        if name is None:
+            name = os.path.splitext(os.path.basename(filepath))[0]
+        return self.add(name, self._cached_lat_lons(filepath))
+
+    def load_folder(self, folder):
+        for pattern in ROUTE_FILE_PATTERNS:
+            for filepath in sorted(glob(os.path.join(folder, pattern))):
+                self.load(filepath)
+        return self
+
+    def __getitem__(self, name):
+        return self.routes[name]
+
+    def __iter__(self):
+        return iter(self.routes.values())
+
+    def __len__(self):
+        return len(self.routes)
+
+    def intersecting(self, geometry):
+        # Routes touching `geometry` (lon/lat axis order), via the STRtree
+        # for candidates and the prepared geometries for the exact test.
+        if self._tree is None:
+            self._names = list(self.routes)
+            lines = [self.routes[name].line for name in self._names]
+            self._names_by_line = {id(line): name for line, name in zip(lines, self._names)}
+            self._tree = STRtree(lines)
+        found = []
+        for candidate in self._tree.query(geometry):
+            # Shapely 2 returns indices, older versions the geometries.
+            if isinstance(candidate, (int, np.integer)):
+                route = self.routes[self._names[candidate]]
+            else:
+                route = self.routes[self._names_by_line[id(candidate)]]
+            if route.prepared.intersects(geometry):
+                found.append(route)
+        return found
@@ -0,0 +1,229 @@
+# Watches Weather DataHub for newly completed model runs.
+#
+# get_latest_mogreps_run() guesses the run from the wall clock, so runs are
+# either fetched before they are complete or picked up late. This polls
+# /runs/{model} for every model instead, using conditional requests (ETag /
+# Last-Modified) so an unchanged run list costs a 304, and calls back as
+# soon as a new entry appears in completeRuns. A model's validators are only
+# kept once all its new runs have triggered, so a failed trigger is retried
+# on the next poll, and one model failing doesn't stop the others being
+# polled. Polls are jittered, and failures back off exponentially. The
+# latest run seen per model is kept in a state file so a restart doesn't
+# re-trigger old runs.
+#
+#   python run_watcher.py -k <apikey> -m mo-mogrepsg -e "<job command> {model} {run} {runDateTime}"
+
+import argparse
+import json
+import os
+import random
+import shlex
+import subprocess
+import time
+
+import requests
+
+from weatherdatahub_api import BASE_URL, MODEL_LIST
+
+WATCHER_STATE_FILE = "latest/watcher.json"
+POLL_PERIOD = 60
+MAX_BACKOFF = 900
+JITTER = 0.2
+
+
+def jittered(seconds, jitter=JITTER):
+    return seconds * random.uniform(1 - jitter, 1 + jitter)
+
+
+def backoff(failures, base=POLL_PERIOD, cap=MAX_BACKOFF):
+    # "Full jitter" exponential backoff.
+    return random.uniform(0, min(cap, base * 2 ** failures))
+
+
+def run_stamp(run):
+    return run["runDateTime"] + ":" + run["run"]
+
+
+class RunWatcher:
+    def __init__(
+        self,
+        base_url,
+        request_headers,
+        on_new_run,
+        models=MODEL_LIST,
+        poll_period=POLL_PERIOD,
+        max_backoff=MAX_BACKOFF,
+        state_file=WATCHER_STATE_FILE,
+        verbose=False,
+    ):
+        self.base_url = base_url
+        self.request_headers = request_headers
+        self.on_new_run = on_new_run
+        self.models = models
+        self.poll_period = poll_period
+        self.max_backoff = max_backoff
+        self.state_file = state_file
+        self.verbose = verbose
+        self.validators = {}
+        self.session = requests.Session()
+        self.latest = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.latest = json.load(f)
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        with open(self.state_file, "w") as f:
+            json.dump(self.latest, f, indent=2)
+
+    def poll_model(self, model):
+        # Returns (completed runs newer than the last one seen, oldest first,
+        # and the response's validators, or None when unchanged).
+        headers = {"Accept": "application/json"}
+        headers.update(self.request_headers)
+        etag, last_modified = self.validators.get(model, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        url = self.base_url + "/runs/" + model + "?sort=RUNDATETIME"
+        req = self.session.get(url, headers=headers, timeout=30)
+        if req.status_code == 304:
+            return [], None
+        if req.status_code != 200:
+            raise Exception("HTTP Reason and Status: " + req.reason, req.status_code)
+        validators = (req.headers.get("ETag"), req.headers.get("Last-Modified"))
+
+        complete_runs = sorted(req.json()["completeRuns"], key=run_stamp)
+        if not complete_runs:
+            return [], validators
+        last_seen = self.latest.get(model)
+        if last_seen is None:
+            # First sight of this model: only the latest run counts as new.
+            return complete_runs[-1:], validators
+        return [run for run in complete_runs if run_stamp(run) > last_seen], validators
+
+    def poll(self):
+        # Polls every model, even after one fails; raises at the end if any did.
+        triggered = []
+        failed = []
+        for model in self.models:
+            try:
+                runs, validators = self.poll_model(model)
+                for run in runs:
+                    if self.verbose:
+                        print("New complete run for " + model + ": " + run_stamp(run))
+                    self.on_new_run(model, run)
+                    self.latest[model] = run_stamp(run)
+                    self._save_state()
+                    triggered.append((model, run))
+            except Exception as ex:
+                print("WARNING: " + model + " poll failed: " + format(ex))
+                failed.append(model)
+                continue
+            if validators is not None:
+                self.validators[model] = validators
+        if failed:
+            raise Exception("Polling failed for " + ", ".join(failed))
+        return triggered
+
+    def watch(self):
+        failures = 0
+        while True:
+            try:
+                self.poll()
+                failures = 0
+                time.sleep(jittered(self.poll_period))
+            except Exception as ex:
+                failures += 1
+                wait = backoff(failures, self.poll_period, self.max_backoff)
+                print("WARNING: run poll failed (" + format(ex) + "), retrying in " + str(round(wait)) + "s")
+                time.sleep(wait)
+
+
+def command_trigger(command):
+    # on_new_run callback running a shell command template, formatted with
+    # model, run and runDateTime.
+    def trigger(model, run):
+        args = [
+            arg.format(model=model, run=run["run"], runDateTime=run["runDateTime"])
+            for arg in shlex.split(command)
+        ]
+        subprocess.run(args, check=True)
+
+    return trigger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Trigger the pipeline as soon as Weather DataHub completes a model run."
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        action="store",
+        dest="baseUrl",
+        default=BASE_URL,
+        help="Base URL used to access Weather DataHub API.",
+    )
+    parser.add_argument(
+        "-c", "--client", action="store", dest="clientId", default="", help="Client ID of your WDH Application"
+    )
+    parser.add_argument(
+        "-s", "--secret", action="store", dest="secret", default="", help="Your WDH API Gateway secret"
+    )
+    parser.add_argument(
+        "-k", "--apikey", action="store", dest="apikey", default="", help="Use direct API Key when not via APIM."
+    )
+    parser.add_argument(
+        "-m",
+        "--modellist",
+        action="store",
+        dest="modellist",
+        default=",".join(MODEL_LIST),
+        help="Comma separated list of models to watch.",
+    )
+    parser.add_argument(
+        "-e",
+        "--exec",
+        action="store",
+        dest="command",
+        required=True,
+        help="Command to run per new run; {model}, {run} and {runDateTime} are substituted.",
+    )
+    parser.add_argument(
+        "-p",
+        "--period",
+        action="store",
+        dest="period",
+        default=POLL_PERIOD,
+        type=int,
+        help="Seconds between polls. Defaults to 60.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode."
+    )
+    args = parser.parse_args()
+
+    if args.apikey == "":
+        if args.clientId == "" or args.secret == "":
+            print("ERROR: IBM client and secret must be supplied.")
+            exit()
+        request_headers = {"x-ibm-client-id": args.clientId, "x-ibm-client-secret": args.secret}
+    else:
+        request_headers = {"x-api-key": args.apikey}
+
+    watcher = RunWatcher(
+        args.baseUrl,
+        request_headers,
+        command_trigger(args.command),
+        models=args.modellist.split(","),
+        poll_period=args.period,
+        verbose=args.verbose,
+    )
+    watcher.watch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# Per-segment rail risk from a precomputed segment-to-cell mapping.
+#
+# Operations act on track segments between consecutive rail_lat_lons
+# vertices, not on grid cells. For each grid+route the cells every segment
+# crosses are found once, weighted by the fraction of the segment's length
+# inside each cell, and stored as a sparse (segment, cell) matrix. Segment
+# mean and max values and buckling probabilities are then vectorised
+# reductions over that matrix for every time and member.
+
+import csv
+
+import numpy as np
+from scipy import sparse
+
+from along_track import grid_route_key
+from grid_index import nearest_cells
+from rail_buckling import exceedance_probability, probability_name, rail_temperature
+from rail_extraction import TIME_CHUNK, MEMBER_CHUNK, convert_chunk, iter_corridor_chunks, t_str
+
+# CSV Schema (member = realization), one row per segment.
+SEGMENT_TITLES = [
+    "Location Name",
+    "Segment",
+    "Start Lat",
+    "Start Long",
+    "End Lat",
+    "End Long",
+    "Datetime",
+    "Member",
+    "Parameter",
+    "Value",
+]
+# Sub-samples per grid spacing when walking a segment.
+SAMPLES_PER_CELL = 4
+
+_segment_cache = {}
+
+
+def _grid_spacing(points):
+    return np.min(np.abs(np.diff(points)))
+
+
+def build_segment_index(grid_lats, grid_lons, rail_lat_lons, samples_per_cell=SAMPLES_PER_CELL):
+    # Returns (lat_inds, lon_inds, weights): the distinct cells touched by the
+    # route and a CSR matrix of shape (n_segments, n_cells) whose rows sum to 1.
+    lat_lons = np.asarray(rail_lat_lons, dtype=float)
+    step = min(_grid_spacing(grid_lats), _grid_spacing(grid_lons)) / samples_per_cell
+
+    sample_lats, sample_lons, sample_rows, sample_weights = [], [], [], []
+    for seg, (start, end) in enumerate(zip(lat_lons[:-1], lat_lons[1:])):
+        if np.isnan(start).any() or np.isnan(end).any():
+            # Either side of a gap between route parts (see split_route_parts).
+            continue
+        n_steps = max(1, int(np.ceil(np.hypot(*(end - start)) / step)))
+        frac = (np.arange(n_steps) + 0.5) / n_steps
+        sample_lats.append(start[0] + frac * (end[0] - start[0]))
+        sample_lons.append(start[1] + frac * (end[1] - start[1]))
+        sample_rows.append(np.full(n_steps, seg))
+        sample_weights.append(np.full(n_steps, 1.0 / n_steps))
+
+    lat_inds, lon_inds, _ = nearest_cells(
+        grid_lats, grid_lons, np.concatenate(sample_lats), np.concatenate(sample_lons)
+    )
+    flat = np.ravel_multi_index((lat_inds[:, 0], lon_inds[:, 0]), (len(grid_lats), len(grid_lons)))
+    cells, cols = np.unique(flat, return_inverse=True)
+    weights = sparse.csr_matrix(
+        (np.concatenate(sample_weights), (np.concatenate(sample_rows), cols)),
+        shape=(len(lat_lons) - 1, len(cells)),
+    )
+    weights.sum_duplicates()
+    cell_lat_inds, cell_lon_inds = np.unravel_index(cells, (len(grid_lats), len(grid_lons)))
+    return cell_lat_inds, cell_lon_inds, weights
+
+
+def get_segment_index(grid_lats, grid_lons, rail_lat_lons, samples_per_cell=SAMPLES_PER_CELL):
+    key = grid_route_key(grid_lats, grid_lons, rail_lat_lons, samples_per_cell)
+    if key not in _segment_cache:
+        _segment_cache[key] = build_segment_index(grid_lats, grid_lons, rail_lat_lons, samples_per_cell)
+    return _segment_cache[key]
+
+
+def segment_mean(values, weights):
+    # values[..., cell] -> [..., segment], length-weighted.
+    filled = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    flat = filled.reshape(-1, filled.shape[-1])
+    return np.asarray(weights @ flat.T).T.reshape(filled.shape[:-1] + (weights.shape[0],))
+
+
+def segment_max(values, weights):
+    # values[..., cell] -> [..., segment], ignoring masked cells.
+    filled = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    gathered = filled[..., weights.indices]
+    return np.fmax.reduceat(gathered, weights.indptr[:-1], axis=-1)
+
+
+def _segment_rows(location_name, rail_lat_lons, param_name, t_unit, times, members, values):
+    for ti, t_point in enumerate(times):
+        date = t_str.format(dt=t_unit.num2date(t_point))
+        for mi, ens_mbr in enumerate(members):
+            for seg, val in enumerate(values[ti, mi]):
+                start, end = rail_lat_lons[seg], rail_lat_lons[seg + 1]
+                if np.isnan(val) or np.isnan(start).any() or np.isnan(end).any():
+                    continue
+                yield [location_name, seg, start[0], start[1], end[0], end[1], date, ens_mbr, param_name, val]
+
+
+def stream_segment_rows(
+    cube,
+    rail_lat_lons,
+    location_name="rail",
+    buckling_thresholds=None,
+    time_chunk=TIME_CHUNK,
+    member_chunk=MEMBER_CHUNK,
+):
+    # Per-segment max and mean of the cube for each time and member. With
+    # buckling_thresholds (air temperature cubes), also the probability of
+    # the segment's hottest rail exceeding each threshold, as "Summary" rows;
+    # chunks then span every member.
+    lat_inds, lon_inds, weights = get_segment_index(
+        cube.coord("latitude").points, cube.coord("longitude").points, rail_lat_lons
+    )
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    if buckling_thresholds is not None:
+        member_chunk = len(cube.coord("realization").points)
+
+    for times, members, values in iter_corridor_chunks(
+        cube, lat_inds, lon_inds, time_chunk, member_chunk
+    ):
+        values = convert_chunk(param_name, cube.units, values)
+        for stat_name, reduce in (("max", segment_max), ("mean", segment_mean)):
+            yield from _segment_rows(
+                location_name,
+                rail_lat_lons,
+                "{}_segment_{}".format(param_name, stat_name),
+                t_unit,
+                times,
+                members,
+                reduce(values, weights),
+            )
+        if buckling_thresholds is not None:
+            hottest = np.ma.masked_invalid(segment_max(rail_temperature(values), weights))
+            probabilities = exceedance_probability(hottest, buckling_thresholds)
+            for threshold, prob in zip(buckling_thresholds, probabilities):
+                yield from _segment_rows(
+                    location_name,
+                    rail_lat_lons,
+                    probability_name(threshold, buckling_thresholds),
+                    t_unit,
+                    times,
+                    ["Summary"],
+                    np.ma.filled(prob, np.nan)[:, np.newaxis],
+                )
+
+
+def write_segment_csv(filepath, cube, rail_lat_lons, location_name="rail", buckling_thresholds=None):
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(SEGMENT_TITLES)
+        csvw.writerows(stream_segment_rows(cube, rail_lat_lons, location_name, buckling_thresholds))
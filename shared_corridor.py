@@ -0,0 +1,276 @@
+# Corridor data shared between worker processes through memory-mapped files.
+#
+# extract_parameters gives each worker process a whole parameter file.
+# Splitting one parameter's members or statistics across processes that way
+# would mean every worker re-loading and re-cutting the cube, or being sent
+# pickled masked arrays. Here the corridor is cut and read once into .npy
+# files (values, mask, times and coordinates) plus a small JSON header.
+# Workers are only sent the folder path and open the arrays with
+# np.load(mmap_mode="r"), so every process reads the same pages of the OS
+# page cache rather than holding its own copy. cf_units and iris are only
+# imported to open or load, as in rail_extraction.py.
+
+import csv
+import json
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import profiling
+from rail_aggregation import WINDOWS, aggregated_param_name, stream_window_stats
+from rail_extraction import (
+    MEMBER_CHUNK,
+    TIME_CHUNK,
+    _member_points,
+    chunk_rows,
+    combine_csvs,
+    convert_chunk,
+    corridor_coords,
+    corridor_indices,
+    iso_t_str,
+    iter_corridor_chunks,
+    summarise_ensemble,
+    summary_rows,
+    summary_titles,
+    titles,
+)
+
+HEADER_FILE = "corridor.json"
+# Header entries that say which forecast run a corridor folder came from.
+RUN_KEYS = ("forecast_reference_time", "valid_from", "valid_to", "source_file")
+
+SharedCorridor = namedtuple(
+    "SharedCorridor", ["param_name", "t_unit", "members", "times", "lat_coords", "lon_coords", "values", "mask"]
+)
+
+
+def _array_filepath(folder, name):
+    return os.path.join(folder, name + ".npy")
+
+
+def _run_time(cube, coord_name):
+    # ISO time of the first point of `coord_name`, or None without one.
+    coords = cube.coords(coord_name)
+    if not coords or not len(coords[0].points):
+        return None
+    return iso_t_str.format(dt=coords[0].units.num2date(coords[0].points[0]))
+
+
+def run_identity(header):
+    # The RUN_KEYS entries of a corridor header (None where it predates them).
+    return {key: header.get(key) for key in RUN_KEYS}
+
+
+def write_shared_corridor(
+    cube, rail_line, folder, corridor=None, time_chunk=TIME_CHUNK, member_chunk=MEMBER_CHUNK, source_file=None
+):
+    # Reads the corridor of `cube` chunk by chunk into values[time, member, cell]
+    # (already in output units) and mask[time, member, cell] under `folder`.
+    # The header records the run (forecast reference time, valid-time range
+    # and `source_file`) so deltas can name their base run.
+    if corridor is None:
+        corridor = corridor_indices(cube, rail_line)
+    lat_inds, lon_inds = corridor
+    lat_coords, lon_coords = corridor_coords(cube, lat_inds, lon_inds)
+    param_name = cube.name()
+    t_unit = cube.coord("time").units
+    times = cube.coord("time").points
+    _, members = _member_points(cube)
+
+    os.makedirs(folder, exist_ok=True)
+    shape = (len(times), len(members), len(lat_inds))
+    values = np.lib.format.open_memmap(
+        _array_filepath(folder, "values"), mode="w+", dtype=np.float32, shape=shape
+    )
+    mask = np.lib.format.open_memmap(_array_filepath(folder, "mask"), mode="w+", dtype=bool, shape=shape)
+
+    # Chunks come time-major, members varying fastest.
+    t_start = m_start = 0
+    for chunk_times, chunk_members, chunk in iter_corridor_chunks(
+        cube, lat_inds, lon_inds, time_chunk, member_chunk
+    ):
+        chunk = convert_chunk(param_name, cube.units, chunk)
+        t_box = slice(t_start, t_start + len(chunk_times))
+        m_box = slice(m_start, m_start + len(chunk_members))
+        values[t_box, m_box] = np.ma.getdata(chunk)
+        mask[t_box, m_box] = np.ma.getmaskarray(chunk)
+        m_start = m_box.stop
+        if m_start == len(members):
+            t_start, m_start = t_box.stop, 0
+    values.flush()
+    mask.flush()
+    del values, mask
+
+    np.save(_array_filepath(folder, "times"), times)
+    np.save(_array_filepath(folder, "lat_coords"), lat_coords)
+    np.save(_array_filepath(folder, "lon_coords"), lon_coords)
+    header = {
+        "param_name": param_name,
+        "t_unit": str(t_unit),
+        "calendar": t_unit.calendar,
+        "members": np.asarray(members).tolist(),
+        "forecast_reference_time": _run_time(cube, "forecast_reference_time"),
+        "valid_from": iso_t_str.format(dt=t_unit.num2date(times[0])) if len(times) else None,
+        "valid_to": iso_t_str.format(dt=t_unit.num2date(times[-1])) if len(times) else None,
+        "source_file": None if source_file is None else os.path.basename(source_file),
+    }
+    with open(os.path.join(folder, HEADER_FILE), "w") as header_file:
+        json.dump(header, header_file)
+    return folder
+
+
+def open_shared_corridor(folder):
+    import cf_units
+
+    with open(os.path.join(folder, HEADER_FILE)) as header_file:
+        header = json.load(header_file)
+    arrays = [
+        np.load(_array_filepath(folder, name), mmap_mode="r")
+        for name in ("times", "lat_coords", "lon_coords", "values", "mask")
+    ]
+    return SharedCorridor(
+        header["param_name"],
+        cf_units.Unit(header["t_unit"], calendar=header["calendar"]),
+        np.array(header["members"]),
+        *arrays
+    )
+
+
+def iter_shared_chunks(corridor, m_box=slice(None), time_chunk=TIME_CHUNK):
+    # Same (time points, member points, values[time, member, cell]) chunks as
+    # iter_corridor_chunks, as views on the mapped arrays.
+    for t_start in range(0, len(corridor.times), time_chunk):
+        t_box = slice(t_start, t_start + time_chunk)
+        yield corridor.times[t_box], corridor.members[m_box], np.ma.masked_array(
+            corridor.values[t_box, m_box], mask=corridor.mask[t_box, m_box]
+        )
+
+
+def _shared_corridor_task(task):
+    # Runs in a worker process: one kind of output for one member slice.
+    folder, kind, m_box, out_filepath, location_name, windows, time_chunk = task
+    corridor = open_shared_corridor(folder)
+    row_args = (corridor.t_unit, corridor.lat_coords, corridor.lon_coords)
+    chunks = iter_shared_chunks(corridor, m_box, time_chunk)
+    with open(out_filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        if kind == "summary":
+            csvw.writerow(summary_titles)
+            for times, _, values in chunks:
+                csvw.writerows(
+                    summary_rows(location_name, corridor.param_name, *row_args, times, summarise_ensemble(values))
+                )
+        elif kind == "members":
+            csvw.writerow(titles)
+            for times, members, values in chunks:
+                csvw.writerows(chunk_rows(location_name, corridor.param_name, *row_args, times, members, values))
+        else:
+            csvw.writerow(titles)
+            for hours, start, members, stat_name, values in stream_window_stats(chunks, corridor.t_unit, windows):
+                csvw.writerows(
+                    chunk_rows(
+                        location_name,
+                        aggregated_param_name(corridor.param_name, hours, stat_name),
+                        *row_args,
+                        [start],
+                        members,
+                        values[np.newaxis],
+                        iso_t_str,
+                    )
+                )
+    return out_filepath
+
+
+def extract_shared(
+    param_file,
+    rail_line,
+    out_dir,
+    location_name="rail",
+    processes=None,
+    member_groups=None,
+    members=True,
+    summary=False,
+    aggregated=False,
+    windows=WINDOWS,
+    time_chunk=TIME_CHUNK,
+    keep_corridor=False,
+    delta_base=None,
+    delta_tolerance=None,
+):
+    # Cuts and reads one parameter file once, then splits the per-member rows
+    # and window aggregation (in `member_groups` member slices) and the
+    # ensemble summary across worker processes. Writes <stem>.csv,
+    # <stem>_summary.csv and <stem>_aggregated.csv as asked for and returns
+    # their paths. With `delta_base`, a previous run's kept corridor folder,
+    # <stem>_delta.csv holds only the values that changed since that run.
+    # `keep_corridor` leaves this run's corridor folder as the next base.
+    import iris
+
+    stem = os.path.splitext(os.path.basename(param_file))[0]
+    corridor_folder = os.path.join(out_dir, "." + stem + "_corridor")
+    kept_folder = corridor_folder
+    if delta_base is not None and os.path.abspath(delta_base) == os.path.abspath(corridor_folder):
+        # Writing over the base would compare the new run with itself, so the
+        # new corridor goes beside it and replaces it once the delta is done.
+        corridor_folder = corridor_folder + ".new"
+        if os.path.exists(corridor_folder):
+            shutil.rmtree(corridor_folder)
+    write_shared_corridor(
+        iris.load_cube(param_file), rail_line, corridor_folder, time_chunk=time_chunk, source_file=param_file
+    )
+    n_members = len(open_shared_corridor(corridor_folder).members)
+    if member_groups is None:
+        member_groups = processes or os.cpu_count()
+    bounds = np.linspace(0, n_members, min(member_groups, n_members) + 1).astype(int)
+    member_boxes = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    tasks = []
+    parts = {}
+    for kind, wanted in (("members", members), ("aggregated", aggregated)):
+        if not wanted:
+            continue
+        for i, m_box in enumerate(member_boxes):
+            part_filepath = os.path.join(corridor_folder, "{}_{}.csv".format(kind, i))
+            parts.setdefault(kind, []).append(part_filepath)
+            tasks.append((corridor_folder, kind, m_box, part_filepath, location_name, windows, time_chunk))
+    summary_filepath = os.path.join(out_dir, stem + "_summary.csv")
+    if summary:
+        tasks.append((corridor_folder, "summary", slice(None), summary_filepath, location_name, windows, time_chunk))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        profiling.map_profiled(executor, _shared_corridor_task, tasks)
+
+    written = []
+    for kind, suffix in (("members", ""), ("aggregated", "_aggregated")):
+        if kind in parts:
+            out_filepath = os.path.join(out_dir, stem + suffix + ".csv")
+            combine_csvs(parts[kind], out_filepath)
+            for part_filepath in parts[kind]:
+                os.remove(part_filepath)
+            written.append(out_filepath)
+    if summary:
+        written.append(summary_filepath)
+    if delta_base is not None and not os.path.exists(os.path.join(delta_base, HEADER_FILE)):
+        print("WARNING: No base run corridor in " + delta_base + ", so no delta is written.")
+    elif delta_base is not None:
+        from rail_delta import DELTA_TOLERANCE, write_delta_csv
+
+        delta_filepath = os.path.join(out_dir, stem + "_delta.csv")
+        write_delta_csv(
+            delta_filepath,
+            corridor_folder,
+            delta_base,
+            location_name,
+            DELTA_TOLERANCE if delta_tolerance is None else delta_tolerance,
+        )
+        written.append(delta_filepath)
+    if not keep_corridor:
+        shutil.rmtree(corridor_folder)
+    elif corridor_folder != kept_folder:
+        if os.path.exists(kept_folder):
+            shutil.rmtree(kept_folder)
+        os.replace(corridor_folder, kept_folder)
+    return written
@@ -0,0 +1,7 @@
+# The modules live at the top of the repository, so put it on the path
+# whichever folder pytest is run from.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
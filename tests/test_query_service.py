@@ -0,0 +1,96 @@
+import csv
+
+import pytest
+
+from query_service import ForecastStore, StoreReloader, parse_datetime, source_name
+from rail_csv import titles
+
+
+def write_csv(filepath, rows, header=titles):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with open(filepath, "w") as csvfile:
+        csvw = csv.writer(csvfile)
+        csvw.writerow(header)
+        csvw.writerows(rows)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    rows = []
+    for day in (20, 18, 19):
+        for member in (0, 1):
+            for lat, lon in ((51.0, -1.0), (52.0, -1.5)):
+                value = day + member / 10 + (lat - 51.0)
+                rows.append(["rail", lat, lon, "{}/07/2022".format(day), member, "air_temperature", value])
+    write_csv(tmp_path / "ensemble_data.csv", rows)
+    write_csv(
+        tmp_path / "pyramid" / "6hr.csv",
+        [["rail", 51.0, -1.0, "2022-07-18T06:00:00", 0, "air_temperature", 99.0]],
+    )
+    write_csv(tmp_path / "other.csv", [["x", "y"]], header=["not", "ours"])
+    return tmp_path
+
+
+def store_for(folder):
+    return ForecastStore(sorted(str(f) for f in folder.rglob("*.csv")), str(folder))
+
+
+def test_parse_datetime():
+    assert parse_datetime("8/07/2022") == parse_datetime("2022-07-08T00:00:00")
+
+
+def test_source_name(tmp_path):
+    assert source_name(str(tmp_path / "pyramid" / "6hr.csv"), str(tmp_path)) == "pyramid/6hr"
+
+
+def test_meta_skips_other_csvs(folder):
+    meta = store_for(folder).meta()
+    assert meta["rows"] == 13
+    assert meta["sources"] == ["ensemble_data", "pyramid/6hr"]
+    assert meta["members"] == ["0", "1"]
+    assert meta["start"] == "2022-07-18T00:00:00"
+    assert meta["end"] == "2022-07-20T00:00:00"
+
+
+def test_range_query_sorted_and_bounded(folder):
+    store = store_for(folder)
+    rows = store.range_query("rail", "air_temperature", member="0", source="ensemble_data")
+    days = ["2022-07-18T00:00:00", "2022-07-19T00:00:00", "2022-07-20T00:00:00"]
+    assert [row["time"] for row in rows] == [day for day in days for _ in range(2)]
+    rows = store.range_query(
+        "rail", "air_temperature", member="1", start="2022-07-19", end="2022-07-19", source="ensemble_data"
+    )
+    assert sorted(row["value"] for row in rows) == [19.1, 20.1]
+    assert store.range_query("rail", "wind_speed") == []
+
+
+def test_range_query_keeps_sources_apart(folder):
+    rows = store_for(folder).range_query(
+        "rail", "air_temperature", member="0", start="2022-07-18", end="2022-07-18T12:00:00"
+    )
+    assert sorted((row["source"], row["value"]) for row in rows) == [
+        ("ensemble_data", 18.0),
+        ("ensemble_data", 19.0),
+        ("pyramid/6hr", 99.0),
+    ]
+
+
+def test_point_query_nearest(folder):
+    store = store_for(folder)
+    rows = store.point_query(
+        "rail", "air_temperature", 51.9, -1.4, valid_time="2022-07-19", source="ensemble_data"
+    )
+    assert sorted((row["member"], row["lat"], row["value"]) for row in rows) == [
+        ("0", 52.0, 20.0),
+        ("1", 52.0, 20.1),
+    ]
+    assert store.point_query("rail", "air_temperature", 51.0, -1.0, valid_time="2022-07-25") == []
+
+
+def test_reloader_picks_up_new_files(folder):
+    reloader = StoreReloader(str(folder), patterns=["*.csv"])
+    assert len(reloader.store) == 12
+    assert not reloader.reload()
+    write_csv(folder / "late.csv", [["rail", 51.0, -1.0, "21/07/2022", 0, "air_temperature", 21.0]])
+    assert reloader.reload()
+    assert len(reloader.store) == 13
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from rail_aggregation import WindowAccumulator, stream_pyramid, stream_window_stats
+
+
+class SecondsUnit:
+    # Stands in for a cf_units time unit of "seconds since 1970-01-01".
+    def convert(self, points, target):
+        assert target.startswith("hours since 1970-01-01")
+        return np.asarray(points, dtype=float) / 3600
+
+
+def hourly_chunks(first_hour, n_steps, masked_step=None):
+    # One member and one cell, value = hour index from first_hour.
+    times = (first_hour + np.arange(n_steps)) * 3600.0
+    values = np.ma.masked_array(np.arange(n_steps, dtype=float).reshape(n_steps, 1, 1), mask=False)
+    if masked_step is not None:
+        values[masked_step] = np.ma.masked
+    return [(times, np.array([0]), values)]
+
+
+def test_window_accumulator_labels_window_floor():
+    acc = WindowAccumulator(6)
+    assert acc.add(7.0, 7.0, np.ma.masked_array([[1.0]])) is None
+    assert acc.add(8.0, 8.0, np.ma.masked_array([[3.0]])) is None
+    start, stats = acc.add(13.0, 13.0, np.ma.masked_array([[0.0]]))
+    assert start == 6.0
+    assert stats["max"][0, 0] == 3.0
+    assert stats["min"][0, 0] == 1.0
+    assert stats["mean"][0, 0] == 2.0
+    start, _ = acc.finish()
+    assert start == 12.0
+
+
+def test_window_accumulator_converts_floor_to_time_units():
+    # Time points in seconds: the 6 hr floor of 07:00 is 06:00.
+    acc = WindowAccumulator(6, t_points_per_hour=3600.0)
+    acc.add(7.0, 7 * 3600.0, np.ma.masked_array([[1.0]]))
+    start, _ = acc.finish()
+    assert start == 6 * 3600.0
+
+
+def test_window_stats_skip_masked_steps():
+    # Hours 1..13, with the hour 8 value (7) masked.
+    stats = {
+        (start / 3600, stat): values[0, 0]
+        for _, start, _, stat, values in stream_window_stats(hourly_chunks(1, 13, masked_step=7), SecondsUnit())
+    }
+    assert sorted({start for start, _ in stats}) == [0.0, 6.0, 12.0]
+    assert stats[(6.0, "max")] == 10.0
+    assert stats[(6.0, "min")] == 5.0
+    assert stats[(6.0, "mean")] == pytest.approx(np.mean([5, 6, 8, 9, 10]))
+
+
+def test_window_stats_all_masked_window_stays_masked():
+    chunks = hourly_chunks(0, 3)
+    chunks[0][2][:] = np.ma.masked
+    stats = {stat: values for _, _, _, stat, values in stream_window_stats(chunks, SecondsUnit(), windows=(3,))}
+    assert all(np.ma.getmaskarray(values).all() for values in stats.values())
+
+
+def test_pyramid_levels_and_labels():
+    levels = {}
+    for level, start, _, stats in stream_pyramid(hourly_chunks(1, 12), SecondsUnit(), levels=(3, 6)):
+        levels.setdefault(level, []).append((start / 3600, stats))
+    assert len(levels["native"]) == 12
+    assert [start for start, _ in levels[3]] == [0.0, 3.0, 6.0, 9.0, 12.0]
+    assert [start for start, _ in levels[6]] == [0.0, 6.0, 12.0]
+    # The 6 hr levels are built from the 3 hr ones and agree with a direct pass.
+    direct = {
+        (start / 3600, stat): values[0, 0]
+        for _, start, _, stat, values in stream_window_stats(hourly_chunks(1, 12), SecondsUnit())
+    }
+    for start, stats in levels[6]:
+        for stat in ("max", "min", "mean"):
+            assert stats[stat][0, 0] == pytest.approx(direct[(start, stat)])
+
+
+def test_pyramid_max_min_skip_masked_steps():
+    chunks = hourly_chunks(0, 6, masked_step=5)
+    (_, _, _, stats), = [item for item in stream_pyramid(chunks, SecondsUnit(), levels=(6,)) if item[0] == 6]
+    assert stats["max"][0, 0] == 4.0
+    assert stats["min"][0, 0] == 0.0
+    assert stats["mean"][0, 0] == 2.0
+
+
+def test_pyramid_rejects_levels_that_dont_nest():
+    with pytest.raises(ValueError):
+        list(stream_pyramid(hourly_chunks(0, 3), SecondsUnit(), levels=(3, 4)))
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from rail_alerts import AlertRule, detect_alerts, hot_runs, join_runs
+
+
+def test_hot_runs():
+    hot = np.array(
+        [
+            [1, 1, 0, 0, 1],
+            [0, 0, 0, 0, 0],
+            [0, 1, 1, 1, 0],
+        ],
+        dtype=bool,
+    )
+    run_times, starts, stops = hot_runs(hot)
+    assert run_times.tolist() == [0, 0, 2]
+    assert starts.tolist() == [0, 4, 1]
+    assert stops.tolist() == [2, 5, 4]
+
+
+def test_join_runs_overlapping_on_consecutive_steps():
+    # Step 0: [0, 2) and [6, 8); step 1: [1, 3); step 2: [7, 9); step 3: [2, 4).
+    run_times = np.array([0, 0, 1, 2, 3])
+    starts = np.array([0, 6, 1, 7, 2])
+    stops = np.array([2, 8, 3, 9, 4])
+    n_alerts, labels = join_runs(run_times, starts, stops)
+    assert n_alerts == 4
+    # Only [0, 2) and [1, 3) overlap; [6, 8) and [7, 9) are two steps apart.
+    assert labels[0] == labels[2]
+    assert len({labels[1], labels[3], labels[4], labels[0]}) == 4
+
+
+def test_join_runs_chain_and_touching_runs():
+    # [0, 2) then [1, 3) then [2, 4) chain into one alert; [4, 5) only
+    # touches [2, 4), which isn't an overlap.
+    run_times = np.array([0, 1, 2, 3])
+    starts = np.array([0, 1, 2, 4])
+    stops = np.array([2, 3, 4, 5])
+    n_alerts, labels = join_runs(run_times, starts, stops)
+    assert n_alerts == 2
+    assert labels[0] == labels[1] == labels[2] != labels[3]
+
+
+def test_join_runs_empty():
+    empty = np.array([], dtype=int)
+    n_alerts, labels = join_runs(empty, empty, empty)
+    assert n_alerts == 0
+    assert len(labels) == 0
+
+
+def test_detect_alerts():
+    # values[time, member, sample]: two of three members above 30 at samples
+    # 2-4 on steps 1-2, one member only (not enough) at sample 7 on step 0.
+    values = np.full((3, 3, 10), 20.0)
+    values[1:3, :2, 2:5] = 31.0
+    values[2, 0, 3] = 35.0
+    values[0, 0, 7] = 40.0
+    rule = AlertRule("air_temperature", 30.0, True, 0.5)
+    alerts = detect_alerts(values, np.arange(10.0), rule)
+    assert len(alerts) == 1
+    alert = alerts[0]
+    assert alert["times"] == (1, 2)
+    assert alert["samples"] == (2, 4)
+    assert alert["peak"] == 35.0
+    assert alert["probability"] == pytest.approx(2 / 3)
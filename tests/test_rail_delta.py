@@ -0,0 +1,117 @@
+import csv
+import datetime
+import json
+
+import numpy as np
+
+import rail_delta
+from rail_delta import corridor_delta, delta_titles
+from shared_corridor import HEADER_FILE, SharedCorridor
+
+
+class HoursUnit:
+    # Stands in for a cf_units time unit of "hours since 1970-01-01".
+    def convert(self, points, target):
+        return np.asarray(points, dtype=float)
+
+    def num2date(self, point):
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=float(point))
+
+
+def corridor(times, members, values, mask=None, lat_coords=(50.0, 50.1, 50.2)):
+    values = np.asarray(values, dtype=np.float32)
+    return SharedCorridor(
+        "air_temperature",
+        HoursUnit(),
+        np.asarray(members),
+        np.asarray(times, dtype=float),
+        np.asarray(lat_coords),
+        np.array([-1.0, -1.0, -1.0]),
+        values,
+        np.zeros(values.shape, dtype=bool) if mask is None else np.asarray(mask),
+    )
+
+
+def apply_delta(new, base, emit):
+    # What a client holding `base` rebuilds from the delta: base values at
+    # the shared times and members, then every emitted value on top.
+    values = np.full(new.values.shape, np.nan, dtype=float)
+    new_ti, base_ti = rail_delta._aligned(new.times, base.times)
+    new_mi, base_mi = rail_delta._aligned(new.members.astype(str), base.members.astype(str))
+    shared = np.where(base.mask, np.nan, base.values)[np.ix_(base_ti, base_mi)]
+    values[np.ix_(new_ti, new_mi)] = shared
+    values[emit] = np.where(new.mask, np.nan, new.values)[emit]
+    return values
+
+
+def make_runs():
+    rng = np.random.default_rng(0)
+    # The base run covers hours 0-5, the new run hours 3-8 with one more member.
+    base = corridor(np.arange(6), [0, 1], 280 + rng.random((6, 2, 3)))
+    new_values = 280 + rng.random((6, 3, 3))
+    new_values[:3, :2] = base.values[3:] + 0.01
+    new_values[1, 0, 2] += 1.0
+    new_mask = np.zeros(new_values.shape, dtype=bool)
+    new_mask[2, 1, 0] = True
+    return corridor(np.arange(3, 9), [0, 1, 2], new_values, new_mask), base
+
+
+def test_corridor_delta_round_trip():
+    new, base = make_runs()
+    emit, had_base = corridor_delta(new, base, tolerance=0.1)
+    rebuilt = apply_delta(new, base, emit)
+    expected = np.where(new.mask, np.nan, new.values)
+    np.testing.assert_allclose(rebuilt, expected, atol=0.1)
+    np.testing.assert_array_equal(np.isnan(rebuilt), new.mask)
+
+
+def test_corridor_delta_emits_only_changes():
+    new, base = make_runs()
+    emit, had_base = corridor_delta(new, base, tolerance=0.1)
+    # Overlapping steps and members: only the moved and the removed values.
+    assert list(zip(*np.nonzero(emit[:3, :2]))) == [(1, 0, 2), (2, 1, 0)]
+    # New valid times and the new member are all written.
+    assert emit[3:].all()
+    assert emit[:, 2].all()
+    assert had_base[:3, :2].all()
+    assert not had_base[3:].any()
+
+
+def test_corridor_delta_different_corridor_is_all_new():
+    new, base = make_runs()
+    moved = new._replace(lat_coords=new.lat_coords + 0.5)
+    emit, had_base = corridor_delta(moved, base)
+    np.testing.assert_array_equal(emit, ~moved.mask)
+    assert not had_base.any()
+
+
+def test_write_delta_csv_names_runs(tmp_path, monkeypatch):
+    new, base = make_runs()
+    folders = {}
+    for name, run, start in (("new", new, "1970-01-01T03:00:00"), ("base", base, "1970-01-01T00:00:00")):
+        folder = tmp_path / name
+        folder.mkdir()
+        header = {
+            "param_name": run.param_name,
+            "forecast_reference_time": start,
+            "valid_from": start,
+            "valid_to": None,
+            "source_file": name + ".nc",
+        }
+        (folder / HEADER_FILE).write_text(json.dumps(header))
+        folders[str(folder)] = run
+    monkeypatch.setattr(rail_delta, "open_shared_corridor", folders.__getitem__)
+
+    out_filepath = tmp_path / "delta.csv"
+    manifest = rail_delta.write_delta_csv(str(out_filepath), str(tmp_path / "new"), str(tmp_path / "base"))
+    assert manifest["base"]["source_file"] == "base.nc"
+    assert manifest["run"]["forecast_reference_time"] == "1970-01-01T03:00:00"
+    assert manifest["removed"] == 1
+    assert json.loads((tmp_path / "delta.json").read_text()) == manifest
+
+    with open(out_filepath) as csvfile:
+        rows = list(csv.reader(csvfile))
+    assert rows[0] == delta_titles
+    assert len(rows) - 1 == manifest["rows"]
+    removed = [row for row in rows[1:] if row[-1] == "1"]
+    assert len(removed) == 1 and removed[0][-2] == "nan"
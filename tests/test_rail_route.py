@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from rail_route import (
+    DEFAULT_ROUTE_FILE,
+    RouteRegistry,
+    haversine_km,
+    load_rail_lat_lons,
+    rail_line_from_lat_lons,
+    resample_route,
+    split_route_parts,
+)
+
+# Due north along a meridian, so chainage is just the change in latitude.
+KM_PER_DEGREE = haversine_km(0.0, 0.0, 1.0, 0.0)
+
+
+def test_resample_route_spacing_and_end():
+    chainage, lats, lons = resample_route([[50.0, -1.0], [50.1, -1.0], [50.3, -1.0]], spacing_km=5.0)
+    total_km = 0.3 * KM_PER_DEGREE
+    assert chainage[0] == 0.0
+    assert chainage[-1] == pytest.approx(total_km)
+    np.testing.assert_allclose(np.diff(chainage[:-1]), 5.0)
+    assert chainage[-2] > total_km - 5.0
+    np.testing.assert_allclose(lats, 50.0 + chainage / KM_PER_DEGREE)
+    np.testing.assert_allclose(lons, -1.0)
+
+
+def test_resample_route_keeps_parts_apart():
+    # Two parts with a 0.1 degree gap between them: no sample in the gap and
+    # chainage carries on from the end of the first part.
+    rail_lat_lons = [[50.0, -1.0], [50.1, -1.0], [np.nan, np.nan], [50.2, -1.0], [50.3, -1.0]]
+    chainage, lats, lons = resample_route(rail_lat_lons, spacing_km=2.0)
+    assert not np.any((lats > 50.1 + 1e-9) & (lats < 50.2 - 1e-9))
+    assert chainage[-1] == pytest.approx(0.2 * KM_PER_DEGREE)
+    assert np.all(np.diff(chainage) >= 0)
+    assert not np.isnan(lats).any()
+
+
+def test_split_route_parts_and_multilinestring():
+    rail_lat_lons = [[50.0, -1.0], [50.1, -1.0], [np.nan, np.nan], [50.2, -0.5], [50.3, -0.5]]
+    parts = split_route_parts(rail_lat_lons)
+    assert [len(part) for part in parts] == [2, 2]
+    line = rail_line_from_lat_lons(rail_lat_lons)
+    assert line.geom_type == "MultiLineString"
+    assert rail_line_from_lat_lons(parts[0]).geom_type == "LineString"
+
+
+def test_registry_reads_geojson_parts_and_caches_lazily(tmp_path):
+    geojson = {
+        "type": "MultiLineString",
+        "coordinates": [[[-1.0, 50.0], [-1.0, 50.1]], [[-0.5, 50.2], [-0.5, 50.3]]],
+    }
+    route_file = tmp_path / "two_parts.geojson"
+    route_file.write_text(json.dumps(geojson))
+    cache_folder = tmp_path / "cache"
+
+    registry = RouteRegistry(cache_folder=str(cache_folder))
+    assert not cache_folder.exists()
+    route = registry.load(str(route_file))
+    assert cache_folder.exists()
+    assert route.name == "two_parts"
+    assert route.line.geom_type == "MultiLineString"
+    np.testing.assert_array_equal(np.isnan(route.rail_lat_lons[:, 0]), [False, False, True, False, False])
+    # The second load comes from the cache.
+    np.testing.assert_array_equal(
+        RouteRegistry(cache_folder=str(cache_folder)).load(str(route_file)).rail_lat_lons, route.rail_lat_lons
+    )
+
+
+def test_default_route_file_loads():
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    rail_lat_lons = load_rail_lat_lons(os.path.join(repo_folder, DEFAULT_ROUTE_FILE))
+    chainage, _, _ = resample_route(rail_lat_lons)
+    assert len(rail_lat_lons) > 2
+    assert 500 < chainage[-1] < 700
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from work_queue import SQLiteWorkQueue, open_queue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteWorkQueue(str(tmp_path / "queue.db"))
+
+
+def expire_leases(queue):
+    with queue._transaction() as db:
+        db.execute("UPDATE jobs SET lease_expires = ? WHERE status = 'running'", (time.time() - 1,))
+
+
+def test_claim_by_priority_then_order(queue):
+    first = queue.put("download", {"n": 1})
+    urgent = queue.put("download", {"n": 2}, priority=5)
+    queue.put("download", {"n": 3})
+    claimed = [queue.claim("w") for _ in range(3)]
+    assert [job.id for job in claimed[:2]] == [urgent, first]
+    assert claimed[0].payload == {"n": 2}
+    assert claimed[0].attempts == 1
+    assert queue.claim("w") is None
+
+
+def test_jobs_wait_for_their_group(queue):
+    download = queue.put("download", {}, group="run")
+    queue.put("convert", {}, after="run")
+    job = queue.claim("w")
+    assert job.id == download
+    assert queue.claim("w") is None
+    queue.complete(job.id, "w", {"ok": True})
+    assert queue.claim("w").kind == "convert"
+
+
+def test_lease_heartbeat_and_expiry(queue):
+    queue.put("download", {})
+    job = queue.claim("w1", lease_seconds=60)
+    # Leased: nobody else gets it, and only its worker can extend it.
+    assert queue.claim("w2") is None
+    assert queue.heartbeat(job.id, "w1")
+    assert not queue.heartbeat(job.id, "w2")
+    expire_leases(queue)
+    retried = queue.claim("w2")
+    assert retried.id == job.id
+    assert retried.attempts == 2
+    # The first worker lost the job, so its completion is ignored.
+    queue.complete(job.id, "w1")
+    assert queue.counts() == {"running": 1}
+
+
+def test_fail_retries_until_max_attempts(queue):
+    queue.put("download", {})
+    for attempt in (1, 2):
+        job = queue.claim("w", max_attempts=2)
+        assert job.attempts == attempt
+        queue.fail(job.id, "w", "boom", max_attempts=2)
+    assert queue.counts() == {"failed": 1}
+    assert queue.claim("w", max_attempts=2) is None
+
+
+def test_expired_last_attempt_fails(queue):
+    # A job that keeps taking its worker down never calls fail().
+    queue.put("download", {})
+    for _ in range(3):
+        assert queue.claim("w", max_attempts=3) is not None
+        expire_leases(queue)
+    assert queue.claim("w", max_attempts=3) is None
+    assert queue.counts() == {"failed": 1}
+
+
+def test_open_queue(tmp_path):
+    assert isinstance(open_queue(str(tmp_path / "a.db")), SQLiteWorkQueue)
+    assert isinstance(open_queue("sqlite://" + str(tmp_path / "b.db")), SQLiteWorkQueue)
+    with pytest.raises(ValueError):
+        open_queue("redis://localhost")
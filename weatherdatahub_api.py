@@ -0,0 +1,9 @@
+# Weather DataHub API settings shared by the download, queue and watcher
+# scripts.
+#
+# Kept apart from fetch_from_weatherdatahub.py, which needs requests, eccodes
+# and the Azure SDK, so the queue and the watcher can read them without
+# importing the whole download script.
+
+MODEL_LIST = ["mo-global", "mo-uk", "mo-uk-latlon", "mo-mogrepsg"]
+BASE_URL = "https://api-metoffice.apiconnect.ibmcloud.com/metoffice/production/1.0.0"
@@ -0,0 +1,393 @@
+# Distributed download and conversion through a shared work queue.
+#
+# download_from_weatherdatahub() and main() in fetch_from_weatherdatahub.py
+# run every download and conversion on the driver. Here each file download
+# and each per-parameter conversion becomes a job in a queue, and any number
+# of worker processes, on any number of nodes, claim jobs from it. A claimed
+# job holds a lease that its worker extends with heartbeats while it runs;
+# if a worker dies its lease expires and the job is claimed again, up to
+# MAX_ATTEMPTS attempts in all, whether earlier attempts raised or took
+# their worker down with them. A conversion job waits until every download job of its
+# run is done.
+#
+# SQLiteWorkQueue keeps the queue in one SQLite file, relying on SQLite's
+# file locking, for local testing and for nodes sharing a filesystem that
+# supports POSIX locks. Cluster backends implement the WorkQueue methods and
+# register themselves in QUEUE_BACKENDS under a URL scheme.
+#
+#   python work_queue.py enqueue -q queue.db -c <client> -s <secret> -o <order> -r 00 -p agl_temperature
+#   python work_queue.py work -q queue.db -c <client> -s <secret>
+
+import abc
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from weatherdatahub_api import BASE_URL
+
+QUEUE_FILE = "queue.db"
+LEASE_SECONDS = 300
+POLL_PERIOD = 10
+MAX_ATTEMPTS = 3
+
+Job = namedtuple("Job", ["id", "kind", "payload", "attempts"])
+
+
+class WorkQueue(abc.ABC):
+    # Interface for queue backends. Jobs in `group` can be waited on by jobs
+    # put with after=group; higher priority jobs are claimed first.
+
+    @abc.abstractmethod
+    def put(self, kind, payload, group=None, after=None, priority=0):
+        pass
+
+    @abc.abstractmethod
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        # Returns a Job leased to worker_id, or None when nothing is ready.
+        # Jobs whose lease expired after max_attempts claims are failed.
+        pass
+
+    @abc.abstractmethod
+    def heartbeat(self, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+        # Extends the lease; returns False if the job is no longer ours.
+        pass
+
+    @abc.abstractmethod
+    def complete(self, job_id, worker_id, result=None):
+        pass
+
+    @abc.abstractmethod
+    def fail(self, job_id, worker_id, error, max_attempts=MAX_ATTEMPTS):
+        pass
+
+    @abc.abstractmethod
+    def counts(self):
+        # {status: number of jobs}
+        pass
+
+
+class SQLiteWorkQueue(WorkQueue):
+    def __init__(self, filepath=QUEUE_FILE):
+        self.filepath = filepath
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    grp TEXT,
+                    after TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority)")
+
+    def _db(self):
+        # One connection per thread, so heartbeats don't share the worker's.
+        if not hasattr(self._local, "db"):
+            self._local.db = sqlite3.connect(self.filepath, timeout=60, isolation_level=None)
+        return self._local.db
+
+    def _transaction(self):
+        queue = self
+
+        class Transaction:
+            def __enter__(self):
+                self.db = queue._db()
+                # Takes the write lock up front so claims can't interleave.
+                self.db.execute("BEGIN IMMEDIATE")
+                return self.db
+
+            def __exit__(self, exc_type, exc, tb):
+                self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+        return Transaction()
+
+    def put(self, kind, payload, group=None, after=None, priority=0):
+        with self._transaction() as db:
+            return db.execute(
+                "INSERT INTO jobs (kind, payload, grp, after, priority) VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), group, after, priority),
+            ).lastrowid
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        now = time.time()
+        with self._transaction() as db:
+            # A job that keeps taking its worker down never reaches fail().
+            db.execute(
+                """UPDATE jobs SET status = 'failed', lease_expires = NULL,
+                error = COALESCE(error, 'Lease expired on the last attempt')
+                WHERE status = 'running' AND lease_expires < ? AND attempts >= ?""",
+                (now, max_attempts),
+            )
+            row = db.execute(
+                """SELECT id, kind, payload, attempts FROM jobs AS j
+                WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ? AND attempts < ?))
+                AND (after IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM jobs AS d WHERE d.grp = j.after AND d.status != 'done'))
+                ORDER BY priority DESC, id LIMIT 1""",
+                (now, max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + lease_seconds, job_id, worker_id),
+            ).rowcount
+        return updated == 1
+
+    def complete(self, job_id, worker_id, result=None):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'done', result = ?, lease_expires = NULL WHERE id = ? AND worker = ?",
+                (json.dumps(result), job_id, worker_id),
+            )
+
+    def fail(self, job_id, worker_id, error, max_attempts=MAX_ATTEMPTS):
+        # Back to pending for another worker, or failed for good.
+        with self._transaction() as db:
+            db.execute(
+                """UPDATE jobs SET error = ?, lease_expires = NULL,
+                status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END
+                WHERE id = ? AND worker = ?""",
+                (error, max_attempts, job_id, worker_id),
+            )
+
+    def counts(self):
+        return dict(self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+QUEUE_BACKENDS = {"sqlite": SQLiteWorkQueue}
+
+
+def open_queue(url):
+    # "scheme://location" for a registered backend; a plain path is SQLite.
+    scheme, sep, location = url.partition("://")
+    if not sep:
+        return SQLiteWorkQueue(url)
+    if scheme not in QUEUE_BACKENDS:
+        raise ValueError("Unknown work queue backend: " + scheme)
+    return QUEUE_BACKENDS[scheme](location)
+
+
+def run_folder(base_folder, order_name, run):
+    return os.path.join(base_folder, "downloaded", order_name + "_" + run)
+
+
+def download_job(payload, context):
+    import fetch_from_weatherdatahub as wdh
+
+    os.makedirs(payload["folder"], exist_ok=True)
+    return wdh.get_order_file(
+        context["baseUrl"],
+        context["requestHeaders"],
+        payload["orderName"],
+        payload["fileId"],
+        False,
+        payload["folder"],
+        time.time(),
+    )[1]
+
+
+def convert_job(payload, context):
+    import fetch_from_weatherdatahub as wdh
+
+    return wdh.convert_and_save_netcdf_xr(payload["folder"], payload["parameter"])
+
+
+JOB_HANDLERS = {"download": download_job, "convert": convert_job}
+
+
+def enqueue_order(work_queue, base_url, request_headers, order_name, runs, base_folder, parameters):
+    # A download job per file of each run, then a conversion job per
+    # parameter that waits for all of that run's downloads. Credentials are
+    # not stored in the queue; workers bring their own.
+    import fetch_from_weatherdatahub as wdh
+
+    order = wdh.get_order_details(base_url, request_headers, order_name, True, runs)
+    files_by_run = wdh.get_files_by_run(order, runs, 0)
+    job_ids = []
+    for run in runs:
+        folder = run_folder(base_folder, order_name, run)
+        group = "download:" + order_name + "_" + run
+        for file_id in files_by_run[run]:
+            job_ids.append(
+                work_queue.put(
+                    "download", {"orderName": order_name, "fileId": file_id, "folder": folder}, group=group
+                )
+            )
+        for parameter in parameters:
+            job_ids.append(
+                work_queue.put("convert", {"folder": folder, "parameter": parameter}, after=group)
+            )
+    return job_ids
+
+
+def _keep_leased(work_queue, job, worker_id, lease_seconds, stop):
+    while not stop.wait(lease_seconds / 3):
+        if not work_queue.heartbeat(job.id, worker_id, lease_seconds):
+            print("WARNING: Lost the lease on job " + str(job.id))
+            return
+
+
+def run_worker(
+    work_queue,
+    context,
+    worker_id=None,
+    handlers=JOB_HANDLERS,
+    lease_seconds=LEASE_SECONDS,
+    poll_period=POLL_PERIOD,
+    max_attempts=MAX_ATTEMPTS,
+    exit_when_idle=True,
+    verbose=False,
+):
+    # Claims and runs jobs until nothing is left that could become ready (or
+    # forever when exit_when_idle is False). Returns the jobs done.
+    if worker_id is None:
+        worker_id = socket.gethostname() + ":" + str(os.getpid()) + ":" + uuid.uuid4().hex[:8]
+    done = 0
+    while True:
+        job = work_queue.claim(worker_id, lease_seconds, max_attempts)
+        if job is None:
+            counts = work_queue.counts()
+            # With nothing running, pending jobs are waiting on failed ones.
+            if exit_when_idle and not counts.get("running"):
+                if counts.get("pending"):
+                    print("WARNING: " + str(counts["pending"]) + " jobs are blocked by failed jobs")
+                return done
+            time.sleep(poll_period)
+            continue
+
+        if verbose:
+            print(worker_id + " running " + job.kind + " job " + str(job.id) + " (attempt " + str(job.attempts) + ")")
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=_keep_leased, args=(work_queue, job, worker_id, lease_seconds, stop), daemon=True
+        )
+        heartbeat.start()
+        try:
+            result = handlers[job.kind](job.payload, context)
+        except Exception as ex:
+            print("WARNING: " + job.kind + " job " + str(job.id) + " failed: " + format(ex))
+            work_queue.fail(job.id, worker_id, format(ex), max_attempts)
+        else:
+            work_queue.complete(job.id, worker_id, result)
+            done += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Queue Weather DataHub downloads and conversions, or work through the queue."
+    )
+    parser.add_argument("mode", choices=["enqueue", "work", "status"], help="What to do.")
+    parser.add_argument(
+        "-q", "--queue", action="store", dest="queue", default=QUEUE_FILE, help="Queue file or backend URL."
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        action="store",
+        dest="baseUrl",
+        default=BASE_URL,
+        help="Base URL used to access Weather DataHub API.",
+    )
+    parser.add_argument(
+        "-c", "--client", action="store", dest="clientId", default="", help="Client ID of your WDH Application"
+    )
+    parser.add_argument(
+        "-s", "--secret", action="store", dest="secret", default="", help="Your WDH API Gateway secret"
+    )
+    parser.add_argument(
+        "-k", "--apikey", action="store", dest="apikey", default="", help="Use direct API Key when not via APIM."
+    )
+    parser.add_argument(
+        "-o", "--orders", action="store", dest="orders", default="", help="Comma separated list of orders to queue."
+    )
+    parser.add_argument(
+        "-r", "--runs", action="store", dest="runs", default="00", help="Comma separated list of runs to queue."
+    )
+    parser.add_argument(
+        "-p",
+        "--parameters",
+        action="store",
+        dest="parameters",
+        default="agl_temperature",
+        help="Comma separated parameters to convert once a run is downloaded.",
+    )
+    parser.add_argument(
+        "-l", "--location", action="store", dest="location", default="./test_data", help="Base download folder."
+    )
+    parser.add_argument(
+        "-e",
+        "--lease",
+        action="store",
+        dest="lease",
+        default=LEASE_SECONDS,
+        type=int,
+        help="Lease length in seconds. Defaults to 300.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose mode."
+    )
+    args = parser.parse_args()
+
+    work_queue = open_queue(args.queue)
+    if args.mode == "status":
+        print(work_queue.counts())
+        return
+
+    if args.apikey == "":
+        if args.clientId == "" or args.secret == "":
+            print("ERROR: IBM client and secret must be supplied.")
+            exit()
+        request_headers = {"x-ibm-client-id": args.clientId, "x-ibm-client-secret": args.secret}
+    else:
+        request_headers = {"x-api-key": args.apikey}
+
+    if args.mode == "enqueue":
+        if args.orders == "":
+            print("ERROR: You must pass an orders list to queue.")
+            exit()
+        for order_name in args.orders.lower().split(","):
+            job_ids = enqueue_order(
+                work_queue,
+                args.baseUrl,
+                request_headers,
+                order_name,
+                args.runs.split(","),
+                args.location,
+                args.parameters.split(","),
+            )
+            print("Queued " + str(len(job_ids)) + " jobs for " + order_name)
+    else:
+        context = {"baseUrl": args.baseUrl, "requestHeaders": request_headers}
+        done = run_worker(work_queue, context, lease_seconds=args.lease, verbose=args.verbose)
+        print("Worker finished " + str(done) + " jobs: " + str(work_queue.counts()))
+
+
+if __name__ == "__main__":
+    main()